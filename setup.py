@@ -17,6 +17,9 @@ config = {
     'install_requires': [
         'pyzmq',
         ],
+    'extras_require': {
+        'asyncssh': ['asyncssh'],
+        },
     'classifiers':[
         "Development Status :: 5 - Production/Stable",
         "Topic :: Utilities",
@@ -25,7 +28,9 @@ config = {
     'test_suite':'sshm.test.suite',
     'entry_points':{
         'console_scripts': [
-            'sshm = sshm.main:main'
+            'sshm = sshm.main:main',
+            'sshmd = sshm.daemon:main',
+            'sshm-query = sshm.store:main',
             ]
         },
     }
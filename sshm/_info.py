@@ -24,11 +24,96 @@ __long_description__ = '''
 
              $ cat some_file | sshm example[1-5].com "cat > some_file"
 
+        Copy a large file through a tree of servers, each server forwards it to two more servers (each server must be able to ssh into the others):
+
+             $ cat some_file | sshm --fanout 2 example[1-50].com "cat > some_file" -A
+
+        Copy a log file from several servers into logs/<uri>/syslog.gz:
+
+             $ sshm --gather logs --compress example[1-5].com /var/log/syslog
+
+        Write the output of each server to out/<uri>.out and out/<uri>.err instead of keeping it in memory:
+
+             $ sshm --output-dir out example[1-50].com "journalctl -b"
+
+        Resolve every server before connecting, servers that do not exist are reported immediately and names of the same address are only connected to once:
+
+             $ sshm --resolve web[001-500].example.com "uptime"
+
+        Roll out a change on one server first, then on 10%% of the servers at a time. Stop when more than 5%% of the servers have failed, the servers that were not started are listed:
+
+             $ sshm --canary 1 --batch 10%% --max-failure-rate 0.05 web[001-500].example.com "sudo systemctl restart app"
+
+        Run every line of audit.sh as a separate command, all in one ssh session on each server. The output of each command is printed separately, and a server stops at its first failed command:
+
+             $ sshm --script --stop-on-failure example[1-50].com audit.sh
+
+        Start a daemon that keeps connections to servers open between jobs, then run jobs through it. All jobs share the daemon's 40 workers:
+
+             $ sshmd --workers 40 &
+             $ sshm --daemon example[1-50].com "uptime"
+
+        Connect to every server from within sshm using asyncssh (pip install sshm[asyncssh]), instead of running an ssh process for each one:
+
+             $ sshm --transport asyncssh --workers 2000 10.20.0.0/20 "uptime"
+
+        Compress the output of each server before it is sent, servers without gzip send it as it is:
+
+             $ sshm --compress example[1-50].com "journalctl -b"
+
+        Summarize the number printed by every server, instead of printing each one:
+
+             $ sshm --reduce web[001-500].example.com "ps aux | wc -l"
+             sshm: 500 hosts, 0 failed, 0 did not print a number
+             sshm: sum 61532, mean 123.064, standard deviation 14.2061
+             sshm: min 98 (web123.example.com), max 311 (web007.example.com)
+             sshm: p50 121, p90 139, p99 171
+             sshm: highest: web007.example.com (311), web250.example.com (190), ...
+             sshm: lowest: web123.example.com (98), web042.example.com (99), ...
+
+        Remember how long each server takes, and start the slowest servers first so they do not finish last:
+
+             $ sshm --history web[001-500].example.com "sudo apt-get update"
+
+        Store every result in a local database, then find the servers whose result changed since the previous run:
+
+             $ sshm --store web[001-500].example.com "uname -r"
+             $ sshm-query --changed "uname -r"
+             $ sshm-query --host web007.example.com --limit 10
+
+        Prefix every line of output with its server, so it can be searched using grep:
+
+             $ sshm --inline example[1-3].com "df -h /" | grep -v Filesystem
+             example1.com: /dev/sda1        50G   21G   27G  44%% /
+             example2.com: /dev/sda1        50G   43G  4.6G  91%% /
+             example3.com: /dev/sda1        50G   12G   36G  25%% /
+
+        Find where a slow run spends its time, in sshm's loop and in the ssh calls, optionally sampling its stack:
+
+             $ sshm --profile example[1-500].com "uptime" > /dev/null
+             sshm: profile: elapsed 9.482s
+             sshm: profile: coordinator poll: 1000 calls, 8.931s wall, 0.041s cpu
+             sshm: profile: coordinator thread start: 500 calls, 0.412s wall, 0.052s cpu
+             ...
+             $ sshm --profile --profile-interval 0.01 --profile-output profile.json example[1-500].com "uptime"
+
         Specify a per-host port:
 
              $ sshm example1.com:123,example2.com,example4.com:78 "exit"
 
-        Specify multiple groups of servers, the last positional argument is assumed to be the command.
+        Specify networks using CIDR, an IPv6 address must be in brackets to specify a port:
+
+             $ sshm 10.20.0.0/22,root@[2001:db8::/120]:22 "uptime"
+
+        Only use the servers of both specifications (--exclude removes them instead):
+
+             $ sshm --intersect 10.20.0.0/24 10.20.0-3.1-9 "uptime"
+
+        Skip some servers, and alternate between subnets so no subnet receives every connection at once (--order random --seed 7 would use a repeatable random order instead):
+
+             $ sshm --exclude 10.20.1.0/24,10.20.2.1-9 --order interleave 10.20.0.0/16 "uptime"
+
+        Specify multiple groups of servers, the last positional argument is assumed to be the command.  A server in more than one group is only connected to once.
 
             $ sshm 192.168.0.1-20 example.com,mail[03-5].example.com "uptime"
 
@@ -52,12 +137,16 @@ __long_description__ = '''
                   (ssh -q example.com echo example)
 
 
+        Connect to new servers without being asked about their keys, and without disabling host key checking. The keys of the servers that are not in your known_hosts are scanned in parallel first, and accepted the first time, like answering "yes" to ssh. This trusts the network the keys are scanned over. A server that is in your known_hosts is still checked against the key it has there:
+
+             $ sshm --prefetch-hostkeys new[001-200].example.com "uptime" -oStrictHostKeyChecking=yes
+
         Any arguments not recognized by SSHM will be passed to ssh:
 
             $ ssh example.com "ls" -o StrictHostKeyChecking=no
 
-        Attempt to get hostnames of the entire 10.0.0.0 subnet, do not store keys found, do not ask about keys found, do not prompt for password, timeout connection after 1 second, tell ssh to not display any error output. This command will take several days, and is not secure because all keys are ignored:
+        Attempt to get hostnames of the entire 10.0.0.0 subnet, do not store keys found, do not ask about keys found, do not prompt for password, timeout connection after 1 second, tell ssh to not display any error output. Only servers accepting connections on port 22 are connected to (--probe), hundreds of servers are checked at a time. This is not secure because all keys are ignored:
 
-            $ sshm -q 10.0-255.0-255.0-255 "hostname" -oUserKnownHostsFile=/dev/null -oStrictHostKeyChecking=no -oBatchMode=yes -oConnectTimeout=1
+            $ sshm -q --probe 10.0-255.0-255.0-255 "hostname" -oUserKnownHostsFile=/dev/null -oStrictHostKeyChecking=no -oBatchMode=yes -oConnectTimeout=1
     ''' % (__version__)
 
@@ -0,0 +1,166 @@
+"""
+An ssh transport that connects using asyncssh instead of an ssh client process.
+
+Every connection is a coroutine of one event loop, which runs in its own
+thread.  A connection costs some memory of this process instead of an ssh
+process, so many more servers can be connected to at once.  This requires
+Python 3 and asyncssh.
+"""
+import asyncio
+import os
+import subprocess
+import threading
+import asyncssh
+
+__all__ = ['start']
+
+# The event loop of every connection, it is started by the first connection.
+_loop = None
+_loop_lock = threading.Lock()
+
+
+def _event_loop():
+    """
+    Get the event loop of the connections, start it if it is not running.
+    """
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=_loop.run_forever, name='sshm-asyncssh')
+            thread.daemon = True
+            thread.start()
+    return _loop
+
+
+def _run(coroutine):
+    """
+    Run "coroutine" in the event loop, wait for its result.
+    """
+    return asyncio.run_coroutine_threadsafe(coroutine, _event_loop()).result()
+
+
+def _message(error, host, port):
+    """
+    Describe a connection error like the ssh client does.
+    """
+    if isinstance(error, asyncssh.Error):
+        return 'ssh: {}\n'.format(error.reason)
+    return 'ssh: connect to host {} port {}: {}\n'.format(host, port or 22,
+            os.strerror(error.errno) if error.errno else error)
+
+
+class _Process(object):
+    """
+    A command running on a server, with the methods of subprocess.Popen that
+    ssh uses.  A failed connection is reported like the ssh client reports it,
+    with the return code 255.
+    """
+
+    def __init__(self, host, port, command, options, stdout, stderr):
+        self.stdin = self
+        self.returncode = None
+        self._conn = self._process = None
+        self._stdout = stdout
+        self._stderr = stderr
+        try:
+            _run(self._start(host, port, command, options))
+        except (OSError, asyncssh.Error) as error:
+            self._error = _message(error, host, port).encode()
+            self.returncode = 255
+
+
+    async def _start(self, host, port, command, options):
+        conn = await asyncssh.connect(host, port, **options)
+        try:
+            self._process = await conn.create_process(command, encoding=None,
+                    stdout=self._stdout, stderr=self._stderr)
+        except:
+            conn.close()
+            raise
+        self._conn = conn
+
+
+    async def _write(self, chunk):
+        self._process.stdin.write(chunk)
+        await self._process.stdin.drain()
+
+
+    async def _communicate(self):
+        self._process.stdin.write_eof()
+        completed = await self._process.wait()
+        self._conn.close()
+        await self._conn.wait_closed()
+        return completed
+
+
+    def write(self, chunk):
+        """
+        Write "chunk" to the command's stdin.
+        """
+        try:
+            _run(self._write(chunk))
+        except (ConnectionError, asyncssh.Error):
+            raise IOError('The stdin of the command is closed')
+
+
+    def close(self):
+        """
+        The stdin is closed by communicate.
+        """
+
+
+    def poll(self):
+        """
+        Get the return code, None while the command is running.
+        """
+        if self.returncode is None and self._process.exit_status is not None:
+            self.returncode = self._process.returncode
+        return self.returncode
+
+
+    def communicate(self):
+        """
+        Close the command's stdin, and wait for it to exit.
+
+        @returns: (stdout, stderr), None for an output that was redirected.
+        """
+        if self._conn is None:
+            if self._stderr == subprocess.PIPE:
+                return b'', self._error
+            self._stderr.write(self._error)
+            return None, None
+        completed = _run(self._communicate())
+        # Without an exit status, the connection was lost like ssh's 255
+        self.returncode = 255 if completed.returncode is None else completed.returncode
+        return (completed.stdout if self._stdout == subprocess.PIPE else None,
+                completed.stderr if self._stderr == subprocess.PIPE else None)
+
+
+def start(user_host, port, command, extra_arguments, address=None, host_key_alias=None,
+        known_hosts=None, stdout=subprocess.PIPE, stderr=subprocess.PIPE):
+    """
+    Run "command" on "user_host" using asyncssh, see sshm.lib._openssh.  The
+    user's ssh config, keys and agent are used like the ssh client would.
+
+    "extra_arguments" are arguments of the ssh client, they can not be used.
+    The host key of "address" is checked using the name of the host, asyncssh
+    adds the port to it.
+    """
+    cmd = ['asyncssh', user_host] + (['-p', port] if port else []) + [command]
+    if extra_arguments:
+        error = ValueError('The asyncssh transport does not accept ssh arguments: {}'.format(
+            ' '.join(extra_arguments)))
+        error.cmd = cmd
+        raise error
+    user, _, host = user_host.rpartition('@')
+    options = {}
+    if user:
+        options['username'] = user
+    if address:
+        options['host_key_alias'] = host
+    if known_hosts:
+        files = [os.path.expanduser(i) for i in known_hosts]
+        options['known_hosts'] = [i for i in files if os.path.exists(i)]
+    return cmd, _Process(address or host, int(port) if port else (), command, options,
+            stdout, stderr)
@@ -0,0 +1,263 @@
+#! /usr/bin/env python3
+"""
+A long-lived sshm process that runs the jobs of many clients.
+
+The daemon listens on a local Unix socket.  Each job is run by its own call to
+sshm, but all jobs share one limit of concurrent ssh connections, and all of
+them reuse the same ssh master connections.  The results of a job are sent
+back to its client as they are received.
+"""
+
+from __future__ import print_function
+import os
+import pickle
+import shutil
+import tempfile
+import threading
+import zmq
+from io import BytesIO
+from traceback import format_exc
+try: # pragma: no cover version specific
+    from lib import sshm, default_workers, RollingAbort
+except ImportError: # pragma: no cover version specific
+    from sshm.lib import sshm, default_workers, RollingAbort
+
+__all__ = ['serve', 'submit', 'shutdown', 'default_socket']
+
+# How long, in seconds, an idle master connection is kept open.
+default_control_persist = 300
+# How long, in seconds, a client waits for the daemon to accept its job.
+default_accept_timeout = 5
+
+# The sshm options a client may set for its job.
+JOB_OPTIONS = ('encoding', 'errors', 'exclude', 'order', 'seed', 'intersect', 'resolve',
+        'probe', 'prefetch_hostkeys', 'batch', 'canary', 'max_failure_rate', 'transport',
+        'compress', 'history')
+# Every job reports its messages to the daemon's main thread through this.
+JOBS_URL = 'inproc://jobs'
+
+
+def default_socket():
+    """
+    Get the path of the daemon's socket.  It is $SSHM_SOCKET, or a socket of
+    the current user in $XDG_RUNTIME_DIR or the temporary directory.
+
+    @rtype: str
+    """
+    if os.environ.get('SSHM_SOCKET'):
+        return os.environ['SSHM_SOCKET']
+    directory = os.environ.get('XDG_RUNTIME_DIR') or tempfile.gettempdir()
+    return os.path.join(directory, 'sshm-{}.sock'.format(os.getuid()))
+
+
+def _check_owner(path):
+    """
+    Raise an OSError if "path" exists and belongs to another user, a socket
+    created by another user could be used to run our jobs.
+    """
+    if os.path.exists(path) and os.stat(path).st_uid != os.getuid():
+        raise OSError('{} belongs to another user'.format(path))
+
+
+def _run_job(context, identity, request, slots, control_arguments):
+    """
+    Run a job's sshm call and send each of its messages, addressed to
+    "identity", to the daemon's main thread.  A message is a pickled (kind,
+    value) tuple.  The last message is ("done", None), ("abort", arguments of
+    a RollingAbort) or ("error", a traceback).
+    """
+    sender = context.socket(zmq.PUSH)
+    sender.connect(JOBS_URL)
+    def send(kind, value):
+        sender.send_multipart([identity, pickle.dumps((kind, value), 2)])
+    try:
+        stdin = BytesIO(request['stdin']) if request.get('stdin') else None
+        options = dict((key, value) for key, value in request.get('options', {}).items()
+                if key in JOB_OPTIONS)
+        # Master connections are only made by the ssh client
+        if options.get('transport', 'openssh') != 'openssh':
+            control_arguments = []
+        results = sshm(request['servers'], request['command'],
+                control_arguments + list(request.get('extra_arguments') or []), stdin,
+                request.get('disable_formatting', False),
+                request.get('workers', default_workers), slots=slots, **options)
+        for result in results:
+            send('result', result)
+        send('done', None)
+    except RollingAbort as abort:
+        send('abort', (abort.failed, abort.finished, abort.remaining))
+    except Exception:
+        send('error', format_exc())
+    sender.close()
+
+
+def serve(path=None, workers=default_workers, control_persist=default_control_persist):
+    """
+    Run jobs sent to the Unix socket "path" until a client requests a shutdown.
+    The jobs are run concurrently.
+
+    @param path: The path of the socket, defaults to default_socket().
+    @type path: str
+
+    @param workers: The maximum amount of ssh connections of all jobs
+        combined.
+    @type workers: int
+
+    @param control_persist: How long, in seconds, ssh keeps an idle master
+        connection to a server open.  Later jobs on the same server reuse it
+        instead of connecting again.  0 disables master connections.
+    @type control_persist: int
+    """
+    path = path or default_socket()
+    _check_owner(path)
+    if os.path.exists(path):
+        # Left behind by a daemon that did not stop cleanly
+        os.remove(path)
+
+    control_arguments = []
+    control_dir = None
+    if control_persist:
+        control_dir = tempfile.mkdtemp(prefix='sshm-control-')
+        control_arguments = ['-oControlMaster=auto',
+                '-oControlPath=' + os.path.join(control_dir, '%C'),
+                '-oControlPersist={}'.format(control_persist)]
+
+    context = zmq.Context()
+    # Only this user may send jobs
+    umask = os.umask(0o177)
+    try:
+        clients = context.socket(zmq.ROUTER)
+        clients.bind('ipc://' + path)
+    finally:
+        os.umask(umask)
+    jobs = context.socket(zmq.PULL)
+    jobs.bind(JOBS_URL)
+
+    poller = zmq.Poller()
+    poller.register(clients, zmq.POLLIN)
+    poller.register(jobs, zmq.POLLIN)
+
+    slots = threading.BoundedSemaphore(workers)
+    threads = []
+    try:
+        while True:
+            socks = dict(poller.poll())
+            if socks.get(jobs) == zmq.POLLIN:
+                # Forward a job's message to its client
+                clients.send_multipart(jobs.recv_multipart())
+            if socks.get(clients) == zmq.POLLIN:
+                identity, request = clients.recv_multipart()
+                request = pickle.loads(request)
+                if request.get('shutdown'):
+                    clients.send_multipart([identity, pickle.dumps(('done', None), 2)])
+                    break
+                clients.send_multipart([identity, pickle.dumps(('accepted', None), 2)])
+                thread = threading.Thread(target=_run_job, args=(context, identity,
+                    request, slots, control_arguments))
+                thread.daemon = True
+                thread.start()
+                threads = [i for i in threads if i.is_alive()] + [thread]
+    finally:
+        # Running jobs are abandoned
+        clients.close(linger=1000)
+        jobs.close(linger=0)
+        if not any(i.is_alive() for i in threads):
+            context.term()
+        if os.path.exists(path):
+            os.remove(path)
+        if control_dir:
+            shutil.rmtree(control_dir, ignore_errors=True)
+
+
+def _request(request, path=None, timeout=default_accept_timeout):
+    """
+    Send "request" to the daemon at "path" and yield each (kind, value) message
+    it replies with.  The first reply must be received within "timeout"
+    seconds.
+    """
+    path = path or default_socket()
+    if not os.path.exists(path):
+        raise OSError('No sshm daemon is listening on {}'.format(path))
+    _check_owner(path)
+
+    context = zmq.Context()
+    daemon = context.socket(zmq.DEALER)
+    daemon.connect('ipc://' + path)
+    try:
+        daemon.send(pickle.dumps(request, 2))
+        if not daemon.poll(timeout * 1000):
+            raise OSError('The sshm daemon on {} did not reply'.format(path))
+        while True:
+            yield pickle.loads(daemon.recv())
+    finally:
+        daemon.close(linger=0)
+        context.term()
+
+
+def submit(servers, command, extra_arguments=None, stdin=None, disable_formatting_var=False,
+        workers=default_workers, path=None, **kwargs):
+    """
+    Run an sshm job on the daemon, and yield its results as they are received.
+    The arguments are the same as sshm's, except for "path".
+
+    @param path: The path of the daemon's socket, defaults to default_socket().
+    @type path: str
+
+    @raises RollingAbort: When a rolling job is stopped, like sshm.
+    @raises RuntimeError: When the job failed in the daemon.
+    """
+    if stdin:
+        # The daemon can not read our stdin, send all of it with the job
+        stdin = getattr(stdin, 'buffer', stdin).read()
+    request = {'servers':servers, 'command':command, 'extra_arguments':extra_arguments,
+            'stdin':stdin, 'disable_formatting':disable_formatting_var, 'workers':workers,
+            'options':kwargs}
+    for kind, value in _request(request, path):
+        if kind == 'result':
+            yield value
+        elif kind == 'done':
+            return
+        elif kind == 'abort':
+            raise RollingAbort(*value)
+        elif kind == 'error':
+            raise RuntimeError('The sshm daemon failed to run the job:\n' + value)
+
+
+def shutdown(path=None):
+    """
+    Stop the daemon at "path", jobs that are still running are abandoned.
+    """
+    for message in _request({'shutdown':True}, path):
+        return
+
+
+def main():
+    """
+    Run the sshm daemon using console provided arguments.
+
+    This should only be run using a console!
+    """
+    import argparse
+    parser = argparse.ArgumentParser(description='Run sshm jobs sent by "sshm --daemon".')
+    parser.add_argument('--socket', default=None,
+            help='The path of the Unix socket to listen on, defaults to $SSHM_SOCKET or {}.'.format(
+                default_socket()))
+    parser.add_argument('-w', '--workers', type=int, default=default_workers,
+            help='Limit the amount of concurrent SSH connections of all jobs combined.')
+    parser.add_argument('--control-persist', type=int, default=default_control_persist,
+            metavar='SECONDS',
+            help='Keep idle connections to servers open for SECONDS, for the next jobs.  0 disables this.')
+    parser.add_argument('--stop', action='store_true', default=False,
+            help='Stop the daemon that is listening on the socket.')
+    args = parser.parse_args()
+    if args.stop:
+        shutdown(args.socket)
+        return
+    try:
+        serve(args.socket, args.workers, args.control_persist)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,56 @@
 #! /usr/bin/env python3
+import os
+import random
+import json
+import math
 import re
+import select
+import socket
 import subprocess
+import sys
+import tempfile
 import threading
+import time
+import uuid
+import zlib
 import zmq
+from collections import OrderedDict
+from errno import EINPROGRESS, EWOULDBLOCK, ETIMEDOUT
 from itertools import product
 from traceback import format_exc
+try: # pragma: no cover version specific
+    from collections.abc import MutableMapping
+except ImportError: # pragma: no cover version specific
+    from collections import MutableMapping
+try: # pragma: no cover version specific
+    import queue
+except ImportError: # pragma: no cover version specific
+    import Queue as queue
+try: # pragma: no cover version specific
+    import ipaddress
+except ImportError: # pragma: no cover version specific
+    ipaddress = None
+try: # pragma: no cover version specific
+    from shlex import quote
+except ImportError: # pragma: no cover version specific
+    from pipes import quote
+try: # pragma: no cover version specific
+    from shutil import which
+except ImportError: # pragma: no cover version specific
+    from distutils.spawn import find_executable as which
 
-__all__ = ['sshm', 'uri_expansion']
-disable_formatting = False
+__all__ = ['sshm', 'uri_expansion', 'uri_count', 'compact_uris', 'fanout', 'gather', 'script',
+        'Result', 'Profile', 'RollingAbort']
 default_workers = 20
+default_encoding = 'utf-8'
+default_errors = 'replace'
+default_resolvers = 20
+dns_ttl = 300
+default_probes = 500
+default_probe_timeout = 3
+default_keyscan_batch = 64
+default_keyscans = 8
+default_keyscan_rate = 500
 
 
 # This is used to parse a range string
@@ -42,10 +84,116 @@ def expand_ranges(to_expand):
                 yield padding % k
 
 
+class _Numbers(object):
+    """
+    The integers of a range string (see expand_ranges) as a sequence.  Each
+    integer is only created when it is requested, so any range can be indexed
+    and tested for membership without expanding it.  An integer that is
+    specified more than once is only kept the first time.
+    """
+
+    def __init__(self, to_expand):
+        # Each segment is (first integer, amount of integers, padding, width)
+        self.segments = []
+        if to_expand == '-':
+            self.add(0, 255, 1)
+        for single, range_str in _match_ranges.findall(to_expand):
+            if single:
+                self.add(int(single), int(single), len(single))
+            if range_str:
+                i, j = range_str.split('-')
+                self.add(int(i), int(j), len(i))
+
+
+    def add(self, start, stop, width):
+        """
+        Add the integers from "start" to "stop" padded to "width", except those
+        that were already added.  Integers padded to different widths are the
+        same once they are at least as long as both widths.
+        """
+        pieces = [(start, stop),]
+        for first, count, padding, other_width in self.segments:
+            if other_width != width:
+                first = max(first, 10 ** (max(width, other_width) - 1))
+            last = first + count - 1
+            remaining = []
+            for i, j in pieces:
+                if i < first:
+                    remaining.append((i, min(j, first - 1)))
+                if j > last:
+                    remaining.append((max(i, last + 1), j))
+            pieces = remaining
+        for i, j in pieces:
+            if j >= i:
+                self.segments.append((i, j - i + 1, '%'+'0.%d' % width +'d', width))
+
+
+    def __len__(self):
+        return sum(segment[1] for segment in self.segments)
+
+
+    def __iter__(self):
+        for start, count, padding, width in self.segments:
+            for k in range(start, start+count):
+                yield padding % k
+
+
+    def __getitem__(self, index):
+        for start, count, padding, width in self.segments:
+            if index < count:
+                return padding % (start+index)
+            index -= count
+        raise IndexError(index)
+
+
+    def __contains__(self, value):
+        if not value.isdigit():
+            return False
+        for start, count, padding, width in self.segments:
+            if start <= int(value) < start+count and padding % int(value) == value:
+                return True
+        return False
+
+
+def count_ranges(to_count):
+    """
+    Count the integers expand_ranges would yield, without expanding them.
+
+        Example: "1,4,07-10" to 6
+
+    @param to_count: Count the integers in this string.
+    @type to_count: str
+    """
+    return len(_Numbers(to_count))
+
+
+def split_uri(uri):
+    """
+    Split a uri into its user and host, and its port.  The port is None when
+    the uri does not contain one.  IPv6 addresses are returned without their
+    brackets.
+
+        Example: "user@[::1]:22" to ("user@::1", "22")
+
+    @param uri: user@example.com:22
+    @type uri: str
+    """
+    if '[' in uri:
+        user_host, _, port = uri.partition(']')
+        return user_host.replace('[', ''), port[1:] or None
+    if uri.count(':') == 1:
+        user_host, port = uri.split(':')
+        return user_host, port
+    return uri, None
+
+
 def create_uri(user, target, port):
     """
-    Create a valid URI from the provided parameters.
+    Create a valid URI from the provided parameters.  An IPv6 "target" is
+    wrapped in brackets when a port is provided.
     """
+    if port and ':' in target:
+        target = '['+target+']'
     if user and port:
         return user+'@'+target+':'+port
     elif user:
@@ -56,73 +204,752 @@ def create_uri(user, target, port):
         return target
 
 
-_parse_uri = re.compile(r'(?:(\w+)@)?(?:(?:([a-zA-Z][\w.-]+)(?:\[([\d,-]+)\])?([\w.]+)?)|((?:(?:(?:\d+-\d+)|(?:\d+,\d+)|(?:\d+)|(?:-))+\.){3}(?:(?:\d+-\d+)|(?:\d+,\d+)|(?:\d+)|(?:-)))(?=,|$|:))(?::(\d+))?,?')
+# The groups found for each uri are:
+#   user, bracketed IPv6 (port allowed), IPv6, IPv4 CIDR, prefix, range,
+#   suffix, IPv4 with ranges, port
+# An IPv6 address may have a CIDR prefix length, it may only be followed by a
+# port when it is in brackets.
+_parse_uri = re.compile(r'(?:(\w+)@)?(?:\[([0-9a-fA-F:.]*:[0-9a-fA-F:.]*(?:/\d+)?)\]|((?:[0-9a-fA-F]{0,4}:){2,7}[0-9a-fA-F]{0,4}(?:/\d+)?)(?=,|$)|((?:\d+\.){3}\d+/\d+)(?=,|$|:)|(?:([a-zA-Z][\w.-]*)(?:\[([\d,-]+)\])?([\w.]+)?)|((?:(?:(?:\d+-\d+)|(?:\d+,\d+)|(?:\d+)|(?:-))+\.){3}(?:(?:\d+-\d+)|(?:\d+,\d+)|(?:\d+)|(?:-)))(?=,|$|:))(?::(\d+))?,?')
 
-def uri_expansion(input_str):
+
+class _Block(object):
+    """
+    The hosts of one uri, the product of its "digits".  A host is created from
+    one value of each digit by "join", "split" does the reverse (it returns None
+    when a host can not be one of these hosts).  The first digit is the most
+    significant, for an IPv4 address each digit is an octet.
     """
-    Expand a list of uris into invividual URLs/IPs and their respective
-    ports and usernames. Preserve any zero-padding the range may contain.
 
-    @param input_str: The uris to expand
-    @type input_str: str
+    def __init__(self, user, port, digits, join, split):
+        self.user = user
+        self.port = port
+        self.digits = digits
+        self.join = join
+        self.split = split
+        self.size = 1
+        for digit in digits:
+            self.size *= len(digit)
+
+
+    def host(self, index):
+        """
+        Get the host at "index" of the lexical order.
+        """
+        values = []
+        for digit in reversed(self.digits):
+            index, i = divmod(index, len(digit))
+            values.append(digit[i])
+        return self.join(values[::-1])
+
+
+    def hosts(self, order='lexical', seed=None):
+        """
+        Yield every host of this block in "order", see uri_expansion.
+        """
+        if order == 'random':
+            for index in _permutation(self.size, seed):
+                yield self.host(index)
+        elif len(self.digits) == 1:
+            for value in self.digits[0]:
+                yield self.join([value,])
+        elif order == 'interleave':
+            # The least significant digit changes slowest, consecutive hosts
+            # are in different subnets.
+            for values in product(*reversed(self.digits)):
+                yield self.join(values[::-1])
+        else:
+            for values in product(*self.digits):
+                yield self.join(values)
+
+
+    def __contains__(self, host):
+        values = self.split(host)
+        if values is None or len(values) != len(self.digits):
+            return False
+        return all(value in digit for value, digit in zip(values, self.digits))
+
+
+def _network_digits(first, last, bits, width):
+    """
+    Split the addresses from "first" to "last" into the (lowest, highest)
+    values of each of their digits.  An address is "bits" long and each digit
+    is "width" bits.  The product of these digits is exact for a CIDR network.
+    """
+    mask = (1 << width) - 1
+    return [((first >> shift) & mask, (last >> shift) & mask)
+            for shift in range(bits - width, -width, -width)]
+
+
+def _ipv6_block(user, port, address):
+    """
+    Create the block of an IPv6 address or network.
+    """
+    if not ipaddress: # pragma: no cover version specific
+        raise ValueError('IPv6 requires the ipaddress module')
+    try:
+        network = ipaddress.IPv6Network(u'' + address, strict=False)
+    except ValueError:
+        raise ValueError('Invalid IPv6 address "{}"'.format(address))
+    digits = [range(low, high+1) for low, high in _network_digits(
+        int(network.network_address), int(network.broadcast_address), 128, 16)]
+
+    def join(values):
+        number = 0
+        for value in values:
+            number = (number << 16) | value
+        return str(ipaddress.IPv6Address(number))
+
+    def split(host):
+        try:
+            number = int(ipaddress.IPv6Address(u'' + host))
+        except ValueError:
+            return None
+        return [(number >> shift) & 0xffff for shift in range(112, -16, -16)]
+
+    return _Block(user, port, digits, join, split)
+
+
+def _parse_blocks(input_str):
+    """
+    Parse "input_str" into a _Block for each uri it contains.
     """
     try:
         uris = _parse_uri.findall(input_str)
     except TypeError:
         raise ValueError('Unable to parse provided URIs')
 
-    yielded_something = False
-    for uri in uris:
-        user, prefix, range_str, suffix, ip_addr, port = uri
-
-        if (prefix or suffix) and range_str:
-            # Expand the URL
-            i = product([prefix,], expand_ranges(range_str), [suffix,])
-            i = [''.join(iter(j)) for j in i]
-            for k in i:
-                yielded_something = True
-                yield create_uri(user, k, port)
-        elif ip_addr:
-            if '-' in ip_addr or ',' in ip_addr:
-                # Expand any ranges in the octets
-                x = [expand_ranges(i) for i in ip_addr.split('.')]
-                # Create all products for each expanded octet
-                j = product(x[0], x[1], x[2], x[3])
-                # Join the octets back together with dots
-                l = ['.'.join(iter(k)) for k in j]
-                for i in l:
-                    yielded_something = True
-                    yield create_uri(user, i, port)
+    blocks = []
+    for user, ipv6_port, ipv6, cidr, prefix, range_str, suffix, ip_addr, port in uris:
+        if ipv6_port or ipv6:
+            blocks.append(_ipv6_block(user, port, ipv6_port or ipv6))
+        elif cidr or ip_addr:
+            if cidr:
+                address, length = cidr.split('/')
+                host_bits = 32 - int(length)
+                first = 0
+                for octet in address.split('.'):
+                    if int(octet) > 255:
+                        host_bits = -1
+                    first = (first << 8) | int(octet)
+                if host_bits < 0:
+                    raise ValueError('Invalid CIDR "{}"'.format(cidr))
+                first = first >> host_bits << host_bits
+                last = first | ((1 << host_bits) - 1)
+                octets = [_Numbers('{}-{}'.format(low, high))
+                        for low, high in _network_digits(first, last, 32, 8)]
             else:
-                # No expansion necessary for IP
-                yielded_something = True
-                yield create_uri(user, ip_addr, port)
+                # Only the values of each octet are kept
+                octets = [_Numbers(i) for i in ip_addr.split('.')]
+            blocks.append(_Block(user, port, octets, '.'.join,
+                lambda host: host.split('.')))
+        elif (prefix or suffix) and range_str:
+            # Bind this prefix and suffix to the functions of this block
+            def split(host, prefix=prefix, suffix=suffix):
+                if (len(host) > len(prefix)+len(suffix) and host.startswith(prefix)
+                        and host.endswith(suffix)):
+                    return [host[len(prefix):len(host)-len(suffix)],]
+            blocks.append(_Block(user, port, [_Numbers(range_str),],
+                lambda values, prefix=prefix, suffix=suffix: prefix+values[0]+suffix,
+                split))
         else:
             # No expansion necessary for URL
-            yielded_something = True
-            yield create_uri(user, prefix+suffix, port)
+            blocks.append(_Block(user, port, [[prefix+suffix,],],
+                lambda values: values[0], lambda host: [host,]))
+    return blocks
+
+
+def _permutation(size, seed=None):
+    """
+    Yield every integer from 0 to "size"-1 exactly once, in an order that is
+    pseudo-random but the same for every "seed".  The integers are shuffled
+    using a Feistel network instead of a list, so the memory used does not
+    depend on "size".
+    """
+    half = max(((size - 1).bit_length() + 1) // 2, 1)
+    mask = (1 << half) - 1
+    generator = random.Random(seed)
+    keys = [generator.getrandbits(64) for i in range(4)]
+    # The network permutes all integers of 2*half bits, any that are not less
+    # than "size" are skipped.  This is at most 4 times "size".
+    for number in range(1 << (half * 2)):
+        left, right = number >> half, number & mask
+        for key in keys:
+            mixed = ((right ^ key) * 0x9E3779B97F4A7C15) & 0xffffffffffffffff
+            left, right = right, left ^ ((mixed ^ (mixed >> 29)) & mask)
+        number = (left << half) | right
+        if number < size:
+            yield number
+
+
+def _block_hosts(block, order, seed, index):
+    """
+    Yield (index, block, host) for each host of "block".
+    """
+    for host in block.hosts(order, seed):
+        yield index, block, host
+
+
+def _round_robin(generators):
+    """
+    Yield the next item of each generator in turn, until all are exhausted.
+    """
+    generators = list(generators)
+    while generators:
+        for generator in list(generators):
+            try:
+                yield next(generator)
+            except StopIteration:
+                generators.remove(generator)
+
+
+class _Matcher(object):
+    """
+    Test whether a host is one of the hosts of some blocks, without expanding
+    them.  Blocks of a single host are kept in a dict, so any amount of them is
+    cheap to test.  When "keyed" is True, a host only matches blocks with the
+    same user and port.
+    """
+
+    def __init__(self, blocks, keyed=True):
+        self.keyed = keyed
+        # (key, host) to the index of the first block of that host
+        self.hosts = {}
+        # (index, key, block) of each block with more than one host
+        self.blocks = []
+        for index, block in enumerate(blocks):
+            if block.size == 1:
+                self.hosts.setdefault((self.key(block), block.host(0)), index)
+            elif block.size:
+                self.blocks.append((index, self.key(block), block))
+
+
+    def key(self, block):
+        return (block.user, block.port) if self.keyed else None
+
+
+    def match(self, block, host, before=None):
+        """
+        Check if "host" of "block" is in one of the blocks, only the blocks
+        before the index "before" are checked when it is provided.
+        """
+        key = self.key(block)
+        index = self.hosts.get((key, host))
+        if index is not None and (before is None or index < before):
+            return True
+        for index, other_key, other in self.blocks:
+            if before is not None and index >= before:
+                break
+            if other_key == key and host in other:
+                return True
+        return False
+
+
+def uri_expansion(input_str, exclude=None, order='lexical', seed=None, intersect=None):
+    """
+    Expand a list of uris into invividual URLs/IPs and their respective
+    ports and usernames. Preserve any zero-padding the range may contain.
+
+    This is a generator, each uri is created only when it is requested.  The
+    memory used does not depend on the amount of uris specified.
+
+    Besides ranges, IPv4 and IPv6 networks can be specified using CIDR
+    notation.  An IPv6 address must be in brackets to specify its port.
+
+        Example: "10.20.0.0/30,root@[2001:db8::/127]:22"
+
+    Each uri is only yielded once, even when it is specified more than once.
+    Duplicates are found by testing the ranges that were already specified,
+    they are never stored.
+
+    @param input_str: The uris to expand, a list of them is their union.
+    @type input_str: str
+
+    @param exclude: Skip any host matched by these uris, their users and ports
+        are ignored.
+        Example: "10.20.0.0/24,10.20.1.1-5"
+    @type exclude: str
+
+    @param intersect: Only yield the hosts also matched by these uris, their
+        users and ports are ignored.
+    @type intersect: str
+
+    @param order: The order of the hosts of each uri.
+        'lexical': The order they are specified in.
+        'interleave': Consecutive hosts are in different subnets, for IPs the
+            last octet changes slowest.  The uris of "input_str" are also
+            interleaved, one host is taken from each in turn.
+        'random': A pseudo-random permutation, the same for every "seed".
+    @type order: str
+
+    @param seed: The seed of the random order, see random.seed.
+    @type seed: int
+    """
+    if order not in ('lexical', 'interleave', 'random'):
+        raise ValueError('Unknown order "{}"'.format(order))
+    if not isinstance(input_str, (list, tuple)):
+        input_str = [input_str,]
+    blocks = []
+    for spec in input_str:
+        spec_blocks = _parse_blocks(spec)
+        # Some targets must be specified
+        if not any(block.size for block in spec_blocks):
+            raise ValueError('No URIs found in "{}"'.format(spec))
+        blocks.extend(spec_blocks)
+    specified = _Matcher(blocks)
+    excluded = _Matcher(_parse_blocks(exclude), keyed=False) if exclude else None
+    intersected = _Matcher(_parse_blocks(intersect), keyed=False) if intersect else None
+    if seed is None and order == 'random':
+        seed = random.getrandbits(64)
+
+    # Each block has its own permutation
+    generators = [_block_hosts(block, order, '{}-{}'.format(seed, i), i)
+            for i, block in enumerate(blocks)]
+    if order == 'interleave':
+        generators = [_round_robin(generators),]
+    for generator in generators:
+        for index, block, host in generator:
+            if specified.match(block, host, index):
+                # This host was already specified by an earlier block
+                continue
+            if excluded and excluded.match(block, host):
+                continue
+            if intersected and not intersected.match(block, host):
+                continue
+            yield create_uri(block.user, host, block.port)
+
+
+# The last number of a host, and what surrounds it
+_last_number = re.compile(r'^(.*?)(\d+)(\D*)$')
+
+def compact_uris(uris):
+    """
+    Describe "uris" using as few ranges as possible.  Uris that only differ by
+    consecutive numbers are combined into one range, the ranges are yielded in
+    the order of "uris".  uri_expansion expands these ranges back into "uris".
+
+        Example: ["host1.com", "host2.com", "host3.com", "10.0.0.7"] to
+            ["host[1-3].com", "10.0.0.7"]
+
+    @param uris: The uris to describe
+    @type uris: iterable
+    """
+    # The current range is (user, prefix, suffix, port), first, last
+    current = None
+    for uri in uris:
+        user_host, port = split_uri(uri)
+        user, _, host = user_host.rpartition('@')
+        match = _last_number.match(host) if ':' not in host else None
+        if match:
+            prefix, number, suffix = match.groups()
+            key = (user, prefix, suffix, port)
+            if (current and current[0] == key and int(number) == int(current[2])+1
+                    and '%0*d' % (len(current[1]), int(number)) == number):
+                current[2] = number
+                continue
+        if current:
+            yield _compact_range(*current)
+        current = [key, number, number] if match else None
+        if not match:
+            yield uri
+    if current:
+        yield _compact_range(*current)
+
+
+def _compact_range(key, first, last):
+    """
+    Create the uri of a range found by compact_uris.
+    """
+    user, prefix, suffix, port = key
+    if first == last:
+        host = prefix+first+suffix
+    elif re.match(r'^(\d+\.){3}$', prefix) and not suffix:
+        host = prefix+first+'-'+last
+    else:
+        host = prefix+'['+first+'-'+last+']'+suffix
+    return create_uri(user, host, port)
+
+
+def uri_count(input_str):
+    """
+    Count the uris that uri_expansion would yield, without expanding them.
+    Duplicate and excluded uris are not subtracted.
+
+    @param input_str: The uris to count
+    @type input_str: str
+    """
+    return sum(block.size for block in _parse_blocks(input_str))
 
-    # Some targets must be specified
-    if not yielded_something:
-        raise ValueError('No URIs found in "{}"'.format(input_str))
+
+# The absolute path of each program that has been started, by (name, PATH).
+_executables = {}
+# Since Python 3.4 file descriptors are not inherited by default, so the
+# descriptors of a child do not need to be closed.
+_close_fds = not hasattr(os, 'set_inheritable')
+
+def _executable(name):
+    """
+    Get the absolute path of the program "name", it is only searched for once
+    for each PATH.  None is returned when it can not be found, that is not
+    remembered, so a program that is installed later is found.
+    """
+    key = (name, os.environ.get('PATH'))
+    path = _executables.get(key)
+    if path is None:
+        path = which(name)
+        if path:
+            _executables[key] = path
+    return path
 
 
 def popen(cmd, stdin, stdout, stderr): # pragma: no cover
     """
     Separating Popen call from ssh command for testing.
+
+    Given an absolute path, and without closing every descriptor, subprocess
+    starts the child using posix_spawn (or vfork) instead of forking this
+    process.  The cost of a fork grows with the memory of this process.
     """
     proc = subprocess.Popen(cmd,
+            executable=_executable(cmd[0]),
+            close_fds=_close_fds,
             stdin=stdin,
             stdout=stdout,
             stderr=stderr,)
     return proc
 
 
-# ZMQ urls used to connect sshm and ssh
+# ZMQ urls used to connect sshm and ssh.  An inproc url only exists within its
+# context, each sshm call creates its own context so concurrent calls never
+# share these sockets.
 SINK_URL = 'inproc://sink'
 STDIN_URL = 'inproc://stdin'
 
-def ssh(thread_num, context, uri, command, extra_arguments, if_stdin=False):
+def escape_formatting(to_escape):
+    """
+    Escape any braces in "to_escape" so it is unchanged by command formatting.
+    """
+    return to_escape.replace('{', '{{').replace('}', '}}')
+
+
+def _open_output(path):
+    """
+    Open "path" for binary writing, create any of its missing directories.
+    """
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError: # pragma: no cover another thread created it
+            if not os.path.isdir(directory):
+                raise
+    return open(path, 'wb')
+
+
+def _decode(output, encoding, errors):
+    """
+    Decode "output" using "encoding", unless it is None or "encoding" is None.
+    """
+    if encoding and 'decode' in dir(output): # pragma: no cover version specific
+        return output.decode(encoding, errors)
+    return output
+
+
+def _openssh(user_host, port, command, extra_arguments, address=None, host_key_alias=None,
+        known_hosts=None, stdout=subprocess.PIPE, stderr=subprocess.PIPE):
+    """
+    Start an OpenSSH client that runs "command" on "user_host".  This is the
+    default transport.
+
+    Every transport is called with these arguments, and returns the command
+    that describes the connection, and a process.  The process has the
+    methods of a subprocess.Popen that ssh uses.
+
+    @param user_host: user@example.com
+    @type user_host: str
+
+    @param port: The port, or None for the default port.
+    @type port: str
+
+    @param command: Execute this command on "user_host".
+    @type command: str
+
+    @param extra_arguments: Arguments of the ssh client.
+    @type extra_arguments: list
+
+    @param address: Connect to this address instead of resolving the host.
+    @type address: str
+
+    @param host_key_alias: Check the host key of "address" using this name.
+    @type host_key_alias: str
+
+    @param known_hosts: Check the host key using these known_hosts files
+        instead of the user's files.
+    @type known_hosts: list
+
+    @param stdout: A file the stdout is written to, or subprocess.PIPE.
+    @param stderr: A file the stderr is written to, or subprocess.PIPE.
+
+    @returns: (cmd, proc)
+    @rtype: tuple
+
+    @raises: An exception with a "cmd" attribute when the process could not
+        be started.
+    """
+    cmd = ['ssh',]
+    # The first value of an option is used, these files include any that are
+    # in the extra arguments
+    if known_hosts:
+        cmd.append('-oUserKnownHostsFile=' + ' '.join(known_hosts))
+    # Add extra arguments after ssh, but before the uri and command
+    cmd.extend(extra_arguments or [])
+    if address:
+        cmd.extend(['-oHostName='+address, '-oHostKeyAlias='+host_key_alias])
+    # Only change the port at the user's request.  Otherwise, use SSH's
+    # default port.
+    if port:
+        cmd.extend([user_host, '-p', port, command])
+    else:
+        cmd.extend([user_host, command])
+    try:
+        return cmd, popen(cmd, stdin=subprocess.PIPE, stdout=stdout, stderr=stderr)
+    except OSError as error:
+        # The failed command is reported in the result
+        error.cmd = cmd
+        raise
+
+
+# The transports that ssh may use, by name.  asyncssh is only imported when it
+# is used.
+transports = ('openssh', 'asyncssh')
+
+def _transport(name):
+    """
+    Get the transport named "name", see _openssh.
+    """
+    if name == 'openssh':
+        return _openssh
+    elif name == 'asyncssh':
+        try: # pragma: no cover version specific
+            from asyncssh_transport import start
+        except ImportError: # pragma: no cover version specific
+            from sshm.asyncssh_transport import start
+        return start
+    raise ValueError('Unknown transport {}, use one of: {}'.format(name, ', '.join(transports)))
+
+
+# This script runs "$1" with its stdout and stderr compressed by gzip.  Each
+# compressed output starts after a line containing the marker, so it can be
+# told apart from anything ssh itself writes to stderr.  Without gzip, "$1" is
+# run as it is.
+_COMPRESSOR = r'''m={marker}
+command -v gzip > /dev/null 2>&1 || { eval "$1"; exit; }
+printf '%s\n' "$m"; printf '%s\n' "$m" >&2
+exec 3>&1
+r=$( { { { (eval "$1") 3>&- 4>&-; echo $? >&4; } | gzip >&3; } 2>&1 | gzip >&2; } 4>&1 )
+exit $r
+'''
+
+def _gunzip_after(output, marker):
+    """
+    Decompress the gzip stream that follows the line "marker" in "output".
+    Anything before the marker or after the stream is kept as it is, output
+    without the marker was not compressed.
+    """
+    before, found, stream = output.partition(marker + b'\n')
+    if not found:
+        return output
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    # Decompressed in chunks, the compressed output is never copied
+    chunks = [before]
+    view = memoryview(stream)
+    for start in range(0, len(stream), CHUNK_SIZE):
+        chunks.append(decompressor.decompress(view[start:start+CHUNK_SIZE]))
+    chunks.append(decompressor.flush())
+    chunks.append(decompressor.unused_data)
+    return b''.join(chunks)
+
+
+if '__slots__' in vars(MutableMapping): # pragma: no cover version specific
+    _MutableMapping = MutableMapping
+else: # pragma: no cover version specific
+    # The Python 2 abstract base classes do not have __slots__, a subclass of
+    # one has a __dict__.  Their methods are copied instead.
+    _MutableMapping = type('_MutableMapping', (object,), dict(
+        [(name, [vars(i)[name] for i in MutableMapping.__mro__ if name in vars(i)][0])
+            for name in ('__contains__', '__eq__', '__ne__', '__hash__', 'get', 'keys',
+                'items', 'values', 'iterkeys', 'itervalues', 'iteritems', 'clear', 'pop',
+                'popitem', 'setdefault', 'update', '_MutableMapping__marker')],
+        __slots__=()))
+
+
+class Result(_MutableMapping):
+    """
+    The result of ssh, it is used like a dict but uses less memory.  The
+    common keys are slots instead of dictionary entries, and the outputs are
+    kept as they were received, they are decoded when they are read.  The part
+    of the 'cmd' before the server is a prefix that results can share, see
+    share_cmd.
+
+    A Result is a MutableMapping, not a dict: isinstance(result, dict) is
+    False, and json.dumps can not serialize it.  Use to_dict for those.
+    """
+
+    _keys = ('thread_num', 'uri', 'return_code', 'stdout', 'stderr', 'traceback', 'cmd',
+            'address', 'stdout_path', 'stdout_size', 'stderr_path', 'stderr_size')
+    __slots__ = tuple('_' + key for key in _keys) + (
+            '_encoding', '_errors', '_cmd_prefix', '_extra')
+    # The usual values of the slots that are always set, they are not pickled
+    _pickle_defaults = {'_encoding':'utf-8', '_errors':'replace', '_cmd_prefix':(),
+            '_extra':None}
+
+    def __init__(self, *args, **kwargs):
+        self._encoding = self._errors = None
+        self._cmd_prefix = ()
+        self._extra = None
+        self.update(*args, **kwargs)
+
+
+    def __getitem__(self, key):
+        if key in self._keys:
+            try:
+                value = getattr(self, '_' + key)
+            except AttributeError:
+                raise KeyError(key)
+            if key in ('stdout', 'stderr'):
+                return _decode(value, self._encoding, self._errors)
+            if key == 'cmd' and value is not None:
+                return list(self._cmd_prefix) + value
+            return value
+        if self._extra and key in self._extra:
+            return self._extra[key]
+        raise KeyError(key)
+
+
+    def __setitem__(self, key, value):
+        if key in self._keys:
+            if key == 'cmd':
+                self._cmd_prefix = ()
+            setattr(self, '_' + key, value)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+
+    def __delitem__(self, key):
+        if key in self._keys:
+            try:
+                delattr(self, '_' + key)
+            except AttributeError:
+                raise KeyError(key)
+        elif self._extra and key in self._extra:
+            del self._extra[key]
+        else:
+            raise KeyError(key)
+
+
+    def __iter__(self):
+        for key in self._keys:
+            if hasattr(self, '_' + key):
+                yield key
+        for key in self._extra or ():
+            yield key
+
+
+    def __len__(self):
+        return sum(1 for key in self)
+
+
+    def __repr__(self):
+        return 'Result({!r})'.format(dict(self))
+
+
+    def __reduce_ex__(self, protocol):
+        # The values of the slots that are set, and a bit for each of them,
+        # are smaller than their names
+        mask = 0
+        values = []
+        for i, name in enumerate(self.__slots__):
+            if not hasattr(self, name):
+                continue
+            value = getattr(self, name)
+            if name in self._pickle_defaults and value == self._pickle_defaults[name]:
+                continue
+            mask |= 1 << i
+            if protocol < 3 and bytes is not str and isinstance(value, bytes):
+                # Before protocol 3, bytes are pickled as a call, text is smaller
+                mask |= 1 << (len(self.__slots__) + i)
+                value = value.decode('latin-1')
+            values.append(value)
+        return _unpickle_result, (mask, tuple(values))
+
+
+    def to_dict(self):
+        """
+        Get a dict of the keys and values, with the outputs decoded.
+
+        @rtype: dict
+        """
+        return dict(self)
+
+
+    def set_output(self, name, output, encoding, errors):
+        """
+        Keep the output "name" (stdout or stderr) as it was received, it is
+        decoded using "encoding" and "errors" when it is read.
+        """
+        setattr(self, '_' + name, output)
+        self._encoding = encoding
+        self._errors = errors
+
+
+    def set_cmd(self, cmd, host):
+        """
+        Set the 'cmd', the part before "host" is kept as the prefix.
+        """
+        if cmd and host in cmd:
+            index = cmd.index(host)
+            self._cmd_prefix = tuple(cmd[:index])
+            self._cmd = cmd[index:]
+        else:
+            self['cmd'] = cmd
+
+
+    def share_cmd(self, prefixes):
+        """
+        Use the equal prefix in "prefixes" instead of this result's own copy,
+        add it when there is none.
+
+        @type prefixes: dict
+        """
+        self._cmd_prefix = prefixes.setdefault(self._cmd_prefix, self._cmd_prefix)
+
+
+if _MutableMapping is not MutableMapping: # pragma: no cover version specific
+    MutableMapping.register(Result)
+
+
+def _unpickle_result(mask, values):
+    """
+    Create the Result pickled by Result.__reduce_ex__.
+    """
+    result = Result()
+    values = iter(values)
+    for i, name in enumerate(Result.__slots__):
+        if mask & 1 << i:
+            value = next(values)
+            if mask & 1 << (len(Result.__slots__) + i):
+                value = value.encode('latin-1')
+            setattr(result, name, value)
+        elif name in Result._pickle_defaults:
+            setattr(result, name, Result._pickle_defaults[name])
+    return result
+
+
+def ssh(thread_num, context, uri, command, extra_arguments, if_stdin=False, stdout_path=None,
+        encoding=default_encoding, errors=default_errors, stderr_path=None, address=None,
+        known_hosts=None, disable_formatting=False, transport='openssh', compress=False,
+        profile=None):
     """
     Create an SSH connection to 'uri'.  Execute 'command' and
     pass any stdin to this ssh session.  Return the results via ZMQ (SINK_URL).
@@ -143,13 +970,54 @@ def ssh(thread_num, context, uri, command, extra_arguments, if_stdin=False):
         write it to proc's stdin.
     @type if_stdin: bool
 
+    @param stdout_path: Write the stdout of the ssh process directly to this
+        file instead of returning it.  This is formatted like the command, but
+        even when formatting is disabled.  The result will contain the
+        'stdout_path' and 'stdout_size' instead of 'stdout'.
+    @type stdout_path: str
+
+    @param stderr_path: The same as stdout_path, but for stderr.
+    @type stderr_path: str
+
+    @param encoding: Decode stdout and stderr using this encoding.  If this is
+        None, stdout and stderr are returned as bytes.
+    @type encoding: str
+
+    @param errors: How decoding errors are handled, see bytes.decode.
+    @type errors: str
+
+    @param address: Connect to this address instead of resolving the host of
+        'uri'.  The host key is still checked using the host's name.
+    @type address: str
+
+    @param known_hosts: Also check the host key using this known_hosts file,
+        after the files of UserKnownHostsFile in ssh_config or
+        'extra_arguments'.
+    @type known_hosts: str
+
+    @param disable_formatting: Run the command without formatting it.
+    @type disable_formatting: bool
+
+    @param transport: The name of the transport that connects to 'uri', see
+        transports.
+    @type transport: str
+
+    @param compress: Compress the stdout and stderr of the command on the
+        server using gzip, decompress them when they are received.  The output
+        is sent as it is when the server does not have gzip.  This can not be
+        used with "stdout_path" or "stderr_path".
+    @type compress: bool
+
+    @param profile: Add the time spent starting the command, sending it stdin,
+        waiting for it and sending its result to the 'worker' phases of this
+        profile.
+    @type profile: Profile
+
     @returns: None
     """
+    phase = profile.phase if profile else _not_profiled
     # This is the basic result that we send back
-    result = {
-            'thread_num':thread_num,
-            'uri':uri,
-            }
+    result = Result(thread_num=thread_num, uri=uri)
 
     # Send the results to this sink
     sink = context.socket(zmq.PUSH)
@@ -158,90 +1026,828 @@ def ssh(thread_num, context, uri, command, extra_arguments, if_stdin=False):
     stdin_sock = context.socket(zmq.REQ)
     stdin_sock.connect(STDIN_URL)
 
+    user_host, port = split_uri(uri)
     # Create the dictionary that can be used in command formatting
     formatting_dict = {
             'uri':uri,
-            'fqdn':uri.split(':')[0],
+            'fqdn':user_host,
             'subdomain':uri.split('.')[0],
             'num':thread_num,
             }
 
+    output_files = {}
+    cmd = None
     try:
-        cmd = ['ssh',]
-        # Add extra arguments after ssh, but before the uri and command
-        cmd.extend(extra_arguments or [])
+        if address:
+            result['address'] = address
         # Format the command string as requested by the user
         if not disable_formatting:
             command = command.format(**formatting_dict)
-        # Only change the port at the user's request.  Otherwise, use SSH's
-        # default port.
-        try:
-            user_url, port = uri.split(':')
-            cmd.extend([user_url, '-p', port, command])
-        except ValueError:
-            # No port provided
-            cmd.extend([uri, command])
+        if compress:
+            marker = 'sshm-gzip-' + uuid.uuid4().hex
+            command = 'sh -c {} sshm {}'.format(
+                    quote(_COMPRESSOR.replace('{marker}', marker)), quote(command))
+
+        # The ssh process writes directly to the output files, that output
+        # never passes through this process.
+        for name, path in (('stdout', stdout_path), ('stderr', stderr_path)):
+            if path:
+                path = path.format(**formatting_dict)
+                output_files[name] = (path, _open_output(path))
+
+        options = _ssh_config(uri, extra_arguments) if address or known_hosts else None
+        if known_hosts:
+            # Checked after the files ssh would check
+            known_hosts = _known_hosts_files(options)[0] + [known_hosts]
 
         # Run the command, return its results
-        proc = popen(cmd,
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,)
+        with phase('worker', 'start'):
+            cmd, proc = _transport(transport)(user_host, port, command, extra_arguments,
+                    address=address, host_key_alias=_host_key_alias(uri, options),
+                    known_hosts=known_hosts,
+                    stdout=output_files.get('stdout', (None, subprocess.PIPE))[1],
+                    stderr=output_files.get('stderr', (None, subprocess.PIPE))[1])
 
         # Write stdin to the PIPE until it is empty
-        while if_stdin:
-            stdin_sock.send_pyobj(thread_num)
-            chunk = stdin_sock.recv_pyobj()
-            # If the chunk is None, the stdin is empty
-            if chunk == None:
-                break
-            # Continually attempt to send the chunk while the process is alive
-            while proc.poll() == None:
-                try:
-                    proc.stdin.write(chunk)
-                    # successfully sent the chunk, get the next one
+        with phase('worker', 'stdin'):
+            while if_stdin:
+                stdin_sock.send_pyobj(thread_num)
+                chunk = stdin_sock.recv_pyobj()
+                # If the chunk is None, the stdin is empty
+                if chunk == None:
                     break
-                except IOError: # pragma: no cover not a predictable error
-                    # Temporary error, attempt to send the chunk again
-                    pass
+                # Continually attempt to send the chunk while the process is alive
+                while proc.poll() == None:
+                    try:
+                        proc.stdin.write(chunk)
+                        # successfully sent the chunk, get the next one
+                        break
+                    except IOError: # pragma: no cover not a predictable error
+                        # Temporary error, attempt to send the chunk again
+                        pass
 
         # Get the output
-        stdout, stderr = proc.communicate()
+        with phase('worker', 'wait'):
+            stdout, stderr = proc.communicate()
         # Close stdin now that the process has ended
         proc.stdin.close()
-        # Convert output into a usable format
-        if 'decode' in dir(stdout): # pragma: no cover version specific
-            stdout = stdout.decode()
-        if 'decode' in dir(stderr): # pragma: no cover version specific
-            stderr = stderr.decode()
-
-        result.update({'return_code':proc.returncode,
-                    'stdout':stdout,
-                    'stderr':stderr,
-                    }
-                )
+        if compress:
+            with phase('worker', 'decompress'):
+                stdout = _gunzip_after(stdout, marker.encode())
+                stderr = _gunzip_after(stderr, marker.encode())
+        result['return_code'] = proc.returncode
+        # Convert output into a usable format, report the size of any output
+        # written to a file instead.
+        for name, output in (('stdout', stdout), ('stderr', stderr)):
+            if name in output_files:
+                path, output_file = output_files[name]
+                output_file.close()
+                result[name+'_path'] = path
+                result[name+'_size'] = os.path.getsize(path)
+            elif errors == 'strict':
+                # A decoding error is reported now, instead of when it is read
+                result[name] = _decode(output, encoding, errors)
+            else:
+                result.set_output(name, output, encoding, errors)
     except:
-        # Oops, get the traceback
+        # Oops, get the traceback, and the command that failed to start
+        cmd = cmd or getattr(sys.exc_info()[1], 'cmd', None)
         result.update({
                 'traceback':format_exc(),
                 }
             )
+    finally:
+        for path, output_file in output_files.values():
+            output_file.close()
 
     # Add the cmd to the result
-    result.update({'cmd':cmd,})
+    result.set_cmd(cmd, user_host)
 
     # Send the results!
-    sink.send_pyobj(result)
+    with phase('worker', 'send'):
+        sink.send_pyobj(result)
 
     sink.close()
+    stdin_sock.close()
+
+
+def _host_key_alias(uri, options=None):
+    """
+    Get the name the host key of "uri" is stored as in known_hosts.  With its
+    ssh "options" (see _ssh_config), its HostKeyAlias or HostName is used.
+    """
+    options = options or {}
+    if options.get('hostkeyalias'):
+        return options['hostkeyalias']
+    user_host, port = split_uri(uri)
+    host = options.get('hostname') or user_host.rpartition('@')[2]
+    port = options.get('port', port)
+    if port and port != '22':
+        return '[{}]:{}'.format(host, port)
+    return host
+
+
+# Each resolved host is cached as: host: (expiry time, address)
+_dns_cache = {}
+_dns_lock = threading.Lock()
+
+def resolve_host(host, clock=time.time):
+    """
+    Resolve "host" to an address, using a cache of recent lookups.  Returns
+    None if the host does not exist.  Any other lookup error is raised, it may
+    be temporary.  Every lookup, including a host that does not exist, is
+    cached for "dns_ttl" seconds.
+
+    @param host: The name or address to resolve.
+    @type host: str
+    """
+    with _dns_lock:
+        cached = _dns_cache.get(host)
+    if cached and cached[0] > clock():
+        return cached[1]
+    try:
+        address = socket.getaddrinfo(host, None, 0, socket.SOCK_STREAM)[0][4][0]
+    except socket.gaierror as error:
+        if error.args[0] not in (socket.EAI_NONAME, getattr(socket, 'EAI_NODATA', None)):
+            raise
+        address = None
+    with _dns_lock:
+        _dns_cache[host] = (clock() + dns_ttl, address)
+    return address
+
+
+# The options of each uri reported by "ssh -G", cached as:
+#   (uri, extra arguments): (expiry time, options)
+_ssh_configs = {}
+_ssh_config_lock = threading.Lock()
+
+def _ssh_config(uri, extra_arguments=None, clock=time.time):
+    """
+    Get the options ssh would use to connect to "uri" with "extra_arguments",
+    as reported by "ssh -G".  The names are lowercase, and each value is a
+    string.  It is empty when ssh can not report them.  The options are
+    cached for "dns_ttl" seconds.
+
+    @param uri: user@example.com:22
+    @type uri: str
+
+    @param extra_arguments: Arguments of the ssh client.
+    @type extra_arguments: list
+    """
+    key = (uri, tuple(extra_arguments or ()))
+    with _ssh_config_lock:
+        cached = _ssh_configs.get(key)
+    if cached and cached[0] > clock():
+        return cached[1]
+    user_host, port = split_uri(uri)
+    cmd = ['ssh',] + list(extra_arguments or []) + ['-G', user_host] + (['-p', port] if port else [])
+    options = {}
+    try:
+        with open(os.devnull, 'r+b') as devnull:
+            proc = subprocess.Popen(cmd, executable=_executable('ssh'), close_fds=_close_fds,
+                    stdin=devnull, stdout=subprocess.PIPE, stderr=devnull)
+            output = proc.communicate()[0]
+    except (OSError, TypeError):
+        # ssh is not installed
+        output = b''
+        proc = None
+    if proc and proc.returncode == 0:
+        for line in output.decode('utf-8', 'replace').splitlines():
+            name, _, value = line.partition(' ')
+            options[name.lower()] = value
+    with _ssh_config_lock:
+        _ssh_configs[key] = (clock() + dns_ttl, options)
+    return options
+
+
+def _proxied(options):
+    """
+    Is the server of these ssh options connected to through another host?
+    Only that host can resolve or reach it.
+    """
+    return any(options.get(name, 'none') != 'none' for name in ('proxyjump', 'proxycommand'))
+
+
+def _resolve_worker(uris, lock, results, stop, extra_arguments, lookup=True):
+    """
+    Resolve uris until "uris" is exhausted, put each (uri, address, error)
+    into "results".  None is put into "results" when finished.  If "uris"
+    raises, (None, None, error) is put instead.  Return once "stop" is set.
+
+    The host is resolved as ssh would, using its HostName in ssh_config.  The
+    address of a server behind a ProxyJump or ProxyCommand is left to ssh,
+    it is put as (uri, None, None).  Without "lookup", only the options are
+    read.
+    """
+    def put(item):
+        while not stop.is_set():
+            try:
+                results.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    while not stop.is_set():
+        with lock:
+            try:
+                uri = next(uris, None)
+            except Exception as error:
+                uri = None
+                put((None, None, error))
+        if uri is None:
+            put(None)
+            return
+        options = _ssh_config(uri, extra_arguments)
+        if _proxied(options) or not lookup:
+            put((uri, None, None))
+            continue
+        host = options.get('hostname') or split_uri(uri)[0].rpartition('@')[2]
+        try:
+            put((uri, resolve_host(host), None))
+        except Exception as error:
+            put((uri, None, error))
+
+
+def _resolve_targets(uris, resolvers=default_resolvers, encoding=default_encoding,
+        extra_arguments=None, lookup=True):
+    """
+    Resolve "uris" concurrently using at most "resolvers" threads.  Yield
+    (uri, address, result) as each lookup finishes, "result" is a result that
+    should be reported instead of connecting to "uri".  Only a few uris are
+    read ahead of what has been yielded.  The threads stop when this
+    generator is closed.
+
+    Each host is resolved as ssh would, using its options from ssh_config and
+    "extra_arguments", see _ssh_config.  A server behind a ProxyJump or
+    ProxyCommand is left to ssh to resolve.
+
+    A uri whose host does not exist is reported with ssh's return code.  The
+    first uri of an address is connected to, any later uri with the same user,
+    address and port is reported with the uri it is an alias of.  A uri that
+    could not be resolved for any other reason is left to ssh to resolve.
+
+    When "lookup" is False, the hosts are not resolved.  Only the ssh options
+    of each uri are read concurrently, for _probe_targets and
+    _prefetch_host_keys.
+    """
+    lock = threading.Lock()
+    stop = threading.Event()
+    results = queue.Queue(resolvers)
+    for i in range(resolvers):
+        thread = threading.Thread(target=_resolve_worker,
+                args=(uris, lock, results, stop, extra_arguments, lookup))
+        thread.daemon = True
+        thread.start()
+
+    # (user, address, port) to the first uri of that address
+    connected = {}
+    running = resolvers
+    try:
+        while running:
+            resolved = results.get()
+            if resolved is None:
+                running -= 1
+                continue
+            uri, address, error = resolved
+            if uri is None:
+                # The uris could not be expanded
+                raise error
+            options = _ssh_config(uri, extra_arguments)
+            user_host, port = split_uri(uri)
+            user, _, host = user_host.rpartition('@')
+            user = options.get('user', user)
+            port = options.get('port', port)
+            if error or not lookup or (address is None and _proxied(options)):
+                yield uri, None, None
+            elif address is None:
+                message = 'ssh: Could not resolve hostname {}: Name or service not known\n'.format(
+                        options.get('hostname', host))
+                yield uri, None, {'uri':uri, 'return_code':255, 'unresolved':True,
+                        'stderr':message if encoding else message.encode()}
+            elif (user, address, port) in connected:
+                yield uri, address, {'uri':uri, 'address':address,
+                        'alias_of':connected[(user, address, port)]}
+            else:
+                connected[(user, address, port)] = uri
+                yield uri, address, None
+    finally:
+        stop.set()
+
+
+def _unreachable(uri, host, port, reason, encoding):
+    """
+    Create the result of a uri that was not connected to, it is reported like
+    ssh reports it.
+    """
+    message = 'ssh: connect to host {} port {}: {}\n'.format(host, port, reason)
+    return {'uri':uri, 'return_code':255, 'unreachable':True,
+            'stderr':message if encoding else message.encode()}
+
+
+def _probe_targets(targets, timeout=default_probe_timeout, probes=default_probes,
+        encoding=default_encoding, clock=time.time, extra_arguments=None):
+    """
+    Check that the port of each target accepts connections before it is
+    connected to.  Up to "probes" non-blocking connects are made at once, each
+    is given "timeout" seconds.  The targets are (uri, address, result) as
+    yielded by _resolve_targets, they are yielded in the same form as their
+    connects finish.  A target that does not respond is yielded with a result
+    instead.
+
+    A uri is probed at the host and port ssh would connect to, using its
+    options from ssh_config and "extra_arguments" (see _ssh_config).  A
+    server behind a ProxyJump or ProxyCommand is not probed, it is yielded
+    as it is.  A host without an address is resolved first, use
+    _resolve_targets to resolve them, and to read their options,
+    concurrently.
+    """
+    poller = select.poll()
+    # The connects in progress, the oldest is always first
+    pending = OrderedDict()
+    targets = iter(targets)
+    target = next(targets, None)
+    while target or pending:
+        while target and len(pending) < probes:
+            uri, address, result = target
+            target = next(targets, None)
+            if result:
+                yield uri, address, result
+                continue
+            options = _ssh_config(uri, extra_arguments)
+            if _proxied(options):
+                yield uri, address, None
+                continue
+            user_host, port = split_uri(uri)
+            host = options.get('hostname') or user_host.rpartition('@')[2]
+            port = int(options.get('port') or port or 22)
+            try:
+                connect_to = address or resolve_host(host)
+            except socket.gaierror:
+                # Leave the temporary failure to ssh
+                yield uri, address, None
+                continue
+            if not connect_to:
+                yield uri, address, _unreachable(uri, host, port,
+                        'Name or service not known', encoding)
+                continue
+            sock = socket.socket(socket.AF_INET6 if ':' in connect_to else socket.AF_INET,
+                    socket.SOCK_STREAM)
+            sock.setblocking(False)
+            error = sock.connect_ex((connect_to, port))
+            if error not in (0, EINPROGRESS, EWOULDBLOCK):
+                sock.close()
+                yield uri, address, _unreachable(uri, host, port, os.strerror(error), encoding)
+                continue
+            poller.register(sock, select.POLLOUT)
+            pending[sock.fileno()] = (sock, clock() + timeout, (uri, address, host, port))
+
+        if not pending:
+            continue
+        oldest = next(iter(pending.values()))
+        for fd, event in poller.poll(max(oldest[1] - clock(), 0) * 1000):
+            sock, deadline, (uri, address, host, port) = pending.pop(fd)
+            poller.unregister(fd)
+            error = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            sock.close()
+            if error:
+                yield uri, address, _unreachable(uri, host, port, os.strerror(error), encoding)
+            else:
+                yield uri, address, None
+
+        # Give up on the connects that took too long
+        now = clock()
+        while pending and next(iter(pending.values()))[1] <= now:
+            fd, (sock, deadline, (uri, address, host, port)) = pending.popitem(last=False)
+            poller.unregister(fd)
+            sock.close()
+            yield uri, address, _unreachable(uri, host, port, os.strerror(ETIMEDOUT), encoding)
+
+
+# The known_hosts files ssh checks when ssh_config does not name them
+default_known_hosts = ('~/.ssh/known_hosts', '~/.ssh/known_hosts2')
+default_global_known_hosts = ('/etc/ssh/ssh_known_hosts', '/etc/ssh/ssh_known_hosts2')
+
+def _known_hosts_files(options):
+    """
+    Get the user's and the global known_hosts files of these ssh "options",
+    see _ssh_config.
+
+    @rtype: tuple
+    """
+    user = options.get('userknownhostsfile', '').split() or list(default_known_hosts)
+    system = options.get('globalknownhostsfile', '').split() or list(default_global_known_hosts)
+    return user, system
+
+
+def _unknown(targets):
+    """
+    Get the targets whose host key is in none of the known_hosts files ssh
+    checks, using "ssh-keygen -F".  Each target is (uri, address, result,
+    options).
+    """
+    checks = []
+    with open(os.devnull, 'wb') as devnull:
+        for target in targets:
+            uri, address, result, options = target
+            alias = _host_key_alias(uri, options)
+            files = [os.path.expanduser(i) for i in sum(_known_hosts_files(options), [])]
+            checks.append((target, [popen(['ssh-keygen', '-F', alias, '-f', path],
+                stdin=devnull, stdout=devnull, stderr=devnull)
+                for path in files if os.path.isfile(path)]))
+        unknown = []
+        for target, procs in checks:
+            procs = [(proc.communicate(), proc.returncode)[1] for proc in procs]
+            if 0 not in procs:
+                unknown.append(target)
+    return unknown
+
+
+def _keyscan(targets, timeout):
+    """
+    Start scanning the host keys of "targets", one ssh-keyscan for each port.
+    Each target is (uri, address, result, options), the host and port ssh
+    connects to are scanned.
+    """
+    ports = OrderedDict()
+    for uri, address, result, options in targets:
+        user_host, port = split_uri(uri)
+        host = options.get('hostname') or user_host.rpartition('@')[2]
+        ports.setdefault(options.get('port') or port or '22', []).append(address or host)
+    with open(os.devnull, 'wb') as devnull:
+        return [popen(['ssh-keyscan', '-T', str(timeout), '-p', port] + hosts,
+            stdin=devnull, stdout=subprocess.PIPE, stderr=devnull)
+            for port, hosts in ports.items()]
+
+
+def _prefetch_host_keys(targets, known_hosts, batch=default_keyscan_batch,
+        scans=default_keyscans, rate=default_keyscan_rate, timeout=default_probe_timeout,
+        clock=time.time, sleep=time.sleep, extra_arguments=None):
+    """
+    Scan the host keys of "targets" before they are connected to, append them
+    to the file "known_hosts".  The targets are (uri, address, result) as
+    yielded by _resolve_targets.  Every "batch" targets are scanned by one
+    ssh-keyscan, up to "scans" of them at once, and no more than "rate" hosts
+    are scanned each second.  Each key is only written once.
+
+    Only a host that is in none of the known_hosts files ssh checks is
+    scanned, those files come from ssh_config and "extra_arguments" (see
+    _ssh_config).  The key of a known host is never written, so ssh still
+    refuses a host whose key does not match the key it knows.  A key is
+    written using the name ssh checks it by, see _host_key_alias.  A server
+    behind a ProxyJump or ProxyCommand is not scanned.
+
+    A target is only yielded after its keys have been written, targets that
+    have a result are yielded without being scanned.
+    """
+    # Each scan is (processes, targets), the oldest is first
+    running = []
+    written = set()
+    scanned = 0
+    start = clock()
+    targets = iter(targets)
+    target = next(targets, None)
+    while target or running:
+        while target and len(running) < scans:
+            scanning = []
+            while target and len(scanning) < batch:
+                uri, address, result = target
+                options = {} if result else _ssh_config(uri, extra_arguments)
+                if result or _proxied(options):
+                    yield target
+                else:
+                    scanning.append((uri, address, result, options))
+                target = next(targets, None)
+            scanning, known = _unknown(scanning), scanning
+            for known_target in known:
+                if known_target not in scanning:
+                    yield known_target[:3]
+            if scanning:
+                # Wait until these hosts are within the rate
+                sleep(max(scanned / float(rate) - (clock() - start), 0))
+                scanned += len(scanning)
+                running.append((_keyscan(scanning, timeout), scanning))
+
+        if running:
+            procs, scanning = running.pop(0)
+            # The names ssh checks each scanned host by
+            aliases = {}
+            for uri, address, result, options in scanning:
+                user_host, port = split_uri(uri)
+                host = address or options.get('hostname') or user_host.rpartition('@')[2]
+                port = options.get('port') or port or '22'
+                scanned_as = host if port == '22' else '[{}]:{}'.format(host, port)
+                aliases.setdefault(scanned_as.encode(), []).append(
+                        _host_key_alias(uri, options).encode())
+            lines = []
+            for proc in procs:
+                for line in proc.communicate()[0].splitlines():
+                    if not line.strip() or line.startswith(b'#'):
+                        continue
+                    name, _, key = line.partition(b' ')
+                    for alias in aliases.get(name, []):
+                        line = alias + b' ' + key
+                        if line not in written:
+                            written.add(line)
+                            lines.append(line + b'\n')
+            with open(known_hosts, 'ab') as file:
+                file.write(b''.join(lines))
+            for scanned_target in scanning:
+                yield scanned_target[:3]
+
+
+def default_history():
+    """
+    Get the path of the user's history file, it is $SSHM_HISTORY or
+    sshm/durations.json in the user's cache directory.
+
+    @rtype: str
+    """
+    if os.environ.get('SSHM_HISTORY'):
+        return os.environ['SSHM_HISTORY']
+    cache = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(cache, 'sshm', 'durations.json')
+
+
+def _load_durations(path):
+    """
+    Get the duration of each uri recorded in "path", in seconds.  A missing or
+    damaged file has no durations.
+    """
+    try:
+        with open(path) as file:
+            durations = json.load(file)
+    except (IOError, OSError, ValueError):
+        return {}
+    return durations if isinstance(durations, dict) else {}
+
+
+def _save_durations(path, durations):
+    """
+    Record "durations" in "path".  A uri that was already recorded keeps the
+    average of its old and new duration, so a single slow run is not trusted
+    entirely.  The file is replaced at once, it is never partially written.
+    """
+    if not durations:
+        return
+    recorded = _load_durations(path)
+    for uri, duration in durations.items():
+        if uri in recorded:
+            duration = (recorded[uri] + duration) / 2.0
+        recorded[uri] = round(duration, 3)
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    fd, temporary = tempfile.mkstemp(dir=directory or '.', prefix='.durations-')
+    with os.fdopen(fd, 'w') as file:
+        json.dump(recorded, file, sort_keys=True)
+    os.rename(temporary, path)
+
+
+def _longest_first(uris, durations):
+    """
+    Sort "uris" by their duration, the longest first.  A uri without a
+    duration is expected to take the average duration of the others, the
+    order of equal uris is kept.
+    """
+    known = [durations[uri] for uri in uris if uri in durations]
+    expected = sum(known) / len(known) if known else 0
+    return sorted(uris, key=lambda uri: -durations.get(uri, expected))
+
+
+# The CPU time of the current thread, when this Python can measure it.
+_thread_time = getattr(time, 'thread_time', None)
+
+class _Phase(object):
+    """
+    Time one call of a phase, see Profile.phase.
+    """
+
+    __slots__ = ('profile', 'group', 'name', 'wall', 'cpu')
+
+    def __init__(self, profile, group, name):
+        self.profile = profile
+        self.group = group
+        self.name = name
+
+
+    def __enter__(self):
+        self.cpu = _thread_time() if _thread_time else None
+        self.wall = time.time()
+
+
+    def __exit__(self, *exc_info):
+        wall = time.time() - self.wall
+        cpu = _thread_time() - self.cpu if _thread_time else None
+        self.profile._record(self.group, self.name, wall, cpu)
+
+
+class _NoPhase(object):
+    """
+    A phase that is not timed, it is used when sshm is not profiled.
+    """
+
+    def __enter__(self):
+        pass
+
+
+    def __exit__(self, *exc_info):
+        pass
+
+_no_phase = _NoPhase()
+
+def _not_profiled(group, name):
+    """
+    The phase method of sshm and ssh when there is no profile.
+    """
+    return _no_phase
+
+
+class Profile(object):
+    """
+    The cumulative wall and CPU time spent in each phase of sshm.  The phases
+    of the coordinator (the loop of sshm) and of the workers (each ssh call)
+    are separate groups.  The time of the workers is their total, it may be
+    longer than the time sshm ran.  The CPU time of a phase is only measured
+    when time.thread_time exists, otherwise it is None.
+
+    While started, the thread that called start is also sampled every
+    "interval" seconds, when an interval is provided.  Each sample is the
+    stack of that thread.
+    """
+
+    def __init__(self, interval=None):
+        self.interval = interval
+        self.phases = {}
+        self.samples = {}
+        self.elapsed = 0
+        self._lock = threading.Lock()
+        self._started = None
+        self._stop = threading.Event()
+        self._sampler = None
+
+
+    def phase(self, group, name):
+        """
+        Get a context manager that adds the time spent in it to the phase
+        "name" of "group".
+        """
+        return _Phase(self, group, name)
+
+
+    def _record(self, group, name, wall, cpu):
+        with self._lock:
+            totals = self.phases.setdefault(group, {}).setdefault(name,
+                    {'count':0, 'wall':0.0, 'cpu':0.0 if cpu is not None else None})
+            totals['count'] += 1
+            totals['wall'] += wall
+            if cpu is not None:
+                totals['cpu'] += cpu
+
+
+    def start(self):
+        """
+        Start measuring the elapsed time, and sampling the current thread.
+        """
+        self._started = time.time()
+        if self.interval:
+            self._stop.clear()
+            self._sampler = threading.Thread(target=self._sample,
+                    args=(threading.current_thread().ident,))
+            self._sampler.daemon = True
+            self._sampler.start()
+
+
+    def stop(self):
+        """
+        Stop what start started.
+        """
+        if self._started is not None:
+            self.elapsed += time.time() - self._started
+            self._started = None
+        if self._sampler:
+            self._stop.set()
+            self._sampler.join()
+            self._sampler = None
+
+
+    def _sample(self, ident):
+        """
+        Count the stacks of the thread "ident", outermost frame first, until
+        stopped.
+        """
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(ident)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('{}:{}'.format(os.path.basename(code.co_filename), code.co_name))
+                frame = frame.f_back
+            if stack:
+                stack = ';'.join(reversed(stack))
+                self.samples[stack] = self.samples.get(stack, 0) + 1
+
+
+    def report(self):
+        """
+        Get everything that was measured, it can be written as JSON.
+
+        @rtype: dict
+        """
+        with self._lock:
+            phases = dict((group, dict((name, dict(totals)) for name, totals in names.items()))
+                    for group, names in self.phases.items())
+        return {'elapsed':self.elapsed, 'phases':phases, 'samples':dict(self.samples)}
+
+
+    def lines(self):
+        """
+        Describe each phase, the longest phases of each group first.
+
+        @rtype: list
+        """
+        lines = ['elapsed {:.3f}s'.format(self.elapsed)]
+        phases = self.report()['phases']
+        for group in sorted(phases):
+            for name, totals in sorted(phases[group].items(), key=lambda i: -i[1]['wall']):
+                cpu = 'n/a' if totals['cpu'] is None else '{:.3f}s'.format(totals['cpu'])
+                lines.append('{} {}: {} calls, {:.3f}s wall, {} cpu'.format(group, name,
+                    totals['count'], totals['wall'], cpu))
+        return lines
+
+
+class RollingAbort(Exception):
+    """
+    Raised by sshm when too many servers of a rolling execution have failed.
+    Every server that was started has finished and been yielded.
+
+    @ivar failed: The amount of servers that failed.
+    @ivar finished: The amount of servers that finished.
+    @ivar remaining: The servers that were never started, see compact_uris.
+    """
+
+    def __init__(self, failed, finished, remaining):
+        self.failed = failed
+        self.finished = finished
+        self.remaining = remaining
+        super(RollingAbort, self).__init__(
+                '{} of {} servers failed, these servers were not started: {}'.format(
+                    failed, finished, remaining or 'none'))
+
+
+def _batch_sizes(batch, canary, servers):
+    """
+    Yield the size of each batch of a rolling execution.  A "batch" ending
+    with % is a percentage of the servers.  Without a "batch", everything after
+    the canary is one batch.
+    """
+    if canary:
+        yield canary
+    if isinstance(batch, str) and batch.endswith('%'):
+        total = sum(uri_count(i) for i in servers)
+        batch = max(int(math.ceil(total * float(batch[:-1]) / 100)), 1)
+    while True:
+        yield int(batch) if batch else float('inf')
+
+
+def _abandon(threads, sink, stdin_sock, slots, cleanup):
+    """
+    Wait for the "threads" of an sshm call that stopped before they finished.
+    Their results are dropped, and the end of stdin is sent to any thread that
+    requests it.  The slot of each thread is released when it finishes, then
+    "cleanup" is called.
+    """
+    # A request for stdin may have been received, but not answered
+    try:
+        stdin_sock.send_pyobj(None, zmq.NOBLOCK)
+    except zmq.ZMQError:
+        pass
+    poller = zmq.Poller()
+    poller.register(sink, zmq.POLLIN)
+    poller.register(stdin_sock, zmq.POLLIN)
+    while threads:
+        socks = dict(poller.poll())
+        if socks.get(sink) == zmq.POLLIN:
+            result = sink.recv_pyobj()
+            threads.pop(result['thread_num']).join()
+            if slots:
+                slots.release()
+        elif socks.get(stdin_sock) == zmq.POLLIN:
+            stdin_sock.recv_pyobj()
+            stdin_sock.send_pyobj(None)
+    cleanup()
 
 
 CHUNK_SIZE = 65536
 
-def sshm(servers, command, extra_arguments=None, stdin=None, disable_formatting_var=False, workers=default_workers):
+def sshm(servers, command, extra_arguments=None, stdin=None, disable_formatting_var=False, workers=default_workers, stdout_path=None,
+        encoding=default_encoding, errors=default_errors, stderr_path=None, exclude=None, order='lexical',
+        seed=None, intersect=None, resolve=False, probe=False, prefetch_hostkeys=False,
+        batch=None, canary=None, max_failure_rate=0, slots=None, transport='openssh',
+        compress=False, history=None, profile=None, on_running=None):
     """
     SSH into multiple servers and execute "command". Pass stdin to these ssh
-    handles.
+    handles.  A server that is specified more than once, even by different
+    groups, is only connected to once.
 
     This is a generator to facilitate using the results of each ssh command as
     they become available.
@@ -269,14 +1875,134 @@ def sshm(servers, command, extra_arguments=None, stdin=None, disable_formatting_
     @param workers: The max amount of concurrent SSH connections.
     @type workers: int
 
+    @param stdout_path: Write the stdout of each ssh session directly to this
+        file, see ssh.
+    @type stdout_path: str
+
+    @param stderr_path: Write the stderr of each ssh session directly to this
+        file, see ssh.
+    @type stderr_path: str
+
+    @param encoding: Decode the output of each ssh session using this encoding.
+        If this is None, the output is returned as bytes.
+    @type encoding: str
+
+    @param errors: How decoding errors are handled, see bytes.decode.
+    @type errors: str
+
+    @param exclude: Skip any server matched by these uris, see uri_expansion.
+    @type exclude: str
+
+    @param intersect: Only connect to the servers also matched by these uris,
+        see uri_expansion.
+    @type intersect: str
+
+    @param order: The order the servers of each group are connected to, one of
+        'lexical', 'interleave' or 'random', see uri_expansion.
+    @type order: str
+
+    @param seed: The seed of the 'random' order.
+    @type seed: int
+
+    @param resolve: Resolve the servers concurrently before connecting to them,
+        see _resolve_targets.  A server that does not exist is reported without
+        running ssh, and servers with the same address are only connected to
+        once.  ssh connects to the resolved address, but checks the host key of
+        the server's name.  The options of ssh_config and "extra_arguments" are
+        used, see _resolve_targets.
+    @type resolve: bool
+
+    @param probe: Only connect to the servers whose port accepts a connection,
+        see _probe_targets.  Many servers are probed at once, any server that
+        does not respond is reported without running ssh.
+    @type probe: bool
+
+    @param prefetch_hostkeys: Scan the host keys of the servers that are not
+        in any known_hosts file in parallel, before connecting to them, see
+        _prefetch_host_keys.  The keys are written to a temporary known_hosts
+        file that every ssh call checks, after the user's own files.  A server
+        whose key is known is still checked against that key.  The file is
+        removed when all servers are finished.
+    @type prefetch_hostkeys: bool
+
+    @param batch: Run the servers in batches of this size, a batch is only
+        started once the previous batch has finished.  A string ending with %
+        is a percentage of the servers.  The batches are limited by "workers"
+        as well.
+    @type batch: int or str
+
+    @param canary: Run a batch of this size before the other batches.
+    @type canary: int
+
+    @param max_failure_rate: When batches or a canary are used, stop once the
+        fraction of finished servers that failed is greater than this.  Servers
+        that were not connected to (see resolve and probe) are not counted.
+        RollingAbort is raised after the running servers finish, it contains
+        the servers that were never started.
+    @type max_failure_rate: float
+
+    @param slots: A semaphore shared by several sshm calls, it limits their
+        total amount of ssh connections.  A slot is acquired before each ssh
+        connection is started, and released when it finishes.  Each call is
+        still limited by its own "workers".  Calls that share slots must be
+        consumed by different threads, a call waiting for a slot blocks its
+        thread.
+    @type slots: threading.Semaphore
+
+    @param transport: How servers are connected to, one of transports.
+        'openssh' runs the ssh client for each server, 'asyncssh' connects to
+        all of them in this process using asyncssh.
+    @type transport: str
+
+    @param compress: Compress the output of each server using gzip before it
+        is sent, it is decompressed when it is received.  This can not be used
+        with "stdout_path" or "stderr_path".
+    @type compress: bool
+
+    @param history: A file that records how long each server took, see
+        default_history.  The servers that took the longest are started first,
+        a server without a record is expected to take the average time.  All
+        servers are expanded before the first one is started.
+    @type history: str
+
+    @param profile: Add the time spent in each phase of this loop, and of each
+        ssh call, to this profile.  The 'coordinator' phases are getting the
+        next target, starting threads, polling, receiving results, serving
+        stdin, joining threads and the time the caller spends with each
+        result.
+    @type profile: Profile
+
+    @param on_running: Called with the amount of running ssh connections each
+        time it changes.
+    @type on_running: callable
+
     @returns: A list containing (success, handle, message) from each method
         call.
     """
     if type(servers) == str:
         servers = [servers,]
-    # Disable formatting when requested
-    global disable_formatting
-    disable_formatting = disable_formatting_var
+    # Only pass the options that were requested to each ssh call
+    ssh_kwargs = {}
+    if stdout_path:
+        ssh_kwargs['stdout_path'] = stdout_path
+    if stderr_path:
+        ssh_kwargs['stderr_path'] = stderr_path
+    if encoding != default_encoding:
+        ssh_kwargs['encoding'] = encoding
+    if errors != default_errors:
+        ssh_kwargs['errors'] = errors
+    if disable_formatting_var:
+        ssh_kwargs['disable_formatting'] = True
+    if transport != 'openssh':
+        _transport(transport)
+        ssh_kwargs['transport'] = transport
+    if compress:
+        if stdout_path or stderr_path:
+            raise ValueError('compress can not be used with stdout_path or stderr_path')
+        ssh_kwargs['compress'] = True
+    if profile:
+        ssh_kwargs['profile'] = profile
+    phase = profile.phase if profile else _not_profiled
 
     context = zmq.Context()
     # The results of each ssh call is reported to this sink
@@ -303,63 +2029,445 @@ def sshm(servers, command, extra_arguments=None, stdin=None, disable_formatting_
     stdin_queue = {}
     stdin_chunks = {}
     chunk_count = 1
+    # The prefix of the cmd shared by the results
+    cmd_prefixes = {}
     # Start each SSH connection in it's own thread
     threads = {}
     thread_num = 0
     # Expand the provided URIs using a generator, this allows for extremely
     # large server specifications.
-    uri_gen = uri_expansion(servers.pop(0))
-    next_uri = next(uri_gen)
-    while next_uri or threads:
-        # Start a new thread if there are any URIs left
-        while next_uri and len(threads) < workers:
-            thread = threading.Thread(target=ssh, args=(thread_num, context,
-                next_uri, command, extra_arguments, if_stdin))
-            thread.start()
-            threads[thread_num] = thread
-            thread_num += 1
+    uri_gen = uri_expansion(servers, exclude, order, seed, intersect)
+    if history:
+        uri_gen = iter(_longest_first(list(uri_gen), _load_durations(history)))
+        # When each thread was started, and how long each uri took
+        begun = {}
+        durations = {}
+    if resolve or probe or prefetch_hostkeys:
+        # The ssh options of the servers are read concurrently
+        targets = _resolve_targets(uri_gen, encoding=encoding, extra_arguments=extra_arguments,
+                lookup=resolve)
+    else:
+        targets = ((uri, None, None) for uri in uri_gen)
+    if probe:
+        targets = _probe_targets(targets, encoding=encoding, extra_arguments=extra_arguments)
+    if prefetch_hostkeys:
+        fd, known_hosts = tempfile.mkstemp(prefix='sshm-known_hosts-')
+        os.close(fd)
+        ssh_kwargs['known_hosts'] = known_hosts
+        targets = _prefetch_host_keys(targets, known_hosts, extra_arguments=extra_arguments)
+    # Rolling execution starts each batch after the previous one has finished
+    rolling = bool(batch or canary)
+    sizes = _batch_sizes(batch, canary, servers)
+    batch_end = next(sizes) if rolling else float('inf')
+    started = set()
+    spawned = finished = failed = 0
+    aborted = False
+    try:
+        with phase('coordinator', 'targets'):
+            target = next(targets, None)
+        while (target and not aborted) or threads:
+            if spawned >= batch_end and not threads:
+                if failed > max_failure_rate * finished:
+                    aborted = True
+                    continue
+                batch_end += next(sizes)
+            # Start a new thread if there are any URIs left
+            while target and len(threads) < workers and spawned < batch_end:
+                uri, address, result = target
+                # Only wait for a shared slot when there is nothing else to do
+                if slots and not result and not slots.acquire(not threads):
+                    break
+                if rolling:
+                    started.add(uri)
+                if result:
+                    # This uri is reported without connecting to it
+                    result['thread_num'] = thread_num
+                    with phase('coordinator', 'caller'):
+                        yield result
+                else:
+                    kwargs = dict(ssh_kwargs, address=address) if address else ssh_kwargs
+                    with phase('coordinator', 'thread start'):
+                        thread = threading.Thread(target=ssh, args=(thread_num, context,
+                            uri, command, extra_arguments, if_stdin), kwargs=kwargs)
+                        thread.start()
+                    threads[thread_num] = thread
+                    spawned += 1
+                    if on_running:
+                        on_running(len(threads))
+                    if history:
+                        begun[thread_num] = time.time()
+                thread_num += 1
+                with phase('coordinator', 'targets'):
+                    target = next(targets, None)
+            if not threads:
+                continue
+
+            with phase('coordinator', 'poll'):
+                socks = dict(poller.poll())
+            if socks.get(sink) == zmq.POLLIN:
+                # A thread has finished, yield the results
+                with phase('coordinator', 'result'):
+                    results = sink.recv_pyobj()
+                finished += 1
+                if isinstance(results, Result):
+                    results.share_cmd(cmd_prefixes)
+                if history:
+                    durations[results['uri']] = time.time() - begun.pop(results['thread_num'])
+                if results.get('return_code') or results.get('traceback'):
+                    failed += 1
+                # The thread is finished before the caller gets its result, the
+                # caller may never return
+                with phase('coordinator', 'join'):
+                    threads.pop(results['thread_num']).join()
+                if slots:
+                    slots.release()
+                if on_running:
+                    on_running(len(threads))
+                with phase('coordinator', 'caller'):
+                    yield results
+            elif socks.get(stdin_sock) == zmq.POLLIN:
+                with phase('coordinator', 'stdin'):
+                    # A thread requests it's stdin, give it it's next chunk.
+                    requester = stdin_sock.recv_pyobj()
+                    # Start each thread at the beginning of the STDIN
+                    if requester not in stdin_queue:
+                        stdin_queue[requester] = 1
+                    # Read the next chunk to memory if it hasn't been read in yet
+                    if stdin_queue[requester] not in stdin_chunks:
+                        chunk = stdin.read(CHUNK_SIZE)
+                        if len(chunk) == 0:
+                            chunk = None
+                        stdin_chunks[chunk_count] = chunk
+                        chunk_count += 1
+
+                    # Send their current chunk
+                    chunk = stdin_chunks[stdin_queue[requester]]
+                    stdin_sock.send_pyobj(chunk)
+                    # Set the next chunk
+                    stdin_queue[requester] += 1
+    finally:
+        targets.close()
+        def cleanup():
+            sink.close()
+            stdin_sock.close()
+            context.term()
+            if prefetch_hostkeys:
+                os.remove(known_hosts)
+            if history:
+                _save_durations(history, durations)
+        if threads:
+            # Closed early, or failed: the running threads are waited for in
+            # the background, their slots are released as they finish.
+            reaper = threading.Thread(target=_abandon,
+                    args=(threads, sink, stdin_sock, slots, cleanup))
+            reaper.daemon = True
+            reaper.start()
+        else:
+            cleanup()
+    if aborted:
+        # Describe every server that was not started, in the order specified
+        remaining = uri_expansion(servers, exclude, intersect=intersect)
+        raise RollingAbort(failed, finished, ','.join(
+            compact_uris(i for i in remaining if i not in started)))
+
+
+
+# This script is executed on every host of a fan-out tree.  It is sent at the
+# beginning of each host's stdin, followed by a line containing the host list,
+# followed by the stdin that is being distributed.  The script saves that stdin
+# to a file and forwards it, using tee, to the roots of its subtrees.  Neither
+# the script nor the host list are passed as arguments, so the size of the tree
+# is not limited by the maximum length of a command.
+#
+#   $0: This script.
+#   $1: The temporary directory this script was written to.
+#   $2: The file the stdin will be written to.
+#   $3: The index of the subtree this host should take from the host list, or
+#       "-" when the host list is already this host's subtree.
+_FANOUT_RELAY = r'''set -f
+d=$1; p=$2; j=$3
+IFS= read -r h || exit 1
+set -- $h
+if [ "$j" != "-" ]; then
+    s=$(( ($# + WIDTH - 1) / WIDTH )); i=0; r=""
+    for c; do
+        if [ $i -gt $((j * s)) ] && [ $i -lt $((j * s + s)) ]; then r="$r $c"; fi
+        i=$((i + 1))
+    done
+    set -- $r
+fi
+if [ $# -eq 0 ]; then
+    cat > "$p"; f=$?
+    rm -rf "$d"
+    exit $f
+fi
+trap "" PIPE
+l=$(($(wc -c < "$0")))
+s=$(( ($# + WIDTH - 1) / WIDTH )); n=0; w=""; t=""
+while [ $# -gt 0 ]; do
+    c=$1; shift; r=""; i=1
+    while [ $i -lt $s ] && [ $# -gt 0 ]; do r="$r $1"; shift; i=$((i + 1)); done
+    o=""
+    case $c in
+        *]:*) o="-p ${c##*:}"; c=${c%:*};;
+        *:*:*) ;;
+        *:*) o="-p ${c##*:}"; c=${c%:*};;
+    esac
+    case $c in *"["*) c=$(printf '%s' "$c" | tr -d '[]');; esac
+    n=$((n + 1)); mkfifo "$d/$n"; t="$t $d/$n"
+    { cat "$0"; printf '%s\n' "$r"; cat "$d/$n"; } | ssh ARGUMENTS $o $c "d=\$(mktemp -d) && dd bs=1 count=$l of=\$d/r 2>/dev/null && exec sh \$d/r \$d $p -" > /dev/null &
+    w="$w $!"
+done
+tee "$p" $t > /dev/null; f=$?
+for i in $w; do wait $i || f=1; done
+rm -rf "$d"
+exit $f
+'''
+
+# Receive the relay script from stdin and execute it.  The relay uses the same
+# command to start the relays below it.
+_FANOUT_BOOTSTRAP = r'd=$(mktemp -d) && dd bs=1 count={length} of=$d/r 2>/dev/null && exec sh $d/r $d {path}'
+
+# The file each host writes the distributed stdin to may only contain these
+# characters, it is passed between hosts without quoting.
+_valid_fanout_path = re.compile(r'^[\w./-]+$')
+
+
+class _PrefixedReader(object):
+    """
+    Read "prefix", then everything in "file".
+    """
+
+    def __init__(self, prefix, file):
+        self.prefix = prefix
+        self.file = file
+
+
+    def read(self, size):
+        if self.prefix:
+            chunk, self.prefix = self.prefix[:size], self.prefix[size:]
+            return chunk
+        return self.file.read(size)
+
+
+def fanout_tree(uris, width):
+    """
+    Split a list of uris into at most "width" subtrees.  The first uri of each
+    subtree is its root.  This must match the splitting done by _FANOUT_RELAY.
+
+        Example: (['a', 'b', 'c', 'd', 'e'], 2) to [['a', 'b', 'c'], ['d', 'e']]
+
+    @param uris: The uris to split.
+    @type uris: list
+
+    @param width: The maximum amount of subtrees.
+    @type width: int
+    """
+    if width < 1:
+        raise ValueError('Fan-out width must be at least 1')
+    size = (len(uris) + width - 1) // width
+    return [uris[i:i+size] for i in range(0, len(uris), size or 1)]
+
+
+def fanout(servers, command, stdin, extra_arguments=None, disable_formatting_var=False, workers=default_workers, width=2, path=None,
+        encoding=default_encoding, errors=default_errors, exclude=None, intersect=None):
+    """
+    Distribute stdin to multiple servers using a tree of ssh connections, then
+    execute "command" on each server with the distributed stdin.
+
+    Only the roots of the tree receive stdin from this host.  Every host writes
+    its stdin to "path" and forwards it to the roots of its subtrees, so this
+    host only sends "width" copies of stdin.  Each host must be able to ssh into
+    the hosts below it (for example, using an agent forwarded with -A).  The
+    extra arguments are also passed to these ssh calls.
+
+    Any host that fails to distribute stdin to its subtree is yielded with a
+    'fanout' key.  The results of "command" are yielded as they are by sshm.
+
+    @param width: The amount of hosts each host forwards stdin to.
+    @type width: int
+
+    @param path: The file stdin will be written to on each host.  This file is
+        removed after "command" is executed.  It may only contain letters,
+        digits and "_./-".
+    @type path: str
+
+    See sshm for the remaining parameters.
+    """
+    if type(servers) == str:
+        servers = [servers,]
+    uris = list(uri_expansion(servers, exclude, intersect=intersect))
+    path = path or '/tmp/sshm-fanout-' + uuid.uuid4().hex
+    if not _valid_fanout_path.match(path):
+        raise ValueError('Invalid fan-out path "{}"'.format(path))
+
+    arguments = ' '.join(quote(i) for i in ['-oBatchMode=yes',] + list(extra_arguments or []))
+    relay = _FANOUT_RELAY.replace('WIDTH', str(width)).replace('ARGUMENTS', arguments)
+    bootstrap = _FANOUT_BOOTSTRAP.format(length=len(relay.encode()), path=path)
+
+    # Every root receives the relay and the complete host list before stdin.
+    # Each root selects its own subtree from the host list using its thread
+    # number.
+    roots = [subtree[0] for subtree in fanout_tree(uris, width)]
+    relay_command = escape_formatting(bootstrap) + ' {num}'
+    prefix = relay.encode() + (' '.join(uris) + '\n').encode()
+    stdin = _PrefixedReader(prefix, getattr(stdin, 'buffer', stdin))
+    for result in sshm(','.join(roots), relay_command, extra_arguments, stdin,
+            workers=workers):
+        if result.get('return_code') != 0:
+            result['fanout'] = True
+            yield result
+
+    # Every host should now have stdin, execute the command using it.
+    command = '({command}) < {path}; r=$?; rm -f {path}; exit $r'.format(
+            command=command, path=path)
+    for result in sshm(uris, command, extra_arguments,
+            disable_formatting_var=disable_formatting_var, workers=workers,
+            encoding=encoding, errors=errors):
+        yield result
+
+
+def _remove_failed_copies(results):
+    """
+    Remove the copied file of any result that failed, along with its directory
+    if it is empty.
+    """
+    for result in results:
+        path = result.get('stdout_path')
+        if path and (result.get('return_code') or result.get('traceback')):
+            del result['stdout_path'], result['stdout_size']
+            if os.path.isfile(path):
+                os.remove(path)
             try:
-                next_uri = next(uri_gen)
-            except StopIteration:
-                # No more URIs in server group, try the next group
-                try:
-                    uri_gen = uri_expansion(servers.pop(0))
-                    next_uri = next(uri_gen)
-                except IndexError:
-                    # No more server groups
-                    next_uri = None
+                os.rmdir(os.path.dirname(path))
+            except OSError:
+                # The directory contains other files
+                pass
+        yield result
 
-        socks = dict(poller.poll())
-        if socks.get(sink) == zmq.POLLIN:
-            # A thread has finished, yield the results
-            results = sink.recv_pyobj()
-            yield results
-            threads[results['thread_num']].join()
-            del threads[results['thread_num']]
-        elif socks.get(stdin_sock) == zmq.POLLIN:
-            # A thread requests it's stdin, give it it's next chunk.
-            thread_num = stdin_sock.recv_pyobj()
-            # Start each thread at the beginning of the STDIN
-            if thread_num not in stdin_queue:
-                stdin_queue[thread_num] = 1
-            # Read the next chunk to memory if it hasn't been read in yet
-            if stdin_queue[thread_num] not in stdin_chunks:
-                chunk = stdin.read(CHUNK_SIZE)
-                if len(chunk) == 0:
-                    chunk = None
-                stdin_chunks[chunk_count] = chunk
-                chunk_count += 1
-
-            # Send their current chunk
-            chunk = stdin_chunks[stdin_queue[thread_num]]
-            stdin_sock.send_pyobj(chunk)
-            # Set the next chunk
-            stdin_queue[thread_num] += 1
-
-    # Cleanup
-    sink.close()
-    stdin_sock.close()
-    context.term()
 
+def gather(servers, path, outdir, extra_arguments=None, compress=False, workers=default_workers,
+        **kwargs):
+    """
+    Copy the file "path" from multiple servers to "outdir/<uri>/".  Each file is
+    written directly to disk by its ssh process as it is received.
+
+    The results are yielded as they are by sshm, each successful result
+    contains the 'stdout_path' and 'stdout_size' of the copied file.  The file
+    of a failed copy is removed.
+
+    @param path: The file to copy from each server.
+    @type path: str
+
+    @param outdir: Copy each file into a directory named after its uri in this
+        directory.
+    @type outdir: str
 
+    @param compress: Compress each file using gzip before it is sent.  The
+        compressed file is kept, its name ends with ".gz".
+    @type compress: bool
 
+    Any other keyword arguments, such as "encoding", are passed to sshm.  See
+    sshm for the remaining parameters.
+    """
+    name = os.path.basename(path.rstrip('/'))
+    if name in ('', '.', '..'):
+        raise ValueError('Unable to copy "{}", it is not a file'.format(path))
+    if compress:
+        command = 'gzip -c -- ' + quote(path)
+        name += '.gz'
+    else:
+        command = 'cat -- ' + quote(path)
+    # The output path is formatted with the uri of each server
+    stdout_path = os.path.join(escape_formatting(outdir), '{uri}',
+            escape_formatting(name))
+    return _remove_failed_copies(sshm(servers, command, extra_arguments,
+        disable_formatting_var=True, workers=workers, stdout_path=stdout_path,
+        **kwargs))
+
+
+# This script runs each step of a script, see script.  Each step is executed by
+# the same shell, its stdout and stderr are written to files and then framed on
+# stdout by a header line: "marker step return_code stdout_size stderr_size".
+# The size of each output is used to find the next header, so the output of a
+# step may contain anything.
+_SCRIPT_RUNNER = r'''d=$(mktemp -d) || exit 255
+trap 'rm -rf "$d"' EXIT
+m={marker}
+run() {
+    eval "$2" > "$d/o" 2> "$d/e"; r=$?
+    printf '%s %s %s %s %s\n' "$m" "$1" "$r" $(wc -c < "$d/o") $(wc -c < "$d/e")
+    cat "$d/o" "$d/e"
+    return $r
+}
+'''
+
+def _split_steps(stdout, marker, commands, encoding, errors):
+    """
+    Split the framed output of _SCRIPT_RUNNER into the results of each step.
+    Returns the results and any output that was not framed.
+    """
+    header = re.compile(re.escape(marker.encode()) + br' (\d+) (\d+) (\d+) (\d+)\n')
+    steps = []
+    unframed = []
+    position = 0
+    match = header.search(stdout, position)
+    while match:
+        unframed.append(stdout[position:match.start()])
+        index, return_code, stdout_size, stderr_size = [int(i) for i in match.groups()]
+        stderr_start = match.end() + stdout_size
+        position = stderr_start + stderr_size
+        steps.append({
+            'command':commands[index],
+            'return_code':return_code,
+            'stdout':_decode(stdout[match.end():stderr_start], encoding, errors),
+            'stderr':_decode(stdout[stderr_start:position], encoding, errors),
+            })
+        match = header.search(stdout, position)
+    unframed.append(stdout[position:])
+    return steps, _decode(b''.join(unframed), encoding, errors)
+
+
+def script(servers, commands, extra_arguments=None, stdin=None, disable_formatting_var=False,
+        workers=default_workers, stop_on_failure=False, encoding=default_encoding,
+        errors=default_errors, **kwargs):
+    """
+    Execute a list of commands on multiple servers, using one ssh session for
+    each server.  The commands are run in order by the same shell, so a
+    command may use the directory or variables of the commands before it.
+    They share the session's stdin.
+
+    Each result contains the 'steps' that were run, each step contains the
+    'command' and its 'stdout', 'stderr' and 'return_code'.  The result's
+    'return_code' is the return code of the last step that was run, its
+    'stderr' is the stderr of ssh.
+
+    @param commands: Run each of these commands, they are formatted like the
+        command of sshm.
+    @type commands: list
+
+    @param stop_on_failure: Stop running the commands of a server after the
+        first command that fails.
+    @type stop_on_failure: bool
+
+    Any other keyword arguments are passed to sshm.  See sshm for the remaining
+    parameters.
+    """
+    if kwargs.get('stdout_path'):
+        raise ValueError('The stdout of a script can not be written to a file')
+    marker = 'sshm-step-' + uuid.uuid4().hex
+    runner = _SCRIPT_RUNNER.replace('{marker}', marker)
+    if not disable_formatting_var:
+        runner = escape_formatting(runner)
+    steps = (' && ' if stop_on_failure else '\n').join(
+            'run {} {}'.format(i, quote(command)) for i, command in enumerate(commands))
+    command = 'sh -c ' + quote(runner + steps)
+    for result in sshm(servers, command, extra_arguments, stdin, disable_formatting_var,
+            workers, encoding=None, **kwargs):
+        result['steps'], stdout = _split_steps(result.pop('stdout', b''), marker,
+                commands, encoding, errors)
+        if stdout:
+            result['stdout'] = stdout
+        if 'stderr' in result:
+            result['stderr'] = _decode(result['stderr'], encoding, errors)
+        yield result
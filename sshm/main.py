@@ -6,11 +6,22 @@ This module should only be run by the console!
 """
 
 from __future__ import print_function
+import heapq
+import json
+import math
+import os.path
 import sys
+import time
 try: # pragma: no cover version specific
-    from lib import sshm
+    from lib import sshm, fanout, gather, script, escape_formatting, uri_expansion, RollingAbort, \
+            default_history, Profile
+    from daemon import submit, default_socket
+    from store import Store
 except ImportError: # pragma: no cover version specific
-    from sshm.lib import sshm
+    from sshm.lib import sshm, fanout, gather, script, escape_formatting, uri_expansion, RollingAbort, \
+            default_history, Profile
+    from sshm.daemon import submit, default_socket
+    from sshm.store import Store
 
 __all__ = ['main']
 
@@ -46,6 +57,58 @@ def get_argparse_args(args=None):
             help="Hide SSHM's server information on output (this implies sorted).")
     parser.add_argument('-w', '--workers', type=int, default=20,
             help="Limit the amount of concurrent SSH connections.")
+    parser.add_argument('-f', '--fanout', type=int, default=None, metavar='WIDTH',
+            help="Distribute stdin through a tree of hosts, each host forwards it to WIDTH more hosts.")
+    parser.add_argument('-g', '--gather', default=None, metavar='OUTDIR',
+            help="Copy the file named by the command from each host into OUTDIR/<uri>/.")
+    parser.add_argument('--compress', action='store_true', default=False,
+            help="Compress the output of each host using gzip before it is sent, it is decompressed when received.  Hosts without gzip send it uncompressed.  With --gather, the compressed file is kept.")
+    parser.add_argument('--output-dir', default=None, metavar='DIR',
+            help="Write the stdout and stderr of each host to DIR/<uri>.out and DIR/<uri>.err instead of printing them.")
+    parser.add_argument('--progress', action='store_true', default=False,
+            help="Display the progress of all hosts on stderr.")
+    parser.add_argument('--exclude', default=None, metavar='SERVERS',
+            help="Skip any server matched by SERVERS, ranges and CIDR networks may be used.")
+    parser.add_argument('--intersect', default=None, metavar='SERVERS',
+            help="Only use the servers also matched by SERVERS.")
+    parser.add_argument('--order', default='lexical', choices=['lexical', 'interleave', 'random'],
+            help="The order servers are connected to.  interleave alternates between subnets, random is a pseudo-random permutation.")
+    parser.add_argument('--seed', type=int, default=None,
+            help="The seed of the random order, the same seed always gives the same order.")
+    parser.add_argument('--history', action='store_true', default=False,
+            help="Record how long each server takes, in $SSHM_HISTORY or ~/.cache/sshm/durations.json.  The servers that took the longest are started first, so they do not finish last.")
+    parser.add_argument('--resolve', action='store_true', default=False,
+            help="Resolve all servers concurrently before connecting.  Servers that do not exist are reported without running ssh, servers with the same address are only connected to once.  Names are resolved using their HostName in ssh_config, servers behind a ProxyJump or ProxyCommand are left to ssh.")
+    parser.add_argument('--probe', action='store_true', default=False,
+            help="Only run ssh on servers whose port accepts a connection, many servers are checked at once.  Unreachable servers are reported without running ssh.  The host and port of ssh_config and ssh arguments are probed, servers behind a ProxyJump or ProxyCommand are not probed.")
+    parser.add_argument('--prefetch-hostkeys', action='store_true', default=False,
+            help="Scan the host keys of the servers that are not in your known_hosts in parallel before connecting, and accept those keys.  Servers that are in your known_hosts are checked against them as usual.")
+    parser.add_argument('--canary', type=int, default=None, metavar='N',
+            help="Run N servers first, the rest are only started if they succeed.")
+    parser.add_argument('--batch', default=None, metavar='N',
+            help="Run the servers in batches of N (or N%% of the servers), each batch starts after the previous batch has finished.")
+    parser.add_argument('--max-failure-rate', type=float, default=0, metavar='RATE',
+            help="Stop starting batches once more than RATE (0 to 1) of the finished servers have failed, the servers that were not started are listed.  Defaults to 0, any failure stops.")
+    parser.add_argument('--script', action='store_true', default=False,
+            help="The command is a file, each of its lines is a command.  All commands are run in one ssh session on each server, and their output is printed separately.  Empty lines and lines starting with # are skipped.")
+    parser.add_argument('--stop-on-failure', action='store_true', default=False,
+            help="Stop running the commands of a --script on a server after one fails.")
+    parser.add_argument('--inline', action='store_true', default=False,
+            help="Prefix every line of output with the uri of its instance, like pdsh.  Errors are written to stderr the same way.")
+    parser.add_argument('--reduce', action='store_true', default=False,
+            help="Only print a summary of the number printed by each host: the count, sum, mean, minimum, maximum, percentiles and the hosts with the highest and lowest numbers.")
+    parser.add_argument('--store', action='store_true', default=False,
+            help="Also store every result in a database, $SSHM_STORE or ~/.local/share/sshm/results.sqlite.  Query it using sshm-query.")
+    parser.add_argument('--transport', default='openssh', choices=['openssh', 'asyncssh'],
+            help="How servers are connected to.  asyncssh connects to all servers from within sshm instead of running ssh for each one, it requires the asyncssh package and does not accept ssh arguments.")
+    parser.add_argument('--daemon', action='store_true', default=False,
+            help="Run the command through the daemon started by sshmd, listening on $SSHM_SOCKET.  Its connections to servers are reused, and its workers are shared by all jobs.")
+    parser.add_argument('--profile', action='store_true', default=False,
+            help="Measure the wall and CPU time sshm spends in each phase of its loop and of each ssh call, print them on stderr when finished.")
+    parser.add_argument('--profile-output', default=None, metavar='FILE',
+            help="With --profile, write the measurements to FILE as JSON instead of printing them.")
+    parser.add_argument('--profile-interval', type=float, default=None, metavar='SECONDS',
+            help="With --profile, also sample the stack of sshm's loop every SECONDS.  The most common stacks are printed, the JSON contains every stack.")
     parser.add_argument('--version', action='version', version='%(prog)s '+__version__)
     args, extra_args = parser.parse_known_args(args=args)
 
@@ -67,28 +130,495 @@ def get_argparse_args(args=None):
     if args.quiet:
         args.sorted_output = True
 
+    if args.compress and (args.output_dir or args.fanout):
+        parser.error('--compress can not be used with --output-dir or --fanout')
+
+    if args.fanout is not None:
+        if args.fanout < 1:
+            parser.error('--fanout WIDTH must be at least 1')
+        if (args.gather or args.output_dir or args.resolve or args.probe or args.prefetch_hostkeys
+                or args.canary or args.batch or args.history):
+            parser.error('--fanout can not be used with --gather, --output-dir, --resolve, --probe, --prefetch-hostkeys, --canary, --batch or --history')
+
+    if args.gather and args.output_dir:
+        parser.error('--gather can not be used with --output-dir')
+
+    if args.script and (args.gather or args.output_dir or args.fanout):
+        parser.error('--script can not be used with --gather, --output-dir or --fanout')
+    if args.daemon and (args.gather or args.output_dir or args.fanout or args.script):
+        parser.error('--daemon can not be used with --gather, --output-dir, --fanout or --script')
+    if args.transport != 'openssh' and (extra_args or args.fanout or args.gather):
+        parser.error('--transport {} can not be used with ssh arguments, --fanout or --gather'.format(
+            args.transport))
+    if args.inline and (args.quiet or args.reduce or args.gather or args.output_dir):
+        parser.error('--inline can not be used with --quiet, --reduce, --gather or --output-dir')
+    if args.reduce and (args.gather or args.output_dir or args.fanout or args.script):
+        parser.error('--reduce can not be used with --gather, --output-dir, --fanout or --script')
+    if args.profile and (args.daemon or args.fanout):
+        parser.error('--profile can not be used with --daemon or --fanout')
+    if (args.profile_output or args.profile_interval is not None) and not args.profile:
+        parser.error('--profile-output and --profile-interval require --profile')
+    if args.profile_interval is not None and args.profile_interval <= 0:
+        parser.error('--profile-interval must be positive')
+    if args.stop_on_failure and not args.script:
+        parser.error('--stop-on-failure can only be used with --script')
+    if args.script:
+        try:
+            args.commands = _read_script(args.command)
+        except (IOError, OSError) as error:
+            parser.error('--script {}: {}'.format(args.command, error.strerror))
+        if not args.commands:
+            parser.error('--script {} contains no commands'.format(args.command))
+
+    if args.history and args.order != 'lexical':
+        parser.error('--history can not be used with --order, it starts the slowest servers first')
+    if args.seed is not None and args.order != 'random':
+        parser.error('--seed can only be used with --order random')
+
+    if args.canary is not None and args.canary < 1:
+        parser.error('--canary N must be at least 1')
+    if args.batch is not None:
+        if not args.batch.rstrip('%').isdigit() or int(args.batch.rstrip('%')) < 1:
+            parser.error('--batch must be a positive number, or a percentage like 10%')
+        if not args.batch.endswith('%'):
+            args.batch = int(args.batch)
+    if args.max_failure_rate < 0:
+        parser.error('--max-failure-rate can not be negative')
+
     return (args, args.command, extra_args)
 
 
 def _print_handling_newlines(uri, return_code, to_print, header='', strip_whitespace=False, quiet=False, file=sys.stdout):
     """
     Print "to_print" to "file" with the formatting needed to represent it's data
-    properly.
+    properly.  If "to_print" is bytes, it is written to "file" without being
+    decoded.
     """
     if strip_whitespace:
         to_print = to_print.strip()
-    if to_print.count('\n') == 0:
+    binary = isinstance(to_print, bytes) and bytes != str
+    if to_print.count(b'\n' if binary else '\n') == 0:
         sep = ' '
     else:
         sep = '\n'
-    output_str = 'sshm: {header}{uri}({return_code}):{sep}{to_print}'
+    output_str = 'sshm: {header}{uri}({return_code}):{sep}'
     if quiet:
-        output_str = '{to_print}'
-    print(output_str.format(header=header,
+        output_str = ''
+    output_str = output_str.format(header=header,
         uri=uri,
         return_code=return_code,
-        sep=sep,
-        to_print=to_print), file=file)
+        sep=sep)
+    if binary:
+        # Write directly to the underlying binary buffer, after anything that
+        # has already been printed.
+        file.flush()
+        file = getattr(file, 'buffer', file)
+        file.write(output_str.encode() + to_print + b'\n')
+        file.flush()
+    else:
+        print(output_str + to_print, file=file)
+
+
+def _print_result(result, args, stdout=None, stderr=None):
+    """
+    Print everything a result contains, as requested by the console arguments.
+    """
+    stdout = stdout or sys.stdout
+    stderr = stderr or sys.stderr
+    if result.get('alias_of') and not args.quiet:
+        _print_handling_newlines(result['uri'],
+                'alias',
+                'same address as {}'.format(result['alias_of']),
+                file=stdout,
+                )
+    # Each step of a script is printed as it would be printed on its own
+    for number, step in enumerate(result.get('steps', []), 1):
+        _print_result(dict(step, uri='[{}] {}'.format(number, result['uri'])), args,
+                stdout, stderr)
+    if result.get('stdout') != None:
+        _print_handling_newlines(result['uri'],
+                result['return_code'],
+                result['stdout'],
+                strip_whitespace=args.strip_whitespace,
+                quiet=args.quiet,
+                file=stdout,
+                )
+    # Output written to files is represented by its path and size
+    if result.get('stdout_path'):
+        _print_handling_newlines(result['uri'],
+                result['return_code'],
+                '{} ({} bytes)'.format(result['stdout_path'], result['stdout_size']),
+                quiet=args.quiet,
+                file=stdout,
+                )
+    if result.get('stderr_size'):
+        _print_handling_newlines(result['uri'],
+                result['return_code'],
+                '{} ({} bytes)'.format(result['stderr_path'], result['stderr_size']),
+                'Error: ',
+                quiet=args.quiet,
+                file=stderr,
+                )
+    if result.get('stderr'):
+        _print_handling_newlines(result['uri'],
+                result.get('return_code', ''),
+                result['stderr'],
+                'Error: ',
+                strip_whitespace=args.strip_whitespace,
+                quiet=args.quiet,
+                file=stderr,
+                )
+    if result.get('traceback'):
+        _print_handling_newlines(result['uri'],
+                result.get('return_code', ''),
+                result['traceback'],
+                'Traceback: ',
+                strip_whitespace=args.strip_whitespace,
+                quiet=args.quiet,
+                file=stderr,
+                )
+
+
+class _InlineWriter(object):
+    """
+    Write outputs with every line prefixed by its uri, like pdsh.  The lines
+    are prefixed as bytes, all at once, and written in batches of at least
+    "size" bytes, or once "interval" seconds have passed since the last write.
+    """
+
+    def __init__(self, file, size=1048576, interval=0.2, clock=time.time):
+        self.file = file
+        self.size = size
+        self.interval = interval
+        self.clock = clock
+        self.pending = []
+        self.pending_size = 0
+        self.last_write = clock()
+
+
+    def write(self, uri, output):
+        """
+        Write each line of "output", bytes or text, prefixed by "uri".
+        """
+        if not output:
+            return
+        if not isinstance(output, bytes):
+            output = output.encode('utf-8', 'replace')
+        prefix = uri.encode('utf-8') + b': '
+        if output.endswith(b'\n'):
+            output = output[:-1]
+        output = prefix + output.replace(b'\n', b'\n' + prefix) + b'\n'
+        self.pending.append(output)
+        self.pending_size += len(output)
+        if self.pending_size >= self.size or self.clock() - self.last_write >= self.interval:
+            self.flush()
+
+
+    def flush(self):
+        """
+        Write everything that is pending.
+        """
+        if self.pending:
+            # Anything printed before should be written first
+            self.file.flush()
+            getattr(self.file, 'buffer', self.file).write(b''.join(self.pending))
+            self.pending = []
+            self.pending_size = 0
+        self.file.flush()
+        self.last_write = self.clock()
+
+
+def _print_inline(result, args, stdout, stderr):
+    """
+    Print everything a result contains using _InlineWriters, every line is
+    prefixed by the uri.
+    """
+    uri = result['uri']
+    if result.get('alias_of'):
+        stderr.write(uri, 'same address as {}'.format(result['alias_of']))
+    for number, step in enumerate(result.get('steps', []), 1):
+        _print_inline(dict(step, uri='[{}] {}'.format(number, uri)), args, stdout, stderr)
+    for name, writer in (('stdout', stdout), ('stderr', stderr), ('traceback', stderr)):
+        output = result.get(name)
+        if output and args.strip_whitespace:
+            output = output.strip()
+        writer.write(uri, output)
+    if result.get('return_code'):
+        stderr.write(uri, 'sshm: return code {}'.format(result['return_code']))
+
+
+class _Progress(object):
+    """
+    Display a single, continually updated, progress line.  The line is redrawn
+    at most once every "interval" seconds.  The amount of running connections
+    is unknown until set_running is called.
+    """
+
+    def __init__(self, total, file=sys.stderr, interval=0.5, clock=time.time):
+        self.total = total
+        self.running = None
+        self.file = file
+        self.interval = interval
+        self.clock = clock
+        self.completed = 0
+        self.failures = 0
+        self.start = self.last_draw = clock()
+
+
+    def line(self):
+        """
+        Get the current progress line.
+        """
+        remaining = max(self.total - self.completed, 0)
+        elapsed = max(self.clock() - self.start, 1e-9)
+        rate = self.completed / elapsed
+        eta = '{:.0f}s'.format(remaining / rate) if rate else '?'
+        return 'sshm: {}/{} done, {} running, {} failed, {:.1f} hosts/s, ETA {}'.format(
+                self.completed, self.total, '?' if self.running is None else self.running,
+                self.failures, rate, eta)
+
+
+    def set_running(self, running):
+        """
+        Set the amount of running connections, see the on_running of sshm.
+        """
+        self.running = running
+
+
+    def update(self, result):
+        """
+        Count a finished result, redraw the line if it is time to.
+        """
+        self.completed += 1
+        if result.get('return_code') or result.get('traceback'):
+            self.failures += 1
+        now = self.clock()
+        if now - self.last_draw >= self.interval:
+            self.last_draw = now
+            self.file.write('\r' + self.line() + '\x1b[K')
+            self.file.flush()
+
+
+    def finish(self):
+        """
+        Draw the final line.
+        """
+        self.file.write('\r' + self.line() + '\x1b[K\n')
+        self.file.flush()
+
+
+def _with_progress(results, progress):
+    """
+    Update "progress" with each result as it is yielded.
+    """
+    for result in results:
+        progress.update(result)
+        yield result
+    progress.finish()
+
+
+class _Quantile(object):
+    """
+    Get the quantile "p" (0 to 1) of a stream of numbers.  The first "exact"
+    numbers are kept, the quantile is exact until there are more.  Then it is
+    estimated in constant memory, using the P-square algorithm of Jain and
+    Chlamtac.  Five markers are kept, the middle marker estimates the
+    quantile.
+    """
+
+    def __init__(self, p, exact=1000):
+        self.p = p
+        self.exact = max(exact, 5)
+        self.values = []
+        self.heights = []
+        self.positions = []
+        self.desired = []
+        self.increments = [0, p / 2.0, p, (1 + p) / 2.0, 1]
+
+
+    def _place_markers(self):
+        """
+        Place the markers on the sorted numbers that were kept, then forget
+        the numbers.
+        """
+        values = sorted(self.values)
+        count = len(values)
+        self.desired = [1 + (count - 1) * i for i in self.increments]
+        # The positions are distinct, the extreme markers are the extremes
+        self.positions = [1]
+        for i, desired in enumerate(self.desired[1:], 1):
+            self.positions.append(min(max(int(round(desired)), self.positions[-1] + 1),
+                count - 4 + i))
+        self.heights = [values[i - 1] for i in self.positions]
+        self.values = None
+
+
+    def add(self, x):
+        """
+        Add the number "x" to the stream.
+        """
+        if self.values is not None:
+            self.values.append(x)
+            if len(self.values) > self.exact:
+                self._place_markers()
+            return
+        q, n = self.heights, self.positions
+        # Find the cell of x, extending the extreme markers when needed
+        if x < q[0]:
+            q[0] = x
+            k = 0
+        elif x >= q[4]:
+            q[4] = x
+            k = 3
+        else:
+            k = [i for i in range(1, 5) if x < q[i]][0] - 1
+        for i in range(k + 1, 5):
+            n[i] += 1
+        for i in range(5):
+            self.desired[i] += self.increments[i]
+        # Move the middle markers towards their desired positions
+        for i in (1, 2, 3):
+            d = self.desired[i] - n[i]
+            if (d >= 1 and n[i + 1] - n[i] > 1) or (d <= -1 and n[i - 1] - n[i] < -1):
+                d = 1 if d > 0 else -1
+                height = q[i] + float(d) / (n[i + 1] - n[i - 1]) * (
+                        (n[i] - n[i - 1] + d) * (q[i + 1] - q[i]) / float(n[i + 1] - n[i]) +
+                        (n[i + 1] - n[i] - d) * (q[i] - q[i - 1]) / float(n[i] - n[i - 1]))
+                if not q[i - 1] < height < q[i + 1]:
+                    # The parabola overshot, use a linear estimate
+                    height = q[i] + d * (q[i + d] - q[i]) / float(n[i + d] - n[i])
+                q[i] = height
+                n[i] += d
+
+
+    def value(self):
+        """
+        Get the quantile, it is exact until more than "exact" numbers have
+        been added.  None is returned when there are no numbers.
+        """
+        if self.values is not None:
+            if not self.values:
+                return None
+            return sorted(self.values)[int(round(self.p * (len(self.values) - 1)))]
+        return self.heights[2]
+
+
+class _Reduction(object):
+    """
+    Summarize the number printed by each host, in constant memory.  The count,
+    sum, minimum and maximum are exact, the mean and standard deviation are
+    kept using Welford's method, and percentiles are exact for the first
+    thousand hosts, then estimated.  Only the hosts with the "outliers"
+    highest and lowest numbers are kept.
+    """
+
+    percentiles = (50, 90, 99)
+
+    def __init__(self, outliers=5):
+        self.outliers = outliers
+        self.count = 0
+        self.total = 0
+        self.mean = 0.0
+        self.squares = 0.0
+        self.highest = []
+        self.lowest = []
+        self.quantiles = [_Quantile(i / 100.0) for i in self.percentiles]
+        self.failed = 0
+        self.invalid = 0
+
+
+    def add(self, result):
+        """
+        Add the number printed by the host of "result".  Failed results, and
+        results that are not a number, are only counted.
+        """
+        if result.get('return_code') or result.get('traceback'):
+            self.failed += 1
+            return
+        stdout = result.get('stdout') or ''
+        try:
+            # Integers are kept exact, a float can not hold a large integer
+            value = int(stdout)
+        except ValueError:
+            try:
+                value = float(stdout)
+            except ValueError:
+                self.invalid += 1
+                return
+        self.count += 1
+        self.total += value
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.squares += delta * (value - self.mean)
+        for quantile in self.quantiles:
+            quantile.add(value)
+        # Heaps of the highest and lowest values, their smallest is replaced
+        uri = result['uri']
+        for heap, key in ((self.highest, value), (self.lowest, -value)):
+            if len(heap) < self.outliers:
+                heapq.heappush(heap, (key, uri))
+            elif key > heap[0][0]:
+                heapq.heapreplace(heap, (key, uri))
+
+
+    def lines(self):
+        """
+        Get the lines of the summary.
+        """
+        lines = ['{} hosts, {} failed, {} did not print a number'.format(
+            self.count + self.failed + self.invalid, self.failed, self.invalid)]
+        if not self.count:
+            return lines
+        deviation = math.sqrt(self.squares / self.count)
+        highest = sorted(self.highest, reverse=True)
+        lowest = sorted(self.lowest, reverse=True)
+        lines.extend([
+            'sum {:g}, mean {:g}, standard deviation {:g}'.format(self.total, self.mean, deviation),
+            'min {:g} ({}), max {:g} ({})'.format(-lowest[0][0], lowest[0][1],
+                highest[0][0], highest[0][1]),
+            ', '.join('p{} {:g}'.format(p, quantile.value())
+                for p, quantile in zip(self.percentiles, self.quantiles)),
+            'highest: ' + ', '.join('{} ({:g})'.format(uri, value) for value, uri in highest),
+            'lowest: ' + ', '.join('{} ({:g})'.format(uri, -value) for value, uri in lowest),
+            ])
+        return lines
+
+
+def _report_profile(profile, path=None, most_common=10):
+    """
+    Print what "profile" measured on stderr, or write it to "path" as JSON.
+    """
+    if path:
+        with open(path, 'w') as file:
+            json.dump(profile.report(), file, indent=2, sort_keys=True)
+        return
+    for line in profile.lines():
+        print('sshm: profile: ' + line, file=sys.stderr)
+    for stack, count in heapq.nlargest(most_common, profile.samples.items(),
+            key=lambda i: i[1]):
+        print('sshm: profile: {} samples: {}'.format(count, stack), file=sys.stderr)
+
+
+def _read_script(path):
+    """
+    Read the commands of a script, one command for each line.  Empty lines and
+    lines starting with # are skipped.
+    """
+    with open(path) as file:
+        lines = [line.strip() for line in file]
+    return [line for line in lines if line and not line.startswith('#')]
+
+
+def _until_aborted(results, aborts):
+    """
+    Yield each result, until a RollingAbort is raised.  It is appended to
+    "aborts" instead of being raised.
+    """
+    try:
+        for result in results:
+            yield result
+    except RollingAbort as abort:
+        aborts.append(abort)
 
 
 def main():
@@ -106,41 +636,108 @@ def main():
         stdin = r_list[0]
     else:
         stdin = None
+    if args.fanout and not stdin:
+        print('sshm: error: --fanout requires stdin', file=sys.stderr)
+        sys.exit(2)
+    if args.daemon and not os.path.exists(default_socket()):
+        print('sshm: error: no daemon is listening on {}, start one with sshmd'.format(
+            default_socket()), file=sys.stderr)
+        sys.exit(2)
+
+    # Which servers are connected to, how, in which order and how many at once.
+    # They may be resolved, probed and have their keys scanned first.
+    scheduling = {'transport':args.transport, 'exclude':args.exclude,
+            'intersect':args.intersect, 'order':args.order, 'seed':args.seed,
+            'resolve':args.resolve, 'probe':args.probe,
+            'prefetch_hostkeys':args.prefetch_hostkeys, 'batch':args.batch,
+            'canary':args.canary, 'max_failure_rate':args.max_failure_rate,
+            'history':default_history() if args.history else None}
+
+    # Measure sshm while it runs, see --profile and --progress
+    instruments = {}
+    profile = Profile(args.profile_interval) if args.profile else None
+    if profile:
+        profile.start()
+        instruments['profile'] = profile
+    progress = None
+    if args.progress:
+        # Excluded and repeated targets are not counted
+        total = sum(1 for i in uri_expansion(args.servers, args.exclude,
+            intersect=args.intersect))
+        progress = _Progress(total)
+        instruments['on_running'] = progress.set_running
 
     # Perform the command on each server, print the results to stdout.
-    results = sshm(args.servers, command, extra_arguments, stdin, args.disable_formatting, args.workers)
-    # If a sorted output is requested, gather all results before output.
-    if args.sorted_output:
+    if args.gather:
+        results = gather(args.servers, command, args.gather, extra_arguments,
+                args.compress, args.workers, encoding=None, **dict(scheduling, **instruments))
+    elif args.fanout:
+        # The order of a tree does not matter
+        results = fanout(args.servers, command, stdin, extra_arguments,
+                args.disable_formatting, args.workers, args.fanout, encoding=None,
+                exclude=args.exclude, intersect=args.intersect)
+    elif args.script:
+        results = script(args.servers, args.commands, extra_arguments, stdin,
+                args.disable_formatting, args.workers, args.stop_on_failure,
+                encoding=None, compress=args.compress, **dict(scheduling, **instruments))
+    elif args.output_dir:
+        # Each uri is only executed once, so its output files are only
+        # written by one ssh process.
+        output_dir = escape_formatting(args.output_dir)
+        results = sshm(args.servers, command, extra_arguments, stdin,
+                args.disable_formatting, args.workers,
+                stdout_path=os.path.join(output_dir, '{uri}.out'),
+                stderr_path=os.path.join(output_dir, '{uri}.err'),
+                **dict(scheduling, **instruments))
+    elif args.daemon:
+        results = submit(args.servers, command, extra_arguments, stdin,
+                args.disable_formatting, args.workers, encoding=None,
+                compress=args.compress, **scheduling)
+    else:
+        # Output is written as it was received, it is never decoded.
+        results = sshm(args.servers, command, extra_arguments, stdin,
+                args.disable_formatting, args.workers, encoding=None,
+                compress=args.compress, **dict(scheduling, **instruments))
+    if args.store:
+        results = Store().record(results, args.servers, command)
+    # A rolling execution that stops early is reported after its results
+    aborts = []
+    results = _until_aborted(results, aborts)
+    if progress:
+        results = _with_progress(results, progress)
+
+    # If a sorted output is requested, gather all results before output.  A
+    # summary does not need to be sorted.
+    if args.sorted_output and not args.reduce:
         results = list(results)
         results = sorted(results, key=lambda x: x['uri'])
 
     exit_code = 0
+    reduction = _Reduction() if args.reduce else None
+    if args.inline:
+        inline = (_InlineWriter(sys.stdout), _InlineWriter(sys.stderr))
     for result in results:
         exit_code = exit_code or result.get('return_code')
-        if result.get('stdout') != None:
-            _print_handling_newlines(result['uri'],
-                    result['return_code'],
-                    result['stdout'],
-                    strip_whitespace=args.strip_whitespace,
-                    quiet=args.quiet,
-                    )
-        if result.get('stderr'):
-            _print_handling_newlines(result['uri'],
-                    result.get('return_code', ''),
-                    result['stderr'],
-                    'Error: ',
-                    strip_whitespace=args.strip_whitespace,
-                    quiet=args.quiet,
-                    file=sys.stderr,
-                    )
-        if result.get('traceback'):
-            _print_handling_newlines(result['uri'],
-                    result['traceback'],
-                    'Traceback: ',
-                    strip_whitespace=args.strip_whitespace,
-                    quiet=args.quiet,
-                    file=sys.stderr,
-                    )
+        if reduction:
+            reduction.add(result)
+        elif args.inline:
+            _print_inline(result, args, *inline)
+        else:
+            _print_result(result, args)
+    if args.inline:
+        for writer in inline:
+            writer.flush()
+    if reduction:
+        for line in reduction.lines():
+            print('sshm: ' + line)
+
+    for abort in aborts:
+        print('sshm: error: stopped, {}'.format(abort), file=sys.stderr)
+        exit_code = exit_code or 1
+
+    if profile:
+        profile.stop()
+        _report_profile(profile, args.profile_output)
 
     # Exit with non-zero when there is a failure
     sys.exit(exit_code)
@@ -0,0 +1,295 @@
+#! /usr/bin/env python3
+"""
+Keep the results of sshm in a local SQLite database, so they can be queried
+after they have been printed.
+
+Each call of sshm is a run.  Every result of a run is stored with its uri,
+command, return code, outputs and the time it was received.
+"""
+
+from __future__ import print_function
+import os
+import sqlite3
+import sys
+import time
+import uuid
+
+__all__ = ['Store', 'default_store']
+
+# Results are written in one transaction once this many are waiting, or once
+# the oldest has waited this many seconds.
+default_batch = 1000
+default_interval = 1
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    run TEXT PRIMARY KEY,
+    started REAL,
+    command TEXT,
+    servers TEXT
+);
+CREATE TABLE IF NOT EXISTS results (
+    run TEXT,
+    uri TEXT,
+    command TEXT,
+    return_code INTEGER,
+    stdout BLOB,
+    stderr BLOB,
+    traceback TEXT,
+    received REAL,
+    elapsed REAL
+);
+CREATE INDEX IF NOT EXISTS results_by_uri ON results (uri, received);
+CREATE INDEX IF NOT EXISTS results_by_command ON results (command, received);
+CREATE INDEX IF NOT EXISTS results_by_run ON results (run, uri);
+CREATE INDEX IF NOT EXISTS runs_by_command ON runs (command, started);
+'''
+
+_COLUMNS = ('run', 'uri', 'command', 'return_code', 'stdout', 'stderr', 'traceback',
+        'received', 'elapsed')
+
+
+def default_store():
+    """
+    Get the path of the user's database, it is $SSHM_STORE or
+    sshm/results.sqlite in the user's data directory.
+
+    @rtype: str
+    """
+    if os.environ.get('SSHM_STORE'):
+        return os.environ['SSHM_STORE']
+    data = os.environ.get('XDG_DATA_HOME') or os.path.expanduser('~/.local/share')
+    return os.path.join(data, 'sshm', 'results.sqlite')
+
+
+def _output(result, name):
+    """
+    Get an output of a result as it is stored, the size of an output written
+    to a file is stored instead.
+    """
+    if result.get(name + '_path'):
+        return '{} ({} bytes)'.format(result[name + '_path'], result[name + '_size'])
+    output = result.get(name)
+    if isinstance(output, bytes) and bytes != str:
+        return sqlite3.Binary(output)
+    return output
+
+
+class Store(object):
+    """
+    A database of results.
+    """
+
+    def __init__(self, path=None, batch=default_batch, interval=default_interval,
+            clock=time.time):
+        path = path or default_store()
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.connection = sqlite3.connect(path)
+        # Many processes may write results at once
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.executescript(_SCHEMA)
+        self.batch = batch
+        self.interval = interval
+        self.clock = clock
+
+
+    def close(self):
+        self.connection.close()
+
+
+    def record(self, results, servers, command, run=None):
+        """
+        Store each result as it is yielded.  The results are written in
+        batches, the last batch is written when "results" ends.
+
+        @param results: The results of sshm, or of anything that uses sshm.
+        @type results: iterable
+
+        @param servers: The servers of the run.
+        @type servers: list
+
+        @param command: The command of the run.
+        @type command: str
+
+        @param run: The name of the run, a new name is created by default.
+        @type run: str
+        """
+        started = self.clock()
+        if not run:
+            run = time.strftime('%Y%m%d-%H%M%S-', time.localtime(started)) + uuid.uuid4().hex[:6]
+        with self.connection:
+            self.connection.execute('INSERT INTO runs VALUES (?, ?, ?, ?)',
+                    (run, started, command, ','.join(servers)))
+        waiting = []
+        written = started
+        try:
+            for result in results:
+                received = self.clock()
+                # Each step of a script is stored as a result of its command
+                for step in [dict(result, command=command)] + result.get('steps', []):
+                    waiting.append((run, result['uri'], step['command'],
+                        step.get('return_code'), _output(step, 'stdout'),
+                        _output(step, 'stderr'), step.get('traceback'), received,
+                        received - started))
+                if len(waiting) >= self.batch or received - written >= self.interval:
+                    self._write(waiting)
+                    waiting = []
+                    written = received
+                yield result
+        finally:
+            self._write(waiting)
+
+
+    def _write(self, rows):
+        """
+        Insert "rows" in one transaction.
+        """
+        if rows:
+            with self.connection:
+                self.connection.executemany(
+                        'INSERT INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+
+
+    def runs(self, command=None, limit=None):
+        """
+        Get the runs, the latest first, as dictionaries.  Only the runs of
+        "command" are returned when it is provided.
+        """
+        query = 'SELECT run, started, command, servers FROM runs'
+        arguments = []
+        if command is not None:
+            query += ' WHERE command = ?'
+            arguments.append(command)
+        query += ' ORDER BY started DESC'
+        if limit:
+            query += ' LIMIT ?'
+            arguments.append(limit)
+        names = ('run', 'started', 'command', 'servers')
+        return [dict(zip(names, row)) for row in self.connection.execute(query, arguments)]
+
+
+    def results(self, uri=None, command=None, run=None, limit=None):
+        """
+        Get the stored results, the latest first, as dictionaries.  They are
+        limited to the provided uri, command and run.
+        """
+        conditions = []
+        arguments = []
+        for column, value in (('uri', uri), ('command', command), ('run', run)):
+            if value is not None:
+                conditions.append(column + ' = ?')
+                arguments.append(value)
+        query = 'SELECT {} FROM results'.format(', '.join(_COLUMNS))
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        query += ' ORDER BY received DESC'
+        if limit:
+            query += ' LIMIT ?'
+            arguments.append(limit)
+        return [dict(zip(_COLUMNS, row)) for row in self.connection.execute(query, arguments)]
+
+
+    def changed(self, command, before=None, after=None):
+        """
+        Compare the results of "command" in two runs, by default its latest
+        two runs.  The command may be a step of a script.  Get (uri, result
+        before, result after) for each uri whose output or return code
+        changed, a result is None when the uri was not in that run.
+        """
+        if before is None or after is None:
+            latest = [row[0] for row in self.connection.execute('SELECT run FROM results'
+                ' WHERE command = ? GROUP BY run ORDER BY MAX(received) DESC LIMIT 2',
+                (command,))]
+            if len(latest) < 2:
+                raise ValueError('"{}" has not been run twice'.format(command))
+            after, before = latest
+        before = dict((i['uri'], i) for i in self.results(command=command, run=before))
+        after = dict((i['uri'], i) for i in self.results(command=command, run=after))
+        changes = []
+        for uri in sorted(set(before) | set(after)):
+            old, new = before.get(uri), after.get(uri)
+            if not old or not new or any(old[i] != new[i]
+                    for i in ('return_code', 'stdout', 'stderr')):
+                changes.append((uri, old, new))
+        return changes
+
+
+def _text(output):
+    """
+    Decode a stored output for printing.
+    """
+    if isinstance(output, (bytes, bytearray)) and bytes != str:
+        return bytes(output).decode('utf-8', 'replace')
+    return output or ''
+
+
+def _print_stored(result, file=None):
+    """
+    Print a stored result like sshm prints it, preceded by its run.
+    """
+    file = file or sys.stdout
+    if result is None:
+        print('  (not run)', file=file)
+        return
+    output = _text(result['stdout']).rstrip('\n')
+    sep = '\n' if '\n' in output else ' '
+    print('{}: {}({}):{}{}'.format(result['run'], result['uri'], result['return_code'],
+        sep, output), file=file)
+    for name in ('stderr', 'traceback'):
+        if result[name]:
+            print('{}: {}({}): {}: {}'.format(result['run'], result['uri'],
+                result['return_code'], name, _text(result[name]).rstrip('\n')), file=file)
+
+
+def main(args=None):
+    """
+    Query the results stored by "sshm --store" using console provided
+    arguments.
+
+    This should only be run using a console!
+    """
+    import argparse
+    parser = argparse.ArgumentParser(description='Query the results stored by "sshm --store".')
+    parser.add_argument('--db', default=None,
+            help='The database to query, defaults to $SSHM_STORE or {}.'.format(default_store()))
+    parser.add_argument('--host', default=None, metavar='URI',
+            help='Only show the results of this uri.')
+    parser.add_argument('--command', default=None,
+            help='Only show the results of this command.')
+    parser.add_argument('--run', default=None,
+            help='Only show the results of this run.')
+    parser.add_argument('-n', '--limit', type=int, default=None,
+            help='Show at most this many results (or runs).')
+    parser.add_argument('--runs', action='store_true', default=False,
+            help='List the runs instead of their results.')
+    parser.add_argument('--changed', default=None, metavar='COMMAND',
+            help='Show the uris whose result of COMMAND changed between its last two runs.')
+    args = parser.parse_args(args)
+
+    store = Store(args.db)
+    try:
+        if args.runs:
+            for run in store.runs(args.command, args.limit):
+                print('{} {} {} {}'.format(run['run'],
+                    time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(run['started'])),
+                    run['servers'], run['command']))
+        elif args.changed:
+            try:
+                changes = store.changed(args.changed)
+            except ValueError as error:
+                parser.error(str(error))
+            for uri, before, after in changes:
+                print('{} changed:'.format(uri))
+                _print_stored(before)
+                _print_stored(after)
+        else:
+            for result in store.results(args.host, args.command, args.run, args.limit):
+                _print_stored(result)
+    finally:
+        store.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,33 @@
+"""
+A local asyncssh server for the asyncssh transport's tests.  This module uses
+Python 3 syntax, it is only imported when asyncssh is installed.
+"""
+import asyncssh
+
+
+class Server(asyncssh.SSHServer):
+    """
+    Accept every user without authentication.
+    """
+
+    def begin_auth(self, username):
+        return False
+
+
+
+async def handle(process):
+    """
+    Echo the command and stdin, and exit with the length of the command.
+    """
+    stdin = await process.stdin.read()
+    process.stdout.write(process.command.encode() + b':' + stdin)
+    process.stderr.write(b'error')
+    process.exit(len(process.command))
+
+
+async def listen(key):
+    """
+    Listen on a free port of 127.0.0.1 using the host key "key".
+    """
+    return await asyncssh.listen('127.0.0.1', 0, server_factory=Server,
+            server_host_keys=[key], process_factory=handle, encoding=None)
@@ -0,0 +1,89 @@
+#! /usr/bin/env python3
+"""
+This module tests the asyncssh transport against a local asyncssh server.
+"""
+from sshm import lib
+
+from io import BytesIO
+import os
+import shutil
+import tempfile
+import unittest
+try:
+    import asyncssh
+    from sshm import asyncssh_transport
+    from sshm.test import asyncssh_server
+except (ImportError, SyntaxError):
+    asyncssh = None
+
+
+@unittest.skipUnless(asyncssh, 'asyncssh is not installed')
+class Test_asyncssh_transport(unittest.TestCase):
+
+
+    def setUp(self):
+        # The server's key is the only known host of a new home directory
+        home = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, home)
+        self.addCleanup(os.environ.__setitem__, 'HOME', os.environ['HOME'])
+        os.environ['HOME'] = home
+        key = asyncssh.generate_private_key('ssh-ed25519')
+        self.server = asyncssh_transport._run(asyncssh_server.listen(key))
+        self.addCleanup(asyncssh_transport._run, self.server.wait_closed())
+        self.addCleanup(self.server.close)
+        self.port = self.server.sockets[0].getsockname()[1]
+        os.mkdir(os.path.join(home, '.ssh'))
+        self.known_hosts = os.path.join(home, '.ssh', 'known_hosts')
+        with open(self.known_hosts, 'wb') as file:
+            file.write('[127.0.0.1]:{} '.format(self.port).encode() +
+                    key.export_public_key())
+
+
+    def test_sshm(self):
+        """
+        The results are the same as the results of the ssh client.
+        """
+        uri = 'user@127.0.0.1:{}'.format(self.port)
+        results = list(lib.sshm(uri, 'echo {num}', stdin=BytesIO(b'in'), transport='asyncssh'))
+        self.assertEqual(len(results), 1)
+        result = results[0]
+        self.assertEqual(result['return_code'], 6)
+        self.assertEqual(result['stdout'], 'echo 0:in')
+        self.assertEqual(result['stderr'], 'error')
+        self.assertEqual(result['cmd'], ['asyncssh', 'user@127.0.0.1', '-p', str(self.port),
+            'echo 0'])
+        self.assertNotIn('traceback', result)
+
+        # Output written to files
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        result, = lib.sshm(uri, 'ls', transport='asyncssh',
+                stdout_path=os.path.join(directory, 'out'),
+                stderr_path=os.path.join(directory, 'err'))
+        self.assertEqual((result['stdout_size'], result['stderr_size']), (3, 5))
+
+
+    def test_failures(self):
+        """
+        Connection failures are reported like the ssh client reports them.
+        """
+        os.remove(self.known_hosts)
+        result, = lib.sshm('127.0.0.1:{}'.format(self.port), 'ls', transport='asyncssh')
+        self.assertEqual(result['return_code'], 255)
+        self.assertIn('Host key is not trusted', result['stderr'])
+
+        self.server.close()
+        result, = lib.sshm('127.0.0.1:{}'.format(self.port), 'ls', transport='asyncssh')
+        self.assertEqual(result['return_code'], 255)
+        self.assertEqual(result['stderr'],
+                'ssh: connect to host 127.0.0.1 port {}: Connection refused\n'.format(self.port))
+
+        # ssh arguments can not be used
+        result, = lib.sshm('127.0.0.1', 'ls', ['-v'], transport='asyncssh')
+        self.assertIn('does not accept ssh arguments', result['traceback'])
+        self.assertEqual(result['cmd'], ['asyncssh', '127.0.0.1', 'ls'])
+
+
+
+if __name__ == '__main__':
+    unittest.main()
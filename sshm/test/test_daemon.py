@@ -0,0 +1,136 @@
+#! /usr/bin/env python3
+"""
+This module tests the sshm daemon without performing a real ssh command.
+"""
+from sshm import lib, daemon
+
+from mock import MagicMock
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import zmq
+
+
+class Test_daemon(unittest.TestCase):
+
+
+    def setUp(self):
+        self.running = 0
+        self.most_running = 0
+        self.lock = threading.Lock()
+        def side_effect(thread_num, context, uri, command, extra_arguments, if_stdin, **kw):
+            """
+            Count the ssh calls that run at the same time, and fail on a
+            server named "fail".
+            """
+            with self.lock:
+                self.running += 1
+                self.most_running = max(self.most_running, self.running)
+            time.sleep(0.02)
+            with self.lock:
+                self.running -= 1
+            sink = context.socket(zmq.PUSH)
+            sink.connect(lib.SINK_URL)
+            sink.send_pyobj({'thread_num':thread_num, 'uri':uri,
+                'return_code':int(uri.startswith('fail')), 'cmd':extra_arguments})
+            sink.close()
+        self.addCleanup(setattr, lib, 'ssh', lib.ssh)
+        lib.ssh = MagicMock(side_effect=side_effect)
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'sshm.sock')
+
+
+    def start(self, workers=2, control_persist=60):
+        thread = threading.Thread(target=daemon.serve, args=(self.path, workers, control_persist))
+        thread.start()
+        while not os.path.exists(self.path):
+            time.sleep(0.01)
+        self.addCleanup(thread.join)
+        self.addCleanup(daemon.shutdown, self.path)
+
+
+    def test_submit(self):
+        """
+        The results of a job are sent back to its client, each ssh call reuses
+        the daemon's master connections.
+        """
+        self.start()
+        results = list(daemon.submit('example[1-3].com', 'foo', ['-oFoo=yes'], path=self.path))
+        self.assertEqual(sorted(i['uri'] for i in results),
+                ['example1.com', 'example2.com', 'example3.com'])
+        arguments = results[0]['cmd']
+        self.assertEqual(arguments[0], '-oControlMaster=auto')
+        self.assertTrue(arguments[1].startswith('-oControlPath='))
+        self.assertEqual(arguments[2:], ['-oControlPersist=60', '-oFoo=yes'])
+
+        # The options of a job are passed to sshm
+        results = list(daemon.submit('example[1-5].com', 'foo', path=self.path,
+            exclude='example[2-4].com'))
+        self.assertEqual(sorted(i['uri'] for i in results), ['example1.com', 'example5.com'])
+
+
+    def test_no_control_persist(self):
+        """
+        Master connections can be disabled.
+        """
+        self.start(control_persist=0)
+        results = list(daemon.submit('example.com', 'foo', ['-oFoo=yes'], path=self.path))
+        self.assertEqual(results[0]['cmd'], ['-oFoo=yes'])
+
+
+    def test_shared_workers(self):
+        """
+        Concurrent jobs share the daemon's limit of ssh connections.
+        """
+        self.start(workers=2)
+        jobs = [daemon.submit('example[1-6].com', 'foo', workers=5, path=self.path)
+                for i in range(3)]
+        results = []
+        threads = [threading.Thread(target=lambda job: results.extend(job), args=(job,))
+                for job in jobs]
+        [i.start() for i in threads]
+        [i.join() for i in threads]
+        self.assertEqual(len(results), 18)
+        self.assertEqual(self.most_running, 2)
+
+
+    def test_errors(self):
+        """
+        A stopped rolling job, and a job that fails, are raised by the client.
+        """
+        self.start()
+        results = []
+        def run(*a, **kw):
+            for result in daemon.submit(*a, path=self.path, **kw):
+                results.append(result)
+        with self.assertRaises(lib.RollingAbort) as context:
+            run('fail1.com,example[1-3].com', 'foo', canary=1)
+        self.assertEqual(context.exception.remaining, 'example[1-3].com')
+        self.assertEqual([i['uri'] for i in results], ['fail1.com'])
+
+        self.assertRaises(RuntimeError, run, ['example.com', ''], 'foo')
+
+
+    def test_no_daemon(self):
+        """
+        A client fails when there is no daemon.
+        """
+        self.assertRaises(OSError, list, daemon.submit('example.com', 'foo', path=self.path))
+
+
+    def test_default_socket(self):
+        self.addCleanup(os.environ.pop, 'SSHM_SOCKET', None)
+        os.environ['SSHM_SOCKET'] = '/foo/bar.sock'
+        self.assertEqual(daemon.default_socket(), '/foo/bar.sock')
+        del os.environ['SSHM_SOCKET']
+        self.assertTrue(daemon.default_socket().endswith('sshm-{}.sock'.format(os.getuid())))
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,7 +5,8 @@ command.
 """
 from sshm import lib
 
-from mock import MagicMock
+from mock import MagicMock, patch
+import os
 import unittest
 import zmq
 
@@ -57,7 +58,7 @@ class TestFuncs(unittest.TestCase):
                 ('foo@example[11-13,17].com:1234,root@1.2,5-7.3.4:1234', ['foo@example11.com:1234', 'foo@example12.com:1234', 'foo@example13.com:1234', 'foo@example17.com:1234', 'root@1.2.3.4:1234', 'root@1.5.3.4:1234', 'root@1.6.3.4:1234', 'root@1.7.3.4:1234']),
                 ('10.1.1.1,10.1.1.2', ['10.1.1.1', '10.1.1.2']),
                 ('10.1.1.1,3,10.1.1.5', ['10.1.1.1', '10.1.1.3', '10.1.1.5']),
-                ('10.1.1.1,3,10.1.1.5,root@example[01-2].com,10-11.1.1.1-5', ['10.1.1.1', '10.1.1.3', '10.1.1.5', 'root@example01.com', 'root@example02.com', '10.1.1.1', '10.1.1.2', '10.1.1.3', '10.1.1.4', '10.1.1.5', '11.1.1.1', '11.1.1.2', '11.1.1.3', '11.1.1.4', '11.1.1.5']),
+                ('10.1.1.1,3,10.1.1.5,root@example[01-2].com,10-11.1.1.1-5', ['10.1.1.1', '10.1.1.3', '10.1.1.5', 'root@example01.com', 'root@example02.com', '10.1.1.2', '10.1.1.4', '11.1.1.1', '11.1.1.2', '11.1.1.3', '11.1.1.4', '11.1.1.5']),
                 ]
 
         for provided, expected in prov_exp:
@@ -161,6 +162,14 @@ class Test_ssh(unittest.TestCase):
 
         self.assertIn('traceback', results)
         self.assertIn('Oh no!', results['traceback'])
+        socket.reset_mock()
+
+        # The command is reported when it could not be started
+        sub.popen.side_effect = OSError('No such file or directory')
+        lib.ssh(1, context, 'foo:22', 'command', ['-v'])
+        results = socket.send_pyobj.call_args_list[0][0][0]
+        self.assertIn('No such file or directory', results['traceback'])
+        self.assertEqual(results['cmd'], ['ssh', '-v', 'foo', '-p', '22', 'command'])
 
 
     def test_formatting(self):
@@ -215,9 +224,7 @@ class Test_ssh(unittest.TestCase):
         socket.reset_mock()
 
         # Disable formatting
-        self.addCleanup(setattr, lib, 'disable_formatting', lib.disable_formatting)
-        lib.disable_formatting = True
-        lib.ssh(1, context, 'foo', 'command{bad}', [])
+        lib.ssh(1, context, 'foo', 'command{bad}', [], disable_formatting=True)
         self.assertNotIn('traceback', socket.send_pyobj.call_args_list[0][0][0])
         cmd = socket.send_pyobj.call_args_list[0][0][0]['cmd']
         self.assertEqual(cmd,
@@ -228,6 +235,34 @@ class Test_ssh(unittest.TestCase):
 
 class Test_sshm(unittest.TestCase):
 
+    def test_popen(self):
+        """
+        Programs are started using their absolute path.
+        """
+        import subprocess
+        self.assertTrue(os.path.isabs(lib._executable('sh')))
+        self.assertIsNone(lib._executable('sshm-does-not-exist'))
+        proc = lib.popen(['sh', '-c', 'echo ok'], subprocess.PIPE, subprocess.PIPE,
+                subprocess.PIPE)
+        self.assertEqual(proc.communicate(), (b'ok\n', b''))
+        self.assertRaises(OSError, lib.popen, ['sshm-does-not-exist'], None, None, None)
+
+        # A change of PATH is followed, a missing program is searched for again
+        import shutil
+        import stat
+        import tempfile
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        program = os.path.join(directory, 'sshm-does-not-exist')
+        with open(program, 'w') as file_handle:
+            file_handle.write('#! /bin/sh\n')
+        os.chmod(program, stat.S_IRWXU)
+        with patch.dict(os.environ, {'PATH':directory}):
+            self.assertEqual(lib._executable('sshm-does-not-exist'), program)
+            self.assertIsNone(lib._executable('sh'))
+        self.assertIsNone(lib._executable('sshm-does-not-exist'))
+
+
     def test_simple(self):
         """
         Test a simple sshm usage.
@@ -282,6 +317,86 @@ class Test_sshm(unittest.TestCase):
                 )
 
 
+    def test_stdin_workers(self):
+        """
+        Serving stdin does not disturb the numbering of threads when there are
+        more servers than workers.
+        """
+        sub, proc = fake_subprocess('', '', 0)
+        self.addCleanup(setattr, lib, 'popen', lib.popen)
+        lib.popen = sub.popen
+
+        from io import BytesIO
+        stdin = BytesIO(b'foobar')
+        result_list = list(lib.sshm('example[1-6].com', 'exit', stdin=stdin,
+            workers=2))
+        self.assertEqual(sorted([r['thread_num'] for r in result_list]),
+                list(range(6)))
+
+
+    def test_on_running(self):
+        """
+        The running connections are reported as they start and finish, results
+        that did not connect are not counted.
+        """
+        sub, proc = fake_subprocess('', '', 0)
+        self.addCleanup(setattr, lib, 'popen', lib.popen)
+        lib.popen = sub.popen
+
+        running = []
+        results = list(lib.sshm('example[1-6].com', 'exit', workers=2,
+            on_running=running.append))
+        self.assertEqual(len(results), 6)
+        self.assertEqual(len(running), 12)
+        self.assertEqual(max(running), 2)
+        self.assertEqual(running[-1], 0)
+
+
+    def test_close(self):
+        """
+        When sshm stops early, the slots of its running connections are
+        released and its known_hosts file is removed once they finish.
+        """
+        import threading
+        import time
+        sub, proc = fake_subprocess('', '', 0)
+        def communicate():
+            time.sleep(0.05)
+            return ('', '')
+        proc.communicate.side_effect = communicate
+        self.addCleanup(setattr, lib, 'popen', lib.popen)
+        lib.popen = sub.popen
+
+        def released(slots):
+            acquired = [slots.acquire(False) for i in range(5)]
+            [slots.release() for i in acquired if i]
+            return all(acquired)
+
+        def wait(condition):
+            # The connections are waited for in the background
+            for i in range(200):
+                if condition():
+                    return True
+                time.sleep(0.02)
+            return False
+
+        # Closed by the caller
+        slots = threading.BoundedSemaphore(5)
+        results = lib.sshm('example[1-9].com', 'exit', slots=slots, prefetch_hostkeys=True)
+        known_hosts = next(results)['cmd'][1].split()[-1]
+        results.close()
+        self.assertTrue(wait(lambda: released(slots) and not os.path.exists(known_hosts)))
+
+        # Failed while serving stdin
+        class Stdin(object):
+            def read(self, size):
+                raise IOError('Oh no!')
+        slots = threading.BoundedSemaphore(5)
+        self.assertRaises(IOError, list, lib.sshm('example[1-9].com', 'exit', stdin=Stdin(),
+            slots=slots))
+        self.assertTrue(wait(lambda: released(slots)))
+
+
     def test_triple(self):
         """
         You can SSH into three servers at once.
@@ -351,4 +466,1344 @@ class Test_sshm(unittest.TestCase):
             self.assertTrue(stdin)
 
 
+    def test_concurrent_sshm(self):
+        """
+        sshm calls that run at the same time keep their own results and
+        formatting, and may share a limit of connections.
+        """
+        self.addCleanup(setattr, lib, 'ssh', lib.ssh)
+        def side_effect(thread_num, context, uri, command, *a, **kw):
+            sink = context.socket(zmq.PUSH)
+            sink.connect(lib.SINK_URL)
+            sink.send_pyobj({'thread_num':thread_num, 'uri':uri,
+                'formatting':not kw.get('disable_formatting')})
+            sink.close()
+        lib.ssh = MagicMock(side_effect=side_effect)
+
+        # Consumed together by one thread
+        first = lib.sshm('first[1-20].com', 'foo', disable_formatting_var=True)
+        second = lib.sshm('second[1-20].com', 'foo')
+        results = {'first':[], 'second':[]}
+        for pair in zip(first, second):
+            for result in pair:
+                results[result['uri'][:-5].rstrip('0123456789')].append(result)
+        self.assertEqual(len(results['first']), 20)
+        self.assertEqual(len(results['second']), 20)
+        self.assertFalse(any(i['formatting'] for i in results['first']))
+        self.assertTrue(all(i['formatting'] for i in results['second']))
+
+        # Consumed by their own threads, sharing slots
+        import threading
+        slots = threading.BoundedSemaphore(2)
+        results = {'first':[], 'second':[]}
+        threads = [threading.Thread(target=lambda name, flag: results[name].extend(
+            lib.sshm(name + '[1-20].com', 'foo', disable_formatting_var=flag, slots=slots)),
+            args=(name, name == 'first')) for name in results]
+        [i.start() for i in threads]
+        [i.join() for i in threads]
+        self.assertEqual(len(results['first']), 20)
+        self.assertEqual(len(results['second']), 20)
+        self.assertFalse(any(i['formatting'] for i in results['first']))
+        self.assertTrue(all(i['formatting'] for i in results['second']))
+        # Every slot was released
+        self.assertTrue(slots.acquire(False) and slots.acquire(False))
+
+
+
+class Test_fanout(unittest.TestCase):
+
+    def test_fanout_tree(self):
+        """
+        Uris are split into subtrees, the first uri of each is its root.
+        """
+        prov_exp = [
+                ((['a'], 2), [['a']]),
+                ((['a', 'b'], 2), [['a'], ['b']]),
+                ((['a', 'b', 'c', 'd', 'e'], 2), [['a', 'b', 'c'], ['d', 'e']]),
+                ((['a', 'b', 'c', 'd', 'e'], 1), [['a', 'b', 'c', 'd', 'e']]),
+                (([], 2), []),
+                ]
+        for provided, expected in prov_exp:
+            self.assertEqual(lib.fanout_tree(*provided), expected)
+
+        self.assertRaises(ValueError, lib.fanout_tree, ['a'], 0)
+
+
+    def test_fanout(self):
+        """
+        Only the roots receive stdin, every host then executes the command
+        using the distributed stdin.
+        """
+        calls = []
+        def fake_sshm(servers, command, extra_arguments=None, stdin=None, **kw):
+            calls.append((servers, command, stdin))
+            if len(calls) == 1:
+                return [{'uri':'example1.com', 'return_code':0},
+                        {'uri':'example3.com', 'return_code':255}]
+            return [{'uri':'example1.com', 'return_code':0},]
+        self.addCleanup(setattr, lib, 'sshm', lib.sshm)
+        lib.sshm = fake_sshm
+
+        from io import BytesIO
+        stdin = BytesIO(b'payload')
+        results = list(lib.fanout('example[1-4].com', 'cat > foo', stdin,
+            width=2, path='/tmp/foo'))
+
+        # Only the failed relay and the command's results are yielded
+        self.assertEqual(results, [
+            {'uri':'example3.com', 'return_code':255, 'fanout':True},
+            {'uri':'example1.com', 'return_code':0},
+            ])
+
+        (roots, relay_command, relay_stdin), (uris, command, command_stdin) = calls
+        self.assertEqual(roots, 'example1.com,example3.com')
+        # The roots receive the relay script and the host list before stdin
+        self.assertTrue(relay_command.startswith('d=$(mktemp -d) && dd'))
+        self.assertTrue(relay_command.endswith(' /tmp/foo {num}'))
+        relay_stdin = b''.join(iter(lambda: relay_stdin.read(1000), b''))
+        self.assertTrue(relay_stdin.endswith(
+            b'\nexample1.com example2.com example3.com example4.com\npayload'))
+        self.assertEqual(uris, ['example1.com', 'example2.com', 'example3.com', 'example4.com'])
+        self.assertEqual(command, '(cat > foo) < /tmp/foo; r=$?; rm -f /tmp/foo; exit $r')
+        self.assertIsNone(command_stdin)
+
+        # The path is passed between hosts without quoting
+        self.assertRaises(ValueError, list, lib.fanout('example1.com', 'ls',
+            stdin, path='/tmp/foo bar'))
+
+
+    @unittest.skipIf(os.name != 'posix', 'The relay requires a POSIX shell.')
+    def test_relay(self):
+        """
+        Run the relay using a fake ssh that executes each host's command in its
+        own directory.  Every host receives stdin, no matter how deep it is in
+        the tree.
+        """
+        import shutil
+        import stat
+        import tempfile
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        fake_ssh = os.path.join(root, 'ssh')
+        with open(fake_ssh, 'w') as file_handle:
+            file_handle.write(_FAKE_SSH)
+        os.chmod(fake_ssh, stat.S_IRWXU)
+        environ = patch.dict(os.environ, {'PATH':root + os.pathsep + os.environ['PATH'],
+            'FAKE_SSH_ROOT':root})
+        environ.start()
+        self.addCleanup(environ.stop)
+
+        payload = os.urandom(300000)
+        for count, width in ((5, 2), (13, 3), (30, 3), (9, 1)):
+            from io import BytesIO
+            servers = 'host[1-{}].example.com,user@other.example.com:2222'.format(count)
+            results = list(lib.fanout(servers, 'cat > got', BytesIO(payload),
+                width=width, path='fanout-test', workers=4))
+            self.assertEqual(count + 1, len(results))
+            for result in results:
+                self.assertNotIn('fanout', result)
+                self.assertEqual(result['return_code'], 0, result)
+                host = result['uri'].split('@')[-1].split(':')[0]
+                with open(os.path.join(root, host, 'got'), 'rb') as file_handle:
+                    self.assertEqual(file_handle.read(), payload)
+                os.remove(os.path.join(root, host, 'got'))
+                self.assertFalse(os.path.exists(os.path.join(root, host, 'fanout-test')))
+
+
+
+# Executes the command of each host in FAKE_SSH_ROOT/<host>
+_FAKE_SSH = """#! /bin/sh
+while :; do case $1 in -p) shift 2;; -*) shift;; *) break;; esac; done
+h=${1#*@}; shift
+if [ "$1" = -p ]; then shift 2; fi
+mkdir -p "$FAKE_SSH_ROOT/$h" && cd "$FAKE_SSH_ROOT/$h" && exec sh -c "$*"
+"""
+
+
+class Test_gather(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        import shutil
+        self.outdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.outdir)
+
+
+    def test_stdout_path(self):
+        """
+        The ssh process writes its stdout directly to the requested file.
+        """
+        import os.path
+        sub, proc = fake_subprocess(None, '', 0)
+        self.addCleanup(setattr, lib, 'popen', lib.popen)
+        def popen(cmd, stdin, stdout, stderr):
+            stdout.write(b'file contents')
+            return proc
+        lib.popen = popen
+        context, socket = fake_context()
+
+        lib.ssh(1, context, 'foo:22', 'cat bar', [],
+                stdout_path=os.path.join(self.outdir, '{uri}', 'bar'))
+        result = socket.send_pyobj.call_args_list[0][0][0]
+        path = os.path.join(self.outdir, 'foo:22', 'bar')
+        self.assertNotIn('stdout', result)
+        self.assertEqual(result['stdout_path'], path)
+        self.assertEqual(result['stdout_size'], 13)
+        with open(path, 'rb') as file_handle:
+            self.assertEqual(file_handle.read(), b'file contents')
+
+
+    def test_gather(self):
+        """
+        A file is copied from each server into a directory named after it's uri.
+        """
+        sub, proc = fake_subprocess(None, '', 0)
+        self.addCleanup(setattr, lib, 'popen', lib.popen)
+        lib.popen = sub.popen
+
+        results = list(lib.gather('example[1-2].com', '/var/log/{a}.log',
+            self.outdir))
+        self.assertEqual(2, len(results))
+        for result in results:
+            self.assertEqual(result['cmd'][-1], "cat -- '/var/log/{a}.log'")
+            self.assertEqual(result['stdout_path'],
+                    self.outdir + '/' + result['uri'] + '/{a}.log')
+            self.assertEqual(result['stdout_size'], 0)
+
+        results = list(lib.gather('example1.com', '/var/log/syslog',
+            self.outdir, compress=True))
+        self.assertEqual(results[0]['cmd'][-1], "gzip -c -- /var/log/syslog")
+        self.assertEqual(results[0]['stdout_path'],
+                self.outdir + '/example1.com/syslog.gz')
+
+
+    def test_gather_failure(self):
+        """
+        The file of a failed copy is removed, a path that is not a file is
+        refused.
+        """
+        sub, proc = fake_subprocess(None, b'No such file or directory', 1)
+        self.addCleanup(setattr, lib, 'popen', lib.popen)
+        lib.popen = sub.popen
+
+        results = list(lib.gather('example1.com', '/var/log/missing', self.outdir))
+        self.assertEqual(results[0]['return_code'], 1)
+        self.assertNotIn('stdout_path', results[0])
+        self.assertEqual(os.listdir(self.outdir), [])
+
+        for path in ('/', '/var/log/..', ''):
+            self.assertRaises(ValueError, lib.gather, 'example1.com', path,
+                    self.outdir)
+
+
+
+class Test_output_files(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        import shutil
+        self.outdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.outdir)
+
+
+    def test_stderr_path(self):
+        """
+        Stdout and stderr can both be written directly to files.
+        """
+        import os.path
+        sub, proc = fake_subprocess(None, None, 1)
+        self.addCleanup(setattr, lib, 'popen', lib.popen)
+        def popen(cmd, stdin, stdout, stderr):
+            stdout.write(b'out')
+            stderr.write(b'error')
+            return proc
+        lib.popen = popen
+        context, socket = fake_context()
+
+        lib.ssh(1, context, 'foo', 'dmesg', [],
+                stdout_path=os.path.join(self.outdir, '{uri}.out'),
+                stderr_path=os.path.join(self.outdir, '{uri}.err'))
+        result = socket.send_pyobj.call_args_list[0][0][0]
+        self.assertNotIn('stdout', result)
+        self.assertNotIn('stderr', result)
+        self.assertEqual(result['return_code'], 1)
+        self.assertEqual(result['stdout_path'], os.path.join(self.outdir, 'foo.out'))
+        self.assertEqual(result['stdout_size'], 3)
+        self.assertEqual(result['stderr_path'], os.path.join(self.outdir, 'foo.err'))
+        self.assertEqual(result['stderr_size'], 5)
+
+
+
+class Test_encoding(unittest.TestCase):
+
+    def test_encoding(self):
+        """
+        Output is decoded using the requested encoding, or returned as bytes.
+        """
+        sub, proc = fake_subprocess(b'\xff\xfeok', b'\xe2\x9c\x93', 0)
+        self.addCleanup(setattr, lib, 'popen', lib.popen)
+        lib.popen = sub.popen
+        context, socket = fake_context()
+
+        # Undecodable bytes are replaced by default
+        lib.ssh(1, context, 'foo', 'command', [])
+        result = socket.send_pyobj.call_args_list[0][0][0]
+        self.assertEqual(result['stdout'], u'��ok')
+        self.assertEqual(result['stderr'], u'✓')
+        socket.reset_mock()
+
+        # Raw bytes
+        lib.ssh(1, context, 'foo', 'command', [], encoding=None)
+        result = socket.send_pyobj.call_args_list[0][0][0]
+        self.assertEqual(result['stdout'], b'\xff\xfeok')
+        self.assertEqual(result['stderr'], b'\xe2\x9c\x93')
+        socket.reset_mock()
+
+        # Strict decoding fails
+        lib.ssh(1, context, 'foo', 'command', [], errors='strict')
+        result = socket.send_pyobj.call_args_list[0][0][0]
+        self.assertIn('UnicodeDecodeError', result['traceback'])
+
+
+    def test_sshm_encoding(self):
+        """
+        sshm only passes the encoding to ssh when it was changed.
+        """
+        self.addCleanup(setattr, lib, 'ssh', lib.ssh)
+        def side_effect(thread_num, context, *a, **kw):
+            sink = context.socket(zmq.PUSH)
+            sink.connect(lib.SINK_URL)
+            sink.send_pyobj({'thread_num':thread_num,})
+        lib.ssh = MagicMock(side_effect=side_effect)
+
+        list(lib.sshm('example.com', 'foo'))
+        self.assertEqual(lib.ssh.call_args_list[0][1], {})
+        lib.ssh.reset_mock()
+
+        list(lib.sshm('example.com', 'foo', encoding=None, errors='strict'))
+        self.assertEqual(lib.ssh.call_args_list[0][1],
+                {'encoding':None, 'errors':'strict'})
+
+
+
+class Test_result(unittest.TestCase):
+
+
+    def test_mapping(self):
+        """
+        A Result is used like the dict it replaces.
+        """
+        result = lib.Result(thread_num=0, uri='example.com')
+        result['return_code'] = 0
+        result['steps'] = []
+        self.assertEqual(result, {'thread_num':0, 'uri':'example.com', 'return_code':0,
+            'steps':[]})
+        self.assertEqual(dict(result, foo=1)['foo'], 1)
+        self.assertNotIn('traceback', result)
+        self.assertEqual(result.get('traceback'), None)
+        self.assertRaises(KeyError, result.__getitem__, 'stdout')
+        del result['steps']
+        del result['uri']
+        self.assertEqual(list(result), ['thread_num', 'return_code'])
+        self.assertRaises(KeyError, result.__delitem__, 'uri')
+        self.assertRaises(KeyError, result.__delitem__, 'foo')
+        self.assertFalse(hasattr(result, '__dict__'))
+
+        # It is a MutableMapping, to_dict gets a dict for json
+        import json
+        self.assertIsInstance(result, lib.MutableMapping)
+        self.assertNotIsInstance(result, dict)
+        self.assertEqual(type(result.to_dict()), dict)
+        self.assertEqual(json.loads(json.dumps(result.to_dict())),
+                {'thread_num':0, 'return_code':0})
+
+
+    def test_lazy(self):
+        """
+        The outputs are decoded when they are read, the cmd prefix is shared
+        by the results received by sshm, also after they were pickled.
+        """
+        import pickle
+        prefixes = {}
+        results = []
+        for uri in ('example1.com', 'example2.com'):
+            result = lib.Result(thread_num=0, uri=uri)
+            result.set_output('stdout', b'caf\xc3\xa9', 'utf-8', 'replace')
+            result.set_output('stderr', b'\xff', 'utf-8', 'replace')
+            result.set_cmd(['ssh', '-oFoo=yes', uri, 'ls'], uri)
+            result = pickle.loads(pickle.dumps(result, 2))
+            result.share_cmd(prefixes)
+            results.append(result)
+        self.assertEqual(results[0]['stdout'], u'caf\xe9')
+        self.assertEqual(results[0]['stderr'], u'\ufffd')
+        self.assertEqual(results[1]['cmd'], ['ssh', '-oFoo=yes', 'example2.com', 'ls'])
+        self.assertIs(results[0]._cmd_prefix, results[1]._cmd_prefix)
+
+        # The cmd can be replaced
+        results[0]['cmd'] = ['foo']
+        self.assertEqual(results[0]['cmd'], ['foo'])
+        result = lib.Result()
+        result.set_cmd(None, 'example.com')
+        self.assertEqual(result['cmd'], None)
+
+
+    def test_pickle(self):
+        """
+        A pickled Result is the same Result, and smaller than the dict it
+        replaces.
+        """
+        import pickle
+        result = lib.Result(thread_num=3, uri='web001.example.com', return_code=0)
+        result.set_output('stdout', b' 12:00 up', 'utf-8', 'replace')
+        result.set_output('stderr', b'', 'utf-8', 'replace')
+        result.set_cmd(['ssh', '-oHostName=10.0.0.1', 'web001.example.com', 'uptime'],
+                'web001.example.com')
+        result['steps'] = []
+        for protocol in (2, pickle.HIGHEST_PROTOCOL):
+            pickled = pickle.dumps(result, protocol)
+            self.assertLess(len(pickled), len(pickle.dumps(result.to_dict(), protocol)))
+            self.assertEqual(pickle.loads(pickled), result)
+            self.assertEqual(pickle.loads(pickled)['cmd'], result['cmd'])
+            self.assertEqual(pickle.loads(pickled)._stdout, b' 12:00 up')
+
+        # Outputs kept as bytes, and a Result without outputs
+        result.set_output('stdout', b'\xff', None, 'strict')
+        copy = pickle.loads(pickle.dumps(result, 2))
+        self.assertEqual((copy['stdout'], copy._encoding, copy._errors),
+                (b'\xff', None, 'strict'))
+        copy = pickle.loads(pickle.dumps(lib.Result(uri='example.com'), 2))
+        self.assertEqual((dict(copy), copy._encoding), ({'uri':'example.com'}, None))
+
+
+
+class Test_uri_count(unittest.TestCase):
+
+    def test_uri_count(self):
+        """
+        Uris are counted without expanding them.
+        """
+        provided = [
+                '10.1.2.3',
+                '10.2.3.4,example.com',
+                '10-11.1.2.3-5',
+                '192.168.3-5,7.1:567',
+                '192.168.0.-',
+                'mail[01-3].example.com:123',
+                'foo@example[11-13,17].com:1234,root@1.2,5-7.3.4:1234',
+                '10.1.1.1,3,root@example[01-2].com,10-11.1.2.1-5',
+                '10.1.2.3-2',
+                ]
+        for spec in provided:
+            self.assertEqual(lib.uri_count(spec),
+                    len(list(lib.uri_expansion(spec)))
+                    if spec != '10.1.2.3-2' else 0)
+
+        # Duplicates are counted
+        self.assertEqual(lib.uri_count('10.1.1.1,3,10-11.1.1.1-5'), 12)
+
+        self.assertEqual(lib.uri_count('10.0-255.0-255.0-255'), 256**3)
+        self.assertRaises(ValueError, lib.uri_count, None)
+
+
+
+class Test_targets(unittest.TestCase):
+    """
+    CIDR networks, IPv6 addresses, exclusions and the order of targets.
+    """
+
+    def test_cidr_ipv6(self):
+        """
+        CIDR networks and IPv6 addresses are expanded and counted.
+        """
+        provided = '10.20.0.254/31,root@10.20.1.0/30:22,2001:db8::1,root@[2001:db8::/127]:22,[fe80::/126]'
+        expected = [
+                '10.20.0.254', '10.20.0.255',
+                'root@10.20.1.0:22', 'root@10.20.1.1:22', 'root@10.20.1.2:22', 'root@10.20.1.3:22',
+                '2001:db8::1',
+                'root@[2001:db8::]:22', 'root@[2001:db8::1]:22',
+                'fe80::', 'fe80::1', 'fe80::2', 'fe80::3',
+                ]
+        self.assertEqual(list(lib.uri_expansion(provided)), expected)
+        self.assertEqual(lib.uri_count(provided), len(expected))
+        # Networks that do not end on an octet are exact
+        self.assertEqual(lib.uri_count('10.0.0.0/8'), 2**24)
+        self.assertEqual(lib.uri_count('10.0.2.0/23'), 512)
+        self.assertEqual(lib.uri_count('2001:db8::/64'), 2**64)
+        self.assertEqual(next(lib.uri_expansion('10.0.3.7/23')), '10.0.2.0')
+
+        for provided in ('10.0.0.0/33', '10.0.0.256/24'):
+            self.assertRaises(ValueError, list, lib.uri_expansion(provided))
+
+
+    def test_split_uri(self):
+        """
+        The port of a uri is split from its host, an IPv6 address loses its
+        brackets.
+        """
+        provided = {
+                'example.com':('example.com', None),
+                'root@example.com:22':('root@example.com', '22'),
+                '2001:db8::1':('2001:db8::1', None),
+                'root@[2001:db8::1]:22':('root@2001:db8::1', '22'),
+                }
+        for uri, expected in provided.items():
+            self.assertEqual(lib.split_uri(uri), expected)
+
+
+    def test_exclude(self):
+        """
+        Any target matched by the exclusion is skipped, its user and port are
+        ignored.
+        """
+        provided = '10.0.0.0/29,root@host[01-10].example.com:22,2001:db8::/126'
+        exclude = '10.0.0.2-3,10.0.0.6/31,host[03-05].example.com,host7.example.com,2001:db8::1'
+        self.assertEqual(list(lib.uri_expansion(provided, exclude)), [
+            '10.0.0.0', '10.0.0.1', '10.0.0.4', '10.0.0.5',
+            'root@host01.example.com:22', 'root@host02.example.com:22',
+            'root@host06.example.com:22', 'root@host07.example.com:22',
+            'root@host08.example.com:22', 'root@host09.example.com:22',
+            'root@host10.example.com:22',
+            '2001:db8::', '2001:db8::2', '2001:db8::3',
+            ])
+        # Everything may be excluded
+        self.assertEqual(list(lib.uri_expansion('10.0.0.1', '10.0.0.0/24')), [])
+
+
+    def test_set_algebra(self):
+        """
+        A list of specifications is their union, each uri is only yielded once.
+        Exclusion is their difference, and intersect their intersection.
+        """
+        provided = ['10.0.0.0/30,10.0.0.2-5', '10.0.0.1,host[1-3].com,host[2-4].com',
+                'root@10.0.0.1,10.0.0.1:22']
+        self.assertEqual(list(lib.uri_expansion(provided)), [
+            '10.0.0.0', '10.0.0.1', '10.0.0.2', '10.0.0.3', '10.0.0.4', '10.0.0.5',
+            'host1.com', 'host2.com', 'host3.com', 'host4.com',
+            'root@10.0.0.1', '10.0.0.1:22'])
+        # Overlapping ranges of one uri
+        self.assertEqual(list(lib.uri_expansion('host[1-3,2-4,004].com')),
+                ['host1.com', 'host2.com', 'host3.com', 'host4.com', 'host004.com'])
+        # Duplicates are found in any order
+        self.assertEqual(sorted(lib.uri_expansion(provided, order='random', seed=1)),
+                sorted(lib.uri_expansion(provided)))
+
+        self.assertEqual(list(lib.uri_expansion('10.0.0.0/24', intersect='10.0.0.3-200,10.1.0.0/16',
+            exclude='10.0.0.5-199')), ['10.0.0.3', '10.0.0.4', '10.0.0.200'])
+
+        # Huge overlapping specifications are not expanded
+        uris = lib.uri_expansion(['10.0.0.0/8', '10.0.0.0/16', '10.1.0.0/16'],
+                exclude='10.0.0.0/24')
+        self.assertEqual(next(uris), '10.0.1.0')
+
+
+    def test_order(self):
+        """
+        Targets can be interleaved between subnets and uris, or permuted
+        pseudo-randomly.
+        """
+        self.assertEqual(list(lib.uri_expansion('10.0.0-2.1-2', order='interleave')), [
+            '10.0.0.1', '10.0.1.1', '10.0.2.1', '10.0.0.2', '10.0.1.2', '10.0.2.2'])
+        self.assertEqual(list(lib.uri_expansion('mail[1-3].com,www[1-2].com', order='interleave')), [
+            'mail1.com', 'www1.com', 'mail2.com', 'www2.com', 'mail3.com'])
+
+        provided = '10.0.0.0/22,host[001-300].com'
+        expected = sorted(lib.uri_expansion(provided))
+        first = list(lib.uri_expansion(provided, order='random', seed=1))
+        self.assertEqual(sorted(first), expected)
+        self.assertNotEqual(first, list(lib.uri_expansion(provided)))
+        # The same seed gives the same order
+        self.assertEqual(first, list(lib.uri_expansion(provided, order='random', seed=1)))
+        self.assertNotEqual(first, list(lib.uri_expansion(provided, order='random', seed=2)))
+
+        # Each integer is permuted exactly once
+        for size in (0, 1, 2, 5, 1000):
+            self.assertEqual(sorted(lib._permutation(size, 3)), list(range(size)))
+
+        # Huge networks are permuted without expanding them
+        uris = lib.uri_expansion('2001:db8::/64', order='random', seed=1)
+        self.assertEqual(len(set(next(uris) for i in range(100))), 100)
+
+        self.assertRaises(ValueError, list, lib.uri_expansion('example.com', order='sorted'))
+
+
+    def test_sshm(self):
+        """
+        sshm skips the excluded servers, and connects to IPv6 addresses without
+        brackets.
+        """
+        sub, proc = fake_subprocess('', '', 0)
+        self.addCleanup(setattr, lib, 'popen', lib.popen)
+        lib.popen = sub.popen
+
+        # Overlapping groups only connect to a server once
+        results = list(lib.sshm(['example[1-3].com', 'example[2-5].com'], 'exit',
+            intersect='example[1-4].com'))
+        self.assertEqual(sorted(i['uri'] for i in results),
+                ['example1.com', 'example2.com', 'example3.com', 'example4.com'])
+
+        results = list(lib.sshm('[2001:db8::/126]:22', 'echo {fqdn}',
+            exclude='2001:db8::2/127'))
+        self.assertEqual(sorted(i['uri'] for i in results),
+                ['[2001:db8::1]:22', '[2001:db8::]:22'])
+        self.assertEqual(sorted(i['cmd'] for i in results), [
+            ['ssh', '2001:db8::', '-p', '22', 'echo 2001:db8::'],
+            ['ssh', '2001:db8::1', '-p', '22', 'echo 2001:db8::1'],
+            ])
+
+
+
+class Test_resolve(unittest.TestCase):
+    """
+    Servers can be resolved concurrently before they are connected to.
+    """
+
+    addresses = {
+            'web1.example.com':'10.0.0.1',
+            'www.example.com':'10.0.0.1',
+            'db.example.com':'10.0.0.2',
+            }
+
+    def setUp(self):
+        """
+        Resolve names using "addresses" instead of DNS.
+        """
+        import socket
+        self.lookups = []
+        def getaddrinfo(host, *a):
+            self.lookups.append(host)
+            if host == 'flaky.example.com':
+                raise socket.gaierror(socket.EAI_AGAIN, 'Temporary failure')
+            if host not in self.addresses:
+                raise socket.gaierror(socket.EAI_NONAME, 'Name or service not known')
+            return [(socket.AF_INET, socket.SOCK_STREAM, 6, '', (self.addresses[host], 0)),]
+        self.addCleanup(setattr, lib.socket, 'getaddrinfo', lib.socket.getaddrinfo)
+        lib.socket.getaddrinfo = getaddrinfo
+        self.addCleanup(lib._dns_cache.clear)
+        lib._dns_cache.clear()
+
+
+    def test_resolve_host(self):
+        """
+        Lookups are cached until their TTL expires, a host that does not exist
+        is None.
+        """
+        import socket
+        now = [1000]
+        clock = lambda: now[0]
+        self.assertEqual(lib.resolve_host('db.example.com', clock), '10.0.0.2')
+        self.assertEqual(lib.resolve_host('gone.example.com', clock), None)
+        self.assertEqual(lib.resolve_host('db.example.com', clock), '10.0.0.2')
+        self.assertEqual(lib.resolve_host('gone.example.com', clock), None)
+        self.assertEqual(self.lookups, ['db.example.com', 'gone.example.com'])
+
+        now[0] += lib.dns_ttl
+        self.assertEqual(lib.resolve_host('db.example.com', clock), '10.0.0.2')
+        self.assertEqual(self.lookups, ['db.example.com', 'gone.example.com', 'db.example.com'])
+
+        # A temporary failure is not cached
+        self.assertRaises(socket.gaierror, lib.resolve_host, 'flaky.example.com')
+        self.assertNotIn('flaky.example.com', lib._dns_cache)
+
+
+    def test_sshm(self):
+        """
+        ssh connects to the resolved address.  A host that does not exist is
+        reported without running ssh, an alias is only reported.
+        """
+        sub, proc = fake_subprocess(b'', b'', 0)
+        self.addCleanup(setattr, lib, 'popen', lib.popen)
+        lib.popen = sub.popen
+
+        results = list(lib.sshm('web1.example.com,www.example.com,root@db.example.com:2222,'
+            'gone.example.com,flaky.example.com', 'exit', resolve=True, encoding=None))
+        results = dict((i['uri'], i) for i in results)
+        self.assertEqual(len(results), 5)
+
+        # The uri of an address that is resolved first is connected to, the
+        # lookups finish in any order
+        first, alias = sorted(('web1.example.com', 'www.example.com'),
+                key=lambda uri: 'alias_of' in results[uri])
+        self.assertEqual(results[first]['cmd'],
+                ['ssh', '-oHostName=10.0.0.1', '-oHostKeyAlias=' + first, first, 'exit'])
+        self.assertEqual(results[first]['address'], '10.0.0.1')
+        self.assertEqual(results['root@db.example.com:2222']['cmd'],
+                ['ssh', '-oHostName=10.0.0.2', '-oHostKeyAlias=[db.example.com]:2222',
+                    'root@db.example.com', '-p', '2222', 'exit'])
+        # ssh resolves the host itself when the lookup failed temporarily
+        self.assertEqual(results['flaky.example.com']['cmd'],
+                ['ssh', 'flaky.example.com', 'exit'])
+
+        self.assertEqual(results[alias]['alias_of'], first)
+        self.assertNotIn('cmd', results[alias])
+        self.assertEqual(results['gone.example.com']['return_code'], 255)
+        self.assertEqual(results['gone.example.com']['stderr'],
+                b'ssh: Could not resolve hostname gone.example.com: Name or service not known\n')
+        self.assertNotIn('cmd', results['gone.example.com'])
+        self.assertEqual(sub.popen.call_count, 3)
+
+        # Every thread number is unique
+        self.assertEqual(sorted(i['thread_num'] for i in results.values()), list(range(5)))
+
+        # Errors in the specification are raised
+        self.assertRaises(ValueError, list, lib.sshm('10.1.2.3-2', 'exit', resolve=True))
+
+
+    @unittest.skipUnless(lib.which('ssh'), 'ssh is not installed')
+    def test_ssh_config(self):
+        """
+        The options of a uri are those reported by ssh, they are cached.
+        """
+        self.addCleanup(lib._ssh_configs.clear)
+        options = lib._ssh_config('root@example.com:2222', ['-oHostName=10.9.9.9'])
+        self.assertEqual((options['user'], options['hostname'], options['port']),
+                ('root', '10.9.9.9', '2222'))
+        self.assertIs(lib._ssh_config('root@example.com:2222', ['-oHostName=10.9.9.9']), options)
+        self.assertEqual(lib._ssh_config('example.com', ['-oNoSuchOption=yes']), {})
+
+
+    def test_ssh_config_hosts(self):
+        """
+        A Host of ssh_config is resolved using its HostName, a server behind a
+        jump host is left to ssh.
+        """
+        sub, proc = fake_subprocess(b'', b'', 0)
+        self.addCleanup(setattr, lib, 'popen', lib.popen)
+        lib.popen = sub.popen
+        configs = {'db':{'hostname':'db.example.com'},
+                'hidden':{'hostname':'hidden.internal', 'proxyjump':'bastion'}}
+        self.addCleanup(setattr, lib, '_ssh_config', lib._ssh_config)
+        lib._ssh_config = lambda uri, extra_arguments=None: configs.get(uri, {})
+
+        results = dict((i['uri'], i) for i in lib.sshm('db,hidden', 'exit', resolve=True))
+        self.assertEqual(results['db']['cmd'], ['ssh', '-oHostName=10.0.0.2',
+            '-oHostKeyAlias=db.example.com', 'db', 'exit'])
+        self.assertEqual(results['hidden']['cmd'], ['ssh', 'hidden', 'exit'])
+        self.assertEqual(self.lookups, ['db.example.com'])
+
+
+    def test_close(self):
+        """
+        The resolving threads stop when the targets are closed.
+        """
+        import itertools
+        import threading
+        import time
+        self.addCleanup(setattr, lib, '_ssh_config', lib._ssh_config)
+        lib._ssh_config = lambda uri, extra_arguments=None: {}
+        running = threading.active_count()
+        uris = ('host{}.example.com'.format(i) for i in itertools.count())
+        targets = lib._resolve_targets(uris, resolvers=3)
+        next(targets)
+        self.assertEqual(threading.active_count(), running + 3)
+        targets.close()
+        for i in range(50):
+            if threading.active_count() == running:
+                break
+            time.sleep(0.1)
+        self.assertEqual(threading.active_count(), running)
+
+
+
+class Test_probe(unittest.TestCase):
+    """
+    Servers can be probed before they are connected to.
+    """
+
+    def listen(self):
+        """
+        Listen on a free port of localhost, return that port.
+        """
+        import socket
+        sock = socket.socket()
+        self.addCleanup(sock.close)
+        sock.bind(('127.0.0.1', 0))
+        sock.listen(5)
+        return sock.getsockname()[1]
+
+
+    def closed_port(self):
+        """
+        Get a port of localhost that does not accept connections.
+        """
+        import socket
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        return port
+
+
+    def test_probe_targets(self):
+        """
+        Only targets that accept connections are yielded without a result.
+        """
+        port, closed = self.listen(), self.closed_port()
+        # This host does not exist
+        self.addCleanup(lib._dns_cache.clear)
+        lib._dns_cache['gone.invalid'] = (float('inf'), None)
+        targets = [
+                ('127.0.0.1:{}'.format(port), None, None),
+                ('root@localhost:{}'.format(port), '127.0.0.1', None),
+                ('127.0.0.1:{}'.format(closed), None, None),
+                ('gone.invalid', None, None),
+                ('reported', None, {'uri':'reported'}),
+                ]
+        results = dict((i[0], i) for i in lib._probe_targets(iter(targets), probes=2))
+        self.assertEqual(len(results), 5)
+        self.assertEqual(results['127.0.0.1:{}'.format(port)], targets[0])
+        self.assertEqual(results['root@localhost:{}'.format(port)], targets[1])
+        self.assertEqual(results['reported'], targets[4])
+        result = results['127.0.0.1:{}'.format(closed)][2]
+        self.assertEqual(result['return_code'], 255)
+        self.assertTrue(result['unreachable'])
+        self.assertEqual(result['stderr'],
+                'ssh: connect to host 127.0.0.1 port {}: Connection refused\n'.format(closed))
+        self.assertTrue(results['gone.invalid'][2]['unreachable'])
+
+
+    def test_timeout(self):
+        """
+        A connect that does not finish in time is unreachable.
+        """
+        now = [0]
+        # The connect never finishes
+        self.addCleanup(setattr, lib.select, 'poll', lib.select.poll)
+        def poll():
+            poller = MagicMock()
+            def wait(timeout):
+                now[0] += timeout / 1000.0
+                return []
+            poller.poll.side_effect = wait
+            return poller
+        lib.select.poll = poll
+        results = list(lib._probe_targets([('127.0.0.1:{}'.format(self.listen()), None, None),],
+            timeout=5, clock=lambda: now[0], encoding=None))
+        self.assertEqual(len(results), 1)
+        self.assertTrue(results[0][2]['stderr'].endswith(b': Connection timed out\n'))
+        self.assertEqual(now[0], 5)
+
+
+    def test_sshm(self):
+        """
+        ssh is only run on the servers that are reachable.
+        """
+        sub, proc = fake_subprocess('', '', 0)
+        self.addCleanup(setattr, lib, 'popen', lib.popen)
+        lib.popen = sub.popen
+
+        port, closed = self.listen(), self.closed_port()
+        results = list(lib.sshm('127.0.0.1:{},127.0.0.1:{}'.format(port, closed),
+            'exit', probe=True))
+        self.assertEqual(len(results), 2)
+        self.assertEqual(sub.popen.call_count, 1)
+        self.assertEqual(sub.popen.call_args[0][0], ['ssh', '127.0.0.1', '-p', str(port), 'exit'])
+        self.assertEqual(sorted(i.get('unreachable', False) for i in results), [False, True])
+
+
+    @unittest.skipUnless(lib.which('ssh'), 'ssh is not installed')
+    def test_ssh_options(self):
+        """
+        The port of the ssh arguments is probed, a server behind a jump host
+        is not probed.
+        """
+        sub, proc = fake_subprocess('', '', 0)
+        self.addCleanup(setattr, lib, 'popen', lib.popen)
+        lib.popen = sub.popen
+        self.addCleanup(lib._ssh_configs.clear)
+
+        port = self.listen()
+        result, = lib.sshm('127.0.0.1', 'exit', ['-p', str(port)], probe=True)
+        self.assertNotIn('unreachable', result)
+        self.assertEqual(result['cmd'], ['ssh', '-p', str(port), '127.0.0.1', 'exit'])
+
+        result, = lib.sshm('127.0.0.1:{}'.format(self.closed_port()), 'exit',
+                ['-oProxyJump=bastion'], probe=True)
+        self.assertNotIn('unreachable', result)
+        self.assertEqual(sub.popen.call_count, 2)
+
+
+
+class Test_prefetch_host_keys(unittest.TestCase):
+    """
+    Host keys can be scanned before the servers are connected to.
+    """
+
+    def setUp(self):
+        """
+        Fake ssh-keyscan, ssh-keygen and ssh.  The contents of the known_hosts
+        file each ssh call was given are kept.  The user's known_hosts file
+        contains the hosts of "known".
+        """
+        import shutil
+        import tempfile
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.user_known_hosts = os.path.join(directory, 'known_hosts')
+        open(self.user_known_hosts, 'w').close()
+        self.known = set(['known.com'])
+        self.configs = {}
+        def ssh_config(uri, extra_arguments=None):
+            return dict({'userknownhostsfile':self.user_known_hosts,
+                'globalknownhostsfile':os.path.join(directory, 'missing')},
+                **self.configs.get(uri, {}))
+        self.addCleanup(setattr, lib, '_ssh_config', lib._ssh_config)
+        lib._ssh_config = ssh_config
+
+        self.scans = []
+        self.known_hosts = {}
+        def popen(cmd, stdin, stdout, stderr):
+            proc = MagicMock(returncode=0)
+            if cmd[0] == 'ssh-keyscan':
+                self.scans.append(cmd)
+                port = cmd[cmd.index('-p')+1]
+                output = [b'# ' + i.encode() + b':' + port.encode() + b' SSH-2.0-OpenSSH'
+                        for i in cmd[5:]]
+                output += [(i if port == '22' else '[{}]:{}'.format(i, port)).encode()
+                        + b' ssh-ed25519 KEY' for i in cmd[5:]]
+                proc.communicate.return_value = (b'\n'.join(output), b'')
+            elif cmd[0] == 'ssh-keygen':
+                self.assertEqual(cmd[3:], ['-f', self.user_known_hosts])
+                proc.returncode = 0 if cmd[2] in self.known else 1
+                proc.communicate.return_value = (None, None)
+            else:
+                option = cmd[1]
+                path = option.split()[-1]
+                with open(path) as file:
+                    self.known_hosts[cmd[-2]] = file.read()
+                self.assertEqual(option,
+                        '-oUserKnownHostsFile={} {}'.format(self.user_known_hosts, path))
+                proc.communicate.return_value = ('', '')
+            return proc
+        self.addCleanup(setattr, lib, 'popen', lib.popen)
+        lib.popen = popen
+
+
+    def test_prefetch_host_keys(self):
+        """
+        Hosts are scanned in rate-limited batches, each target is yielded once
+        its key is written.
+        """
+        import tempfile
+        fd, known_hosts = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, known_hosts)
+
+        now = [0]
+        sleeps = []
+        def sleep(seconds):
+            sleeps.append(seconds)
+            now[0] += seconds
+        targets = [('h{}.com'.format(i), None, None) for i in range(5)]
+        targets.insert(2, ('gone.com', None, {'uri':'gone.com'}))
+        targets.append(('root@h0.com:2222', None, None))
+        # Known hosts and hosts behind a jump host are not scanned
+        targets.append(('known.com', None, None))
+        targets.append(('hidden', None, None))
+        self.configs['hidden'] = {'proxyjump':'bastion'}
+        # A host of ssh_config is scanned at its HostName and Port, a resolved
+        # host at its address
+        targets.append(('web', None, None))
+        self.configs['web'] = {'hostname':'real.com', 'port':'2200'}
+        targets.append(('db.com', '10.0.0.5', None))
+        yielded = []
+        for target in lib._prefetch_host_keys(iter(targets), known_hosts, batch=2,
+                scans=2, rate=4, clock=lambda: now[0], sleep=sleep):
+            if not target[2]:
+                # The key of this host has already been written
+                with open(known_hosts) as file:
+                    self.assertIn(' KEY', file.read())
+            yielded.append(target)
+
+        self.assertEqual(sorted(yielded), sorted(targets))
+        self.assertEqual([i[5:] for i in self.scans],
+                [['h0.com', 'h1.com'], ['h2.com', 'h3.com'], ['h4.com'], ['h0.com'],
+                    ['real.com'], ['10.0.0.5']])
+        self.assertEqual(self.scans[3][:5], ['ssh-keyscan', '-T', '3', '-p', '2222'])
+        self.assertEqual(self.scans[4][:5], ['ssh-keyscan', '-T', '3', '-p', '2200'])
+        # 4 hosts are scanned each second
+        self.assertEqual(sleeps, [0, 0.5, 0.5, 0.5, 0.25])
+        with open(known_hosts) as file:
+            self.assertEqual(file.read().splitlines(), [
+                'h0.com ssh-ed25519 KEY', 'h1.com ssh-ed25519 KEY',
+                'h2.com ssh-ed25519 KEY', 'h3.com ssh-ed25519 KEY',
+                'h4.com ssh-ed25519 KEY', '[h0.com]:2222 ssh-ed25519 KEY',
+                '[real.com]:2200 ssh-ed25519 KEY', 'db.com ssh-ed25519 KEY'])
+
+
+    def test_sshm(self):
+        """
+        Each ssh call checks the keys that were scanned, the file is removed
+        afterwards.
+        """
+        results = list(lib.sshm('host[1-3].com,root@host1.com,known.com', 'exit',
+            prefetch_hostkeys=True))
+        self.assertEqual(len(results), 5)
+        self.assertEqual(sorted(self.known_hosts),
+                ['host1.com', 'host2.com', 'host3.com', 'known.com', 'root@host1.com'])
+        # A known host is only checked against the user's known_hosts
+        self.assertNotIn('known.com', self.known_hosts.pop('known.com'))
+        for uri, contents in self.known_hosts.items():
+            self.assertIn(uri.split('@')[-1] + ' ssh-ed25519 KEY\n', contents)
+        # The same key is only written once
+        self.assertEqual(contents.count('host1.com ssh-ed25519 KEY'), 1)
+        self.assertFalse(os.path.exists(results[0]['cmd'][1].split()[-1]))
+
+
+
+class Test_history(unittest.TestCase):
+    """
+    The servers that took the longest are started first.
+    """
+
+    def setUp(self):
+        import shutil, tempfile, time
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'cache', 'durations.json')
+        self.started = []
+        def side_effect(thread_num, context, uri, *a, **kw):
+            self.started.append(uri)
+            time.sleep(0.01 * int(uri[7:-4]))
+            sink = context.socket(zmq.PUSH)
+            sink.connect(lib.SINK_URL)
+            sink.send_pyobj({'thread_num':thread_num, 'uri':uri})
+            sink.close()
+        self.addCleanup(setattr, lib, 'ssh', lib.ssh)
+        lib.ssh = MagicMock(side_effect=side_effect)
+
+
+    def test_history(self):
+        list(lib.sshm('example[1-3].com', 'foo', workers=1, history=self.path))
+        self.assertEqual(self.started, ['example1.com', 'example2.com', 'example3.com'])
+        durations = lib._load_durations(self.path)
+        self.assertEqual(sorted(durations), self.started)
+        self.assertTrue(durations['example1.com'] < durations['example3.com'])
+
+        # An unknown server is expected to take the average time
+        os.remove(self.path)
+        lib._save_durations(self.path, {'example1.com':1, 'example2.com':2, 'example3.com':6})
+        self.started = []
+        list(lib.sshm('example[1-4].com,example0.com', 'foo', workers=1, history=self.path))
+        self.assertEqual(self.started, ['example3.com', 'example4.com', 'example0.com',
+            'example2.com', 'example1.com'])
+        self.assertEqual(len(lib._load_durations(self.path)), 5)
+
+
+    def test_durations(self):
+        """
+        A recorded duration is averaged with the next one.
+        """
+        self.assertEqual(lib._load_durations(self.path), {})
+        lib._save_durations(self.path, {'a':1, 'b':2})
+        lib._save_durations(self.path, {'a':3})
+        self.assertEqual(lib._load_durations(self.path), {'a':2, 'b':2})
+        with open(self.path, 'w') as file:
+            file.write('{damaged')
+        self.assertEqual(lib._load_durations(self.path), {})
+        self.assertEqual(lib._longest_first(['a', 'b', 'c', 'd'], {'b':1, 'd':3}),
+                ['d', 'a', 'c', 'b'])
+
+
+
+class Test_rolling(unittest.TestCase):
+    """
+    Servers can be run in batches, which stop once too many have failed.
+    """
+
+    def setUp(self):
+        """
+        Fake ssh, any server named "bad" fails.  The amount of results yielded
+        when each server was started is kept.
+        """
+        self.yielded = []
+        self.started = {}
+        def side_effect(thread_num, context, uri, *a, **kw):
+            self.started[uri] = len(self.yielded)
+            sink = context.socket(zmq.PUSH)
+            sink.connect(lib.SINK_URL)
+            sink.send_pyobj({'thread_num':thread_num, 'uri':uri,
+                'return_code':1 if uri.startswith('bad') else 0})
+            sink.close()
+        self.addCleanup(setattr, lib, 'ssh', lib.ssh)
+        lib.ssh = MagicMock(side_effect=side_effect)
+
+
+    def run_sshm(self, *a, **kw):
+        for result in lib.sshm(*a, **kw):
+            self.yielded.append(result)
+        return self.yielded
+
+
+    def test_compact_uris(self):
+        """
+        Consecutive uris are combined into ranges that expand back into them.
+        """
+        provided = 'host[08-12].example.com,root@10.0.0.1-9:22,10.0.1.0-3,host7,2001:db8::1,web[1-2],web4'
+        uris = list(lib.uri_expansion(provided))
+        self.assertEqual(list(lib.compact_uris(uris)), provided.split(','))
+        self.assertEqual(list(lib.compact_uris([])), [])
+
+
+    def test_batches(self):
+        """
+        Each batch starts once the previous batch has finished, the canary is
+        the first batch.
+        """
+        results = self.run_sshm('example[1-6].com', 'exit', canary=1, batch=2)
+        self.assertEqual(len(results), 6)
+        self.assertEqual(sorted(self.started.values()), [0, 1, 1, 3, 3, 5])
+
+        # A percentage of the servers
+        self.yielded, self.started = [], {}
+        self.run_sshm('example[1-6].com', 'exit', batch='50%', workers=2)
+        self.assertEqual(sorted(self.started.values()), [0, 0, 1, 3, 3, 4])
+
+
+    def test_abort(self):
+        """
+        Once too many servers have failed, no more batches are started.  The
+        servers that were not started are reported.
+        """
+        try:
+            self.run_sshm(['good[1-2].com', 'bad.com,good[3-9].com,10.0.0.1-3'], 'exit',
+                    canary=2, batch=2)
+            self.fail('RollingAbort was not raised')
+        except lib.RollingAbort as abort:
+            self.assertEqual((abort.failed, abort.finished), (1, 4))
+            self.assertEqual(abort.remaining, 'good[4-9].com,10.0.0.1-3')
+        self.assertEqual(sorted(self.started), ['bad.com', 'good1.com', 'good2.com', 'good3.com'])
+        self.assertEqual(len(self.yielded), 4)
+
+        # The failure rate may be allowed
+        self.yielded, self.started = [], {}
+        results = self.run_sshm('good[1-2].com,bad.com,good[3-9].com', 'exit', batch=3,
+                max_failure_rate=0.5)
+        self.assertEqual(len(results), 10)
+
+        # Without batches nothing is stopped
+        self.yielded, self.started = [], {}
+        self.assertEqual(len(self.run_sshm('bad.com,good[1-3].com', 'exit')), 4)
+
+
+
+class Test_compress(unittest.TestCase):
+    """
+    Output can be compressed on the server.
+    """
+
+    def setUp(self):
+        """
+        Run the command of each ssh call locally instead, ssh itself writes to
+        stderr first.
+        """
+        import subprocess
+        self.calls = []
+        self.env = None
+        def popen(cmd, stdin, stdout, stderr):
+            self.calls.append(cmd)
+            return subprocess.Popen(['/bin/sh', '-c', 'echo Warning >&2; ' + cmd[-1]],
+                    stdin=stdin, stdout=stdout, stderr=stderr, env=self.env)
+        self.addCleanup(setattr, lib, 'popen', lib.popen)
+        lib.popen = popen
+
+
+    def test_compress(self):
+        from io import BytesIO
+        command = 'cat; seq 10000; echo {fqdn} >&2; exit 3'
+        result, = lib.sshm('example.com', command, stdin=BytesIO(b'in\n'), compress=True)
+        self.assertEqual(result['return_code'], 3)
+        self.assertEqual(result['stdout'],
+                'in\n' + ''.join('{}\n'.format(i) for i in range(1, 10001)))
+        self.assertEqual(result['stderr'], 'Warning\nexample.com\n')
+        # The output was sent compressed
+        self.assertIn('gzip', self.calls[0][-1])
+
+        self.assertRaises(ValueError, list, lib.sshm('example.com', 'ls', compress=True,
+            stdout_path='/tmp/out'))
+
+
+    def test_no_gzip(self):
+        """
+        Output is sent as it is when the server does not have gzip.
+        """
+        import shutil, tempfile
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        os.symlink('/bin/sh', os.path.join(directory, 'sh'))
+        self.env = {'PATH':directory}
+        result, = lib.sshm('example.com', 'echo out; echo err >&2; exit 4', compress=True)
+        self.assertEqual((result['return_code'], result['stdout'], result['stderr']),
+                (4, 'out\n', 'Warning\nerr\n'))
+
+
+    def test_gunzip_after(self):
+        import gzip
+        stream = gzip.compress(b'x' * 200000) if hasattr(gzip, 'compress') else None
+        if stream:
+            self.assertEqual(lib._gunzip_after(b'a\nM\n' + stream + b'b\n', b'M'),
+                    b'a\n' + b'x' * 200000 + b'b\n')
+        self.assertEqual(lib._gunzip_after(b'plain', b'M'), b'plain')
+
+
+
+class Test_profile(unittest.TestCase):
+
+
+    def setUp(self):
+        """
+        Run the command of each ssh call locally instead.
+        """
+        import subprocess
+        def popen(cmd, stdin, stdout, stderr):
+            return subprocess.Popen(['/bin/sh', '-c', cmd[-1]], stdin=stdin, stdout=stdout,
+                    stderr=stderr)
+        self.addCleanup(setattr, lib, 'popen', lib.popen)
+        lib.popen = popen
+
+
+    def test_phases(self):
+        """
+        The time of each phase of the loop and of each ssh call is added up.
+        """
+        from io import BytesIO
+        profile = lib.Profile(interval=0.001)
+        profile.start()
+        results = list(lib.sshm('example[1-3].com', 'cat; sleep 0.05', stdin=BytesIO(b'in'),
+            profile=profile))
+        profile.stop()
+        self.assertEqual([i['stdout'] for i in results], ['in'] * 3)
+
+        report = profile.report()
+        self.assertEqual(sorted(report['phases']), ['coordinator', 'worker'])
+        coordinator = report['phases']['coordinator']
+        self.assertEqual(set(coordinator), set(['targets', 'thread start', 'poll', 'result',
+            'stdin', 'caller', 'join']))
+        self.assertEqual(coordinator['result']['count'], 3)
+        self.assertEqual(coordinator['targets']['count'], 4)
+        worker = report['phases']['worker']
+        self.assertEqual(set(worker), set(['start', 'stdin', 'wait', 'send']))
+        self.assertEqual(worker['wait']['count'], 3)
+        self.assertGreaterEqual(worker['wait']['wall'], 0.15)
+        self.assertGreaterEqual(report['elapsed'], 0.05)
+        # The loop was sampled while it waited
+        self.assertTrue(any('lib.py:sshm' in stack for stack in report['samples']))
+
+        lines = profile.lines()
+        self.assertTrue(lines[0].startswith('elapsed '))
+        self.assertTrue(any(i.startswith('worker wait: 3 calls, ') for i in lines))
+
+
+
+class Test_script(unittest.TestCase):
+    """
+    Several commands can be run using one ssh session.
+    """
+
+    def setUp(self):
+        """
+        Run the command of each ssh call locally instead.
+        """
+        import subprocess
+        self.calls = []
+        def popen(cmd, stdin, stdout, stderr):
+            self.calls.append(cmd)
+            return subprocess.Popen(['sh', '-c', cmd[-1]], stdin=stdin, stdout=stdout,
+                    stderr=stderr)
+        self.addCleanup(setattr, lib, 'popen', lib.popen)
+        lib.popen = popen
+
+
+    def test_script(self):
+        """
+        Each step is reported separately, the shell is shared by all steps.
+        """
+        commands = ['cd /; echo {fqdn}', 'pwd; echo oops >&2; false', 'printf "%s" "$x"; x=1',
+                'printf "%s" "$x"']
+        results = list(lib.script('example[1-2].com', commands))
+        self.assertEqual(len(results), 2)
+        self.assertEqual(len(self.calls), 2)
+        for result in results:
+            self.assertEqual(result['return_code'], 0)
+            self.assertEqual(result['stderr'], '')
+            self.assertNotIn('stdout', result)
+            self.assertEqual(result['steps'], [
+                {'command':commands[0], 'return_code':0, 'stdout':result['uri']+'\n', 'stderr':''},
+                {'command':commands[1], 'return_code':1, 'stdout':'/\n', 'stderr':'oops\n'},
+                {'command':commands[2], 'return_code':0, 'stdout':'', 'stderr':''},
+                {'command':commands[3], 'return_code':0, 'stdout':'1', 'stderr':''},
+                ])
+
+
+    def test_stop_on_failure(self):
+        """
+        The steps after a failure are not run, the output may be bytes.
+        """
+        commands = ['echo {one}', 'exit 3', 'echo never']
+        results = list(lib.script('example.com', commands, stop_on_failure=True,
+            disable_formatting_var=True, encoding=None))
+        self.assertEqual(results[0]['return_code'], 3)
+        self.assertEqual(results[0]['steps'], [
+            {'command':commands[0], 'return_code':0, 'stdout':b'{one}\n', 'stderr':b''},
+            ])
+
+        # Output that is not part of a step is kept, the output of a step may
+        # contain anything
+        steps, stdout = lib._split_steps(b'motd\nm 1 2 4 0\nm 0\nm 0 0 0 0\nbye',
+                'm', ['a', 'b'], 'utf-8', 'replace')
+        self.assertEqual(steps, [
+            {'command':'b', 'return_code':2, 'stdout':'m 0\n', 'stderr':''},
+            {'command':'a', 'return_code':0, 'stdout':'', 'stderr':''},
+            ])
+        self.assertEqual(stdout, 'motd\nbye')
+        self.assertRaises(ValueError, next, lib.script('example.com', ['ls'],
+            stdout_path='/tmp/{uri}'))
+
+
+
+class Test_lazy_expansion(unittest.TestCase):
+    """
+    Extremely large server specifications are expanded lazily.
+    """
+
+    def test_memory(self):
+        """
+        The memory used to expand a specification does not depend on its size,
+        and the first uri is available immediately.
+        """
+        import time
+        import tracemalloc
+
+        for spec, count in (('10.0-255.0-255.0-255', 256**3),
+                ('host[1-100000000].example.com', 100000000)):
+            self.assertEqual(lib.uri_count(spec), count)
+
+            tracemalloc.start()
+            self.addCleanup(tracemalloc.stop)
+            start = time.time()
+            gen = lib.uri_expansion(spec)
+            next(gen)
+            first = time.time() - start
+            for i in range(100000):
+                next(gen)
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            self.assertLess(first, 0.1)
+            self.assertLess(peak, 256 * 1024)
+
+
+    def test_first_spawn(self):
+        """
+        sshm starts the first ssh connection without expanding the rest of the
+        specification.
+        """
+        sub, proc = fake_subprocess('', '', 0)
+        self.addCleanup(setattr, lib, 'popen', lib.popen)
+        lib.popen = sub.popen
+
+        results = lib.sshm('10.0-255.0-255.0-255', 'exit', workers=1)
+        self.assertIn(next(results)['uri'], ('10.0.0.0', '10.0.0.1'))
+        self.assertEqual(sub.popen.call_count, 1)
+
+
 
@@ -2,7 +2,10 @@
 """
 This module tests what is testable in main.py
 """
-from sshm.main import get_argparse_args, _print_handling_newlines
+from sshm.main import get_argparse_args, _print_handling_newlines, _print_result, _Progress, _until_aborted, \
+        _Quantile, _Reduction, _InlineWriter, _print_inline, \
+        _read_script, _report_profile
+from sshm.lib import RollingAbort
 import unittest
 
 try:
@@ -94,6 +97,178 @@ class TestFuncs(unittest.TestCase):
         self.assertEqual(args.workers, 5)
         self.assertEqual(extra_args, [])
 
+        # You can copy a file from each host
+        provided = ['-g', '/tmp/logs', '--compress', 'example[1-9].com', '/var/log/syslog']
+        args, command, extra_args = get_argparse_args(provided)
+        self.assertEqual(args.gather, '/tmp/logs')
+        self.assertTrue(args.compress)
+        self.assertEqual(command, '/var/log/syslog')
+        self.assertEqual(extra_args, [])
+
+        # Any output can be compressed, except output written to files
+        provided = ['--compress', 'example[1-9].com', 'ls']
+        args, command, extra_args = get_argparse_args(provided)
+        self.assertTrue(args.compress)
+        for provided in (['--compress', '--output-dir', '/tmp/out', 'example.com', 'ls'],
+                ['--compress', '-f', '2', 'example.com', 'ls']):
+            self.assertRaises(SystemExit, get_argparse_args, provided)
+
+        # You can write the output of each host to files
+        provided = ['--output-dir', '/tmp/out', 'example[1-9].com', 'dmesg']
+        args, command, extra_args = get_argparse_args(provided)
+        self.assertEqual(args.output_dir, '/tmp/out')
+        self.assertEqual(command, 'dmesg')
+        self.assertEqual(extra_args, [])
+
+        # Output can not be gathered and written to an output directory
+        provided = ['-g', '/tmp/logs', '--output-dir', '/tmp/out', 'example.com', 'ls']
+        self.assertRaises(SystemExit, get_argparse_args, provided)
+
+        # You can display the progress
+        provided = ['--progress', 'example[1-9].com', 'ls']
+        args, command, extra_args = get_argparse_args(provided)
+        self.assertTrue(args.progress)
+        self.assertEqual(extra_args, [])
+
+        # You can distribute stdin using a tree of hosts
+        provided = ['-f', '3', 'example[1-9].com', 'ls']
+        args, command, extra_args = get_argparse_args(provided)
+        self.assertEqual(args.fanout, 3)
+        self.assertEqual(command, 'ls')
+        self.assertEqual(extra_args, [])
+
+        # The fan-out can not be combined with other ways of handling output
+        for provided in (['-f', '0', 'example.com', 'ls'],
+                ['-f', '2', '-g', '/tmp/logs', 'example.com', 'ls'],
+                ['-f', '2', '--output-dir', '/tmp/out', 'example.com', 'ls']):
+            self.assertRaises(SystemExit, get_argparse_args, provided)
+
+        # Servers can be excluded and connected to in a different order
+        provided = ['--exclude', '10.0.0.0/24', '--order', 'random', '--seed', '4',
+                '10.0.0.0/16', 'ls']
+        args, command, extra_args = get_argparse_args(provided)
+        self.assertEqual(args.exclude, '10.0.0.0/24')
+        self.assertEqual(args.order, 'random')
+        self.assertEqual(args.seed, 4)
+        self.assertEqual(args.servers, ['10.0.0.0/16',])
+        self.assertEqual(extra_args, [])
+
+        provided = ['--intersect', 'example[1-5].com', 'example[1-3].com', 'example[3-9].com', 'ls']
+        args, command, extra_args = get_argparse_args(provided)
+        self.assertEqual(args.intersect, 'example[1-5].com')
+        self.assertEqual(args.servers, ['example[1-3].com', 'example[3-9].com'])
+
+        provided = ['--resolve', 'example[1-3].com', 'ls']
+        args, command, extra_args = get_argparse_args(provided)
+        self.assertTrue(args.resolve)
+        # A fan-out tree resolves its own hosts
+        provided = ['--resolve', '-f', '2', 'example[1-3].com', 'ls']
+        self.assertRaises(SystemExit, get_argparse_args, provided)
+
+        provided = ['--probe', '10.0.0.0/8', 'hostname']
+        args, command, extra_args = get_argparse_args(provided)
+        self.assertTrue(args.probe)
+        provided = ['--probe', '-f', '2', 'example[1-3].com', 'ls']
+        self.assertRaises(SystemExit, get_argparse_args, provided)
+
+        provided = ['--canary', '1', '--batch', '10%', '--max-failure-rate', '0.1',
+                'example[1-30].com', 'ls']
+        args, command, extra_args = get_argparse_args(provided)
+        self.assertEqual((args.canary, args.batch, args.max_failure_rate), (1, '10%', 0.1))
+        args, command, extra_args = get_argparse_args(['--batch', '5', 'example.com', 'ls'])
+        self.assertEqual(args.batch, 5)
+        for provided in (['--batch', '0', 'example.com', 'ls'],
+                ['--batch', 'x%', 'example.com', 'ls'],
+                ['--canary', '0', 'example.com', 'ls'],
+                ['--max-failure-rate', '-1', 'example.com', 'ls'],
+                ['--batch', '5', '-f', '2', 'example.com', 'ls']):
+            self.assertRaises(SystemExit, get_argparse_args, provided)
+
+        import os
+        import tempfile
+        scripts = []
+        for contents in ('uptime\n', '# Nothing\n\n'):
+            fd, path = tempfile.mkstemp(suffix='.sh')
+            os.write(fd, contents.encode())
+            os.close(fd)
+            self.addCleanup(os.remove, path)
+            scripts.append(path)
+        checks, empty = scripts
+        provided = ['--script', '--stop-on-failure', 'example[1-3].com', checks]
+        args, command, extra_args = get_argparse_args(provided)
+        self.assertTrue(args.script)
+        self.assertTrue(args.stop_on_failure)
+        self.assertEqual(command, checks)
+        self.assertEqual(args.commands, ['uptime'])
+        # A script without commands, or that can not be read, is an error
+        for provided in (['--stop-on-failure', 'example.com', 'ls'],
+                ['--script', '-g', '/tmp/logs', 'example.com', checks],
+                ['--script', 'example.com', empty],
+                ['--script', 'example.com', empty + '.missing']):
+            self.assertRaises(SystemExit, get_argparse_args, provided)
+
+        provided = ['--daemon', '--batch', '2', 'example[1-3].com', 'ls']
+        args, command, extra_args = get_argparse_args(provided)
+        self.assertTrue(args.daemon)
+        for provided in (['--daemon', '--script', 'example.com', 'checks.sh'],
+                ['--daemon', '-f', '2', 'example.com', 'ls']):
+            self.assertRaises(SystemExit, get_argparse_args, provided)
+
+        provided = ['--transport', 'asyncssh', 'example[1-3].com', 'ls']
+        args, command, extra_args = get_argparse_args(provided)
+        self.assertEqual(args.transport, 'asyncssh')
+        for provided in (['--transport', 'asyncssh', 'example.com', 'ls', '-v'],
+                ['--transport', 'asyncssh', '-g', '/tmp/logs', 'example.com', 'foo'],
+                ['--transport', 'paramiko', 'example.com', 'ls']):
+            self.assertRaises(SystemExit, get_argparse_args, provided)
+
+        provided = ['--reduce', 'example[1-3].com', 'ps aux | wc -l']
+        args, command, extra_args = get_argparse_args(provided)
+        self.assertTrue(args.reduce)
+        self.assertRaises(SystemExit, get_argparse_args, ['--reduce', '--script', 'example.com', 'a'])
+
+        provided = ['--history', 'example[1-3].com', 'ls']
+        args, command, extra_args = get_argparse_args(provided)
+        self.assertTrue(args.history)
+        for provided in (['--history', '--order', 'random', 'example.com', 'ls'],
+                ['--history', '-f', '2', 'example.com', 'ls']):
+            self.assertRaises(SystemExit, get_argparse_args, provided)
+
+        provided = ['--store', 'example[1-3].com', 'uname -r']
+        args, command, extra_args = get_argparse_args(provided)
+        self.assertTrue(args.store)
+        self.assertEqual(extra_args, [])
+
+        provided = ['--inline', 'example[1-3].com', 'ls', '-i', 'key']
+        args, command, extra_args = get_argparse_args(provided)
+        self.assertTrue(args.inline)
+        self.assertEqual(extra_args, ['-i', 'key'])
+        self.assertRaises(SystemExit, get_argparse_args, ['--inline', '-u', 'example.com', 'ls'])
+
+        provided = ['--profile', 'example[1-3].com', 'ls']
+        args, command, extra_args = get_argparse_args(provided)
+        self.assertTrue(args.profile)
+        self.assertEqual((args.servers, command), (['example[1-3].com'], 'ls'))
+        provided = ['--profile', '--profile-output', 'out.json', '--profile-interval', '0.01',
+                'example.com', 'ls']
+        args, command, extra_args = get_argparse_args(provided)
+        self.assertEqual((args.profile_output, args.profile_interval), ('out.json', 0.01))
+        for provided in (['--profile', '--daemon', 'example.com', 'ls'],
+                ['--profile-interval', '0.01', 'example.com', 'ls'],
+                ['--profile-output', 'out.json', 'example.com', 'ls'],
+                ['--profile', '--profile-interval', '0', 'example.com', 'ls']):
+            self.assertRaises(SystemExit, get_argparse_args, provided)
+
+        provided = ['--prefetch-hostkeys', 'example[1-3].com', 'ls']
+        args, command, extra_args = get_argparse_args(provided)
+        self.assertTrue(args.prefetch_hostkeys)
+        self.assertEqual(extra_args, [])
+
+        # A seed is only used by the random order
+        for provided in (['--seed', '4', 'example.com', 'ls'],
+                ['--order', 'sorted', 'example.com', 'ls']):
+            self.assertRaises(SystemExit, get_argparse_args, provided)
+
 
     def test__print_handling_newlines(self):
         """
@@ -114,5 +289,257 @@ class TestFuncs(unittest.TestCase):
             tfh.seek(0)
             self.assertEqual(tfh.read(), expected)
 
+        # Bytes are written without being decoded
+        from io import BytesIO
+        prov_exp = [
+                (('uri', 0, b'\xff\xfe'), b'sshm: uri(0): \xff\xfe\n'),
+                (('uri', 0, b'a\nb\n', 'Error: '), b'sshm: Error: uri(0):\na\nb\n\n'),
+                (('uri', 0, b' \xff\n', '', True), b'sshm: uri(0): \xff\n'),
+                (('uri', 0, b'\xff', '', False, True), b'\xff\n'),
+                ]
+
+        for provided, expected in prov_exp:
+            tfh = BytesIO()
+            _print_handling_newlines(*provided, file=tfh),
+            self.assertEqual(tfh.getvalue(), expected)
+
+
+    def test__print_result(self):
+        """
+        Output written to files is printed as its path and size.
+        """
+        args, command, extra_args = get_argparse_args(['example.com', 'ls'])
+        result = {
+                'uri':'example.com',
+                'return_code':1,
+                'stdout_path':'/tmp/out/example.com.out',
+                'stdout_size':12,
+                'stderr_path':'/tmp/out/example.com.err',
+                'stderr_size':3,
+                }
+        stdout, stderr = StringIO(), StringIO()
+        _print_result(result, args, stdout, stderr)
+        self.assertEqual(stdout.getvalue(),
+                'sshm: example.com(1): /tmp/out/example.com.out (12 bytes)\n')
+        self.assertEqual(stderr.getvalue(),
+                'sshm: Error: example.com(1): /tmp/out/example.com.err (3 bytes)\n')
+
+        # An empty stderr file is not printed
+        result['stderr_size'] = 0
+        stdout, stderr = StringIO(), StringIO()
+        _print_result(result, args, stdout, stderr)
+        self.assertEqual(stderr.getvalue(), '')
+
+        # Tracebacks are printed to stderr
+        stdout, stderr = StringIO(), StringIO()
+        _print_result({'uri':'example.com', 'traceback':'Oh no!'}, args,
+                stdout, stderr)
+        self.assertEqual(stdout.getvalue(), '')
+        self.assertEqual(stderr.getvalue(), 'sshm: Traceback: example.com(): Oh no!\n')
 
+        # Each step of a script is printed
+        result = {'uri':'example.com', 'return_code':1, 'stderr':'', 'steps':[
+            {'command':'true', 'return_code':0, 'stdout':'yes', 'stderr':''},
+            {'command':'false', 'return_code':1, 'stdout':'', 'stderr':'no'},
+            ]}
+        stdout, stderr = StringIO(), StringIO()
+        _print_result(result, args, stdout, stderr)
+        self.assertEqual(stdout.getvalue(),
+                'sshm: [1] example.com(0): yes\nsshm: [2] example.com(1): \n')
+        self.assertEqual(stderr.getvalue(), 'sshm: Error: [2] example.com(1): no\n')
+
+        # An alias is printed with the server that was connected to
+        result = {'uri':'www.example.com', 'alias_of':'example.com', 'address':'10.0.0.1'}
+        stdout, stderr = StringIO(), StringIO()
+        _print_result(result, args, stdout, stderr)
+        self.assertEqual(stdout.getvalue(),
+                'sshm: www.example.com(alias): same address as example.com\n')
+        self.assertEqual(stderr.getvalue(), '')
+
+
+    def test_progress(self):
+        """
+        The progress line is only redrawn once per interval.
+        """
+        now = [100.0]
+        tfh = StringIO()
+        progress = _Progress(10, tfh, interval=1, clock=lambda: now[0])
+
+        now[0] = 100.5
+        progress.update({'return_code':0})
+        self.assertEqual(tfh.getvalue(), '')
+
+        now[0] = 102.0
+        progress.set_running(4)
+        progress.update({'return_code':1})
+        self.assertEqual(tfh.getvalue(),
+                '\rsshm: 2/10 done, 4 running, 1 failed, 1.0 hosts/s, ETA 8s\x1b[K')
+
+        for i in range(7):
+            progress.update({'traceback':'Oh no!'})
+        progress.set_running(0)
+        progress.finish()
+        self.assertTrue(tfh.getvalue().endswith(
+            '\rsshm: 9/10 done, 0 running, 8 failed, 4.5 hosts/s, ETA 0s\x1b[K\n'))
+
+        # Without set_running, the running connections are unknown
+        self.assertEqual(_Progress(3, tfh, clock=lambda: 100.0).line(),
+                'sshm: 0/3 done, ? running, 0 failed, 0.0 hosts/s, ETA ?')
+
+
+    def test__Quantile(self):
+        """
+        Quantiles are exact for few numbers, then estimated closely.
+        """
+        import random
+        generator = random.Random(4)
+        quantiles = dict((p, _Quantile(p)) for p in (0.5, 0.9, 0.99))
+        self.assertIsNone(quantiles[0.5].value())
+        for x in (3, 1, 2):
+            quantiles[0.5].add(x)
+        self.assertEqual(quantiles[0.5].value(), 2)
 
+        # A skewed distribution is exact up to the limit
+        quantile = _Quantile(0.99, exact=100)
+        values = [1] * 90 + [1000] * 10
+        generator.shuffle(values)
+        for x in values:
+            quantile.add(x)
+        self.assertEqual(quantile.value(), 1000)
+        # The estimate starts from the exact values
+        quantile.add(1)
+        self.assertEqual(quantile.value(), 1000)
+
+        for i in range(20000):
+            x = generator.uniform(0, 1000)
+            for quantile in quantiles.values():
+                quantile.add(x)
+        for p, quantile in quantiles.items():
+            self.assertAlmostEqual(quantile.value(), p * 1000, delta=10)
+
+
+    def test__Reduction(self):
+        """
+        Only a summary of the numbers is kept.
+        """
+        reduction = _Reduction(outliers=2)
+        self.assertEqual(reduction.lines(), ['0 hosts, 0 failed, 0 did not print a number'])
+        for i in range(1, 101):
+            reduction.add({'uri':'example{}.com'.format(i), 'return_code':0,
+                'stdout':'{}\n'.format(i).encode()})
+        reduction.add({'uri':'example.com', 'return_code':0, 'stdout':b'lots'})
+        reduction.add({'uri':'example.com', 'return_code':1, 'stdout':b'7'})
+        reduction.add({'uri':'example.com', 'traceback':'oops'})
+        self.assertEqual(reduction.lines(), [
+            '103 hosts, 2 failed, 1 did not print a number',
+            'sum 5050, mean 50.5, standard deviation 28.8661',
+            'min 1 (example1.com), max 100 (example100.com)',
+            # Percentiles are exact for few hosts
+            'p50 51, p90 90, p99 99',
+            'highest: example100.com (100), example99.com (99)',
+            'lowest: example1.com (1), example2.com (2)',
+            ])
+
+        # Integers are summed exactly
+        reduction = _Reduction()
+        for stdout in (b'12345678901234567891\n', b'1'):
+            reduction.add({'uri':'example.com', 'return_code':0, 'stdout':stdout})
+        self.assertEqual(reduction.total, 12345678901234567892)
+        reduction.add({'uri':'example.com', 'return_code':0, 'stdout':b'0.5'})
+        self.assertEqual((reduction.count, reduction.invalid), (3, 0))
+
+
+    def test__InlineWriter(self):
+        """
+        Every line is prefixed, the lines are written in batches.
+        """
+        from io import BytesIO
+        file = BytesIO()
+        now = [0]
+        writer = _InlineWriter(file, size=30, interval=1, clock=lambda: now[0])
+        writer.write('a', b'1\n2\n')
+        writer.write('b', '3')
+        writer.write('c', b'')
+        self.assertEqual(file.getvalue(), b'')
+        writer.write('long', b'4\n\n5')
+        self.assertEqual(file.getvalue(), b'a: 1\na: 2\nb: 3\nlong: 4\nlong: \nlong: 5\n')
+        writer.write('d', b'6\n')
+        now[0] = 2
+        writer.write('e', b'7\n')
+        self.assertTrue(file.getvalue().endswith(b'long: 5\nd: 6\ne: 7\n'))
+
+
+    def test__print_inline(self):
+        from io import BytesIO
+        class args:
+            strip_whitespace = True
+        stdout, stderr = BytesIO(), BytesIO()
+        writers = (_InlineWriter(stdout), _InlineWriter(stderr))
+        _print_inline({'uri':'example.com', 'return_code':2, 'stdout':b' out\nput\n ',
+            'stderr':b'oops\n'}, args, *writers)
+        _print_inline({'uri':'example.com', 'return_code':0, 'steps':[
+            {'command':'ls', 'return_code':0, 'stdout':b'x\n', 'stderr':b''}]}, args, *writers)
+        _print_inline({'uri':'alias.com', 'alias_of':'example.com'}, args, *writers)
+        for writer in writers:
+            writer.flush()
+        self.assertEqual(stdout.getvalue(),
+                b'example.com: out\nexample.com: put\n[1] example.com: x\n')
+        self.assertEqual(stderr.getvalue(), b'example.com: oops\n'
+                b'example.com: sshm: return code 2\nalias.com: same address as example.com\n')
+
+
+    def test__until_aborted(self):
+        """
+        The results before a rolling execution stopped are kept, the abort is
+        reported afterwards.
+        """
+        def results():
+            yield {'uri':'example1.com'}
+            raise RollingAbort(1, 1, 'example[2-5].com')
+        aborts = []
+        self.assertEqual(list(_until_aborted(results(), aborts)), [{'uri':'example1.com'},])
+        self.assertEqual(len(aborts), 1)
+        self.assertEqual(str(aborts[0]),
+                '1 of 1 servers failed, these servers were not started: example[2-5].com')
+
+
+    def test__report_profile(self):
+        """
+        A profile is printed on stderr, or written to a file as JSON.
+        """
+        import json
+        import os
+        import sys
+        import tempfile
+        from sshm.lib import Profile
+        profile = Profile()
+        with profile.phase('coordinator', 'poll'):
+            pass
+        profile.samples = {'main.py:main;lib.py:sshm':3}
+        self.addCleanup(setattr, sys, 'stderr', sys.stderr)
+        sys.stderr = StringIO()
+        _report_profile(profile)
+        lines = sys.stderr.getvalue().splitlines()
+        self.assertEqual(lines[0], 'sshm: profile: elapsed 0.000s')
+        self.assertTrue(lines[1].startswith('sshm: profile: coordinator poll: 1 calls, '))
+        self.assertEqual(lines[2], 'sshm: profile: 3 samples: main.py:main;lib.py:sshm')
+
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        _report_profile(profile, path)
+        with open(path) as file:
+            report = json.load(file)
+        self.assertEqual(report['phases']['coordinator']['poll']['count'], 1)
+        self.assertEqual(report['samples'], {'main.py:main;lib.py:sshm':3})
+
+
+    def test__read_script(self):
+        """
+        Each line of a script is a command, except empty lines and comments.
+        """
+        import tempfile
+        with tempfile.NamedTemporaryFile('w', suffix='.sh') as file:
+            file.write('# Checks\nuptime\n\n  df -h /  \n')
+            file.flush()
+            self.assertEqual(_read_script(file.name), ['uptime', 'df -h /'])
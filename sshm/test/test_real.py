@@ -69,9 +69,11 @@ class TestReal(unittest.TestCase):
     def test_localhost_multi(self):
         """
         Simply login to the local machine three times and verify there is
-        output.
+        output.  A server that is repeated is only connected to once.
         """
-        results_list = list(sshm('localhost,localhost,localhost', 'echo testing'))
+        self.assertEqual(1, len(list(sshm('localhost,localhost', 'echo testing'))))
+        results_list = list(sshm('localhost,127.0.0.1,localhost:22,localhost',
+            'echo testing'))
 
         # Verify all instances are unique
         self.assertEqual(3,
@@ -0,0 +1,128 @@
+#! /usr/bin/env python3
+"""
+This module tests storing and querying results.
+"""
+from sshm import store
+
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import unittest
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+
+class Test_store(unittest.TestCase):
+
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'data', 'results.sqlite')
+        self.now = [1000.0]
+        def clock():
+            self.now[0] += 1
+            return self.now[0]
+        self.store = store.Store(self.path, batch=2, interval=60, clock=clock)
+        self.addCleanup(self.store.close)
+
+
+    def stored(self):
+        """
+        Count the results another connection can see.
+        """
+        connection = sqlite3.connect(self.path)
+        try:
+            return connection.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+        finally:
+            connection.close()
+
+
+    def test_record(self):
+        """
+        Results are written in batches, and yielded unchanged.
+        """
+        results = [{'uri':'example{}.com'.format(i), 'return_code':i, 'stdout':b'out',
+            'stderr':b''} for i in range(3)]
+        recorded = self.store.record(iter(results), ['example[0-2].com'], 'ls', run='first')
+        self.assertEqual(next(recorded), results[0])
+        self.assertEqual(self.stored(), 0)
+        self.assertEqual(next(recorded), results[1])
+        self.assertEqual(self.stored(), 2)
+        self.assertEqual(list(recorded), results[2:])
+        self.assertEqual(self.stored(), 3)
+
+        self.assertEqual(self.store.runs(), [{'run':'first', 'started':1001.0, 'command':'ls',
+            'servers':'example[0-2].com'}])
+        stored = self.store.results(uri='example1.com')
+        self.assertEqual(stored, [{'run':'first', 'uri':'example1.com', 'command':'ls',
+            'return_code':1, 'stdout':b'out', 'stderr':b'', 'traceback':None,
+            'received':1003.0, 'elapsed':2.0}])
+        self.assertEqual(len(self.store.results(command='ls', run='first')), 3)
+        self.assertEqual(len(self.store.results(command='pwd')), 0)
+        self.assertEqual(len(self.store.results(limit=2)), 2)
+
+
+    def test_steps_and_files(self):
+        """
+        Each step of a script is stored as a result of its command, an output
+        written to a file is stored as its path.
+        """
+        results = [{'uri':'example.com', 'return_code':0, 'steps':[
+            {'command':'uname -r', 'return_code':0, 'stdout':'5.4\n', 'stderr':''}]},
+            {'uri':'example2.com', 'return_code':0, 'stdout_path':'out/example2.com.out',
+                'stdout_size':12}]
+        list(self.store.record(results, ['example.com'], 'checks.sh'))
+        self.assertEqual([i['stdout'] for i in self.store.results(command='uname -r')], ['5.4\n'])
+        self.assertEqual(self.store.results(uri='example2.com')[0]['stdout'],
+                'out/example2.com.out (12 bytes)')
+
+
+    def test_changed(self):
+        """
+        The results that changed between two runs are found.
+        """
+        def run(outputs):
+            list(self.store.record([{'uri':uri, 'return_code':0, 'stdout':output}
+                for uri, output in outputs], ['example'], 'uname -r'))
+        self.assertRaises(ValueError, self.store.changed, 'uname -r')
+        run([('a', b'1'), ('b', b'1'), ('c', b'1')])
+        run([('a', b'1'), ('b', b'2'), ('d', b'1')])
+        changes = self.store.changed('uname -r')
+        self.assertEqual([(uri, before and before['stdout'], after and after['stdout'])
+            for uri, before, after in changes],
+            [('b', b'1', b'2'), ('c', b'1', None), ('d', None, b'1')])
+
+
+    def test_main(self):
+        """
+        The console prints the stored results.
+        """
+        list(self.store.record([{'uri':'a', 'return_code':0, 'stdout':b'1\n'}], ['a'],
+            'uname -r', run='first'))
+        list(self.store.record([{'uri':'a', 'return_code':1, 'stdout':b'2\n',
+            'stderr':b'oops\n'}], ['a'], 'uname -r', run='second'))
+        self.addCleanup(setattr, sys, 'stdout', sys.stdout)
+        sys.stdout = StringIO()
+        store.main(['--db', self.path, '--host', 'a'])
+        store.main(['--db', self.path, '--changed', 'uname -r'])
+        self.assertEqual(sys.stdout.getvalue(), 'second: a(1): 2\nsecond: a(1): stderr: oops\n'
+                'first: a(0): 1\n'
+                'a changed:\nfirst: a(0): 1\nsecond: a(1): 2\nsecond: a(1): stderr: oops\n')
+
+
+    def test_default_store(self):
+        self.addCleanup(os.environ.pop, 'SSHM_STORE', None)
+        os.environ['SSHM_STORE'] = '/foo/results.sqlite'
+        self.assertEqual(store.default_store(), '/foo/results.sqlite')
+        del os.environ['SSHM_STORE']
+        self.assertTrue(store.default_store().endswith(os.path.join('sshm', 'results.sqlite')))
+
+
+
+if __name__ == '__main__':
+    unittest.main()